@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import importlib.util
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+import db_pool
+
+
+# Production ASGI entry point for the Flask app, e.g.
+#
+#   uvicorn asgi:app --workers 4
+#   python asgi.py --workers 4 --threads 16
+#
+# The event loop only moves bytes; every request runs the unchanged Flask app
+# (so responses are identical to the WSGI server) on a bounded reader thread
+# pool, while writes to the sleep database are funnelled through a single writer
+# thread so SQLite's one-writer lock is never contended inside a process. Other
+# POSTs - the credentials routes, on their own database, and the write-behind
+# /fhir/insert_sleep_data, which only enqueues - stay on the reader pool, so
+# they do not queue behind the sleep database's writes or each other.
+
+READ_THREADS = int(os.environ.get("ASGI_READ_THREADS", min(32, (os.cpu_count() or 1) + 4)))
+READ_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+# One pooled read connection per reader thread plus one for the writer
+db_pool.configure(size=READ_THREADS + 1)
+
+
+def _load_flask_app():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fhir-sleepdata.py')
+    spec = importlib.util.spec_from_file_location('fhir_sleepdata', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['fhir_sleepdata'] = module
+    spec.loader.exec_module(module)
+    return module.app
+
+
+flask_app = _load_flask_app()
+_urls = flask_app.url_map.bind('localhost')
+
+# Endpoints that write the sleep database
+SLEEP_WRITE_ENDPOINTS = {'api_add_new_patient', 'api_process_bundle', 'delete_observation_fhir'}
+if not flask_app.config.get('WRITE_BEHIND_ENABLED'):
+    SLEEP_WRITE_ENDPOINTS.add('api_insert_sleep_data')
+
+# Tasks of the requests being served, awaited on shutdown before the pools close
+_in_flight = set()
+_readers = ThreadPoolExecutor(max_workers=READ_THREADS, thread_name_prefix='sqlite-reader')
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def _executor_for(scope):
+    if scope['method'] in READ_METHODS:
+        return _readers
+    try:
+        endpoint, _ = _urls.match(scope['path'], scope['method'])
+    except HTTPException:
+        return _readers  # 404 or 405, answered without touching the database
+    return _writer if endpoint in SLEEP_WRITE_ENDPOINTS else _readers
+
+
+def _start(environ):
+    # Runs the WSGI app up to its first body chunk, on a worker thread
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+    body = flask_app(environ, start_response)
+    chunks = iter(body)
+    first = next(chunks, None)
+    return started['status'], started['headers'], body, chunks, first
+
+
+async def _http(scope, receive, send):
+    task = asyncio.current_task()
+    _in_flight.add(task)
+    try:
+        await _serve(scope, receive, send)
+    finally:
+        _in_flight.discard(task)
+
+
+async def _serve(scope, receive, send):
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        body.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+
+    loop = asyncio.get_running_loop()
+    executor = _executor_for(scope)
+    status, headers, iterable, chunks, chunk = await loop.run_in_executor(
+        executor, _start, _environ(scope, b''.join(body)))
+    try:
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            # Streamed responses (e.g. $export) pull each chunk on the pool too
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(executor, iterable.close)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Replay uploads a crash left in the write-behind journal before serving
+            if flask_app.config.get('WRITE_BEHIND_ENABLED'):
+                await asyncio.get_running_loop().run_in_executor(None, flask_app.extensions['write_queue'].start)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Let in-flight requests, including the rest of their response bodies,
+            # and queued writes finish before closing connections
+            if _in_flight:
+                await asyncio.wait(list(_in_flight))
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, _writer.shutdown, True)
+            await loop.run_in_executor(None, _readers.shutdown, True)
+            # Group-commit whatever the write-behind queue still holds
+            await loop.run_in_executor(None, flask_app.extensions['write_queue'].close)
+            db_pool.close_all_pools()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        await _http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    else:
+        raise NotImplementedError("Unsupported ASGI scope type: {}".format(scope['type']))
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the FHIR API through ASGI.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get("PORT", 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1)),
+                        help="number of worker processes")
+    parser.add_argument('--threads', type=int, default=READ_THREADS,
+                        help="reader threads per worker process")
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help="seconds to wait for in-flight requests on shutdown")
+    args = parser.parse_args()
+
+    # Worker processes re-import this module, so pass the thread count through the environment
+    os.environ["ASGI_READ_THREADS"] = str(args.threads)
+    uvicorn.run('asgi:app', app_dir=os.path.dirname(os.path.abspath(__file__)), host=args.host, port=args.port,
+                workers=args.workers,
+                timeout_graceful_shutdown=args.graceful_timeout)
@@ -0,0 +1,99 @@
+import argparse
+import csv
+import os
+import random
+from datetime import date, timedelta
+
+
+# Deterministic synthetic Patients and sleep_observations CSVs in the layout of
+# data/*.csv. Every patient draws from its own Random seeded by (seed, patient id),
+# so a dataset is identical across runs and a smaller dataset is a prefix of a
+# larger one. The full benchmark scale is 10,000 patients x 5 years of nights.
+
+PATIENT_HEADER = ['Patient_ID', 'First_Name', 'Last_Name', 'Date_of_Birth', 'Gender', 'Phone_Number',
+                  'Email', 'Address', 'City', 'State', 'Zip_Code']
+OBSERVATION_HEADER = ['patient_id', 'snoring_rate', 'respiratory_rate', 'body_temperature', 'limb_movement',
+                      'blood_oxygen', 'eye_movement', 'sleeping_hours', 'heart_rate', 'stress_level',
+                      'observation_date']
+
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley', 'Jamie', 'Avery', 'Quinn']
+LAST_NAMES = ['Smith', 'Johnson', 'Lee', 'Garcia', 'Brown', 'Davis', 'Miller', 'Wilson', 'Moore', 'Clark']
+CITIES = [('Springfield', 'IL', '627'), ('Portland', 'OR', '972'), ('Austin', 'TX', '787'), ('Albany', 'NY', '122')]
+
+# (low, high) of each vital at stress level 0 and 4; nights interpolate by stress
+# level plus noise, roughly as in the sleep tracker data this project started from
+VITAL_RANGES = [
+    ('snoring_rate', 45.0, 100.0, 2),
+    ('respiratory_rate', 16.0, 30.0, 2),
+    ('body_temperature', 96.0, 85.0, 2),
+    ('limb_movement', 4.0, 19.0, 2),
+    ('blood_oxygen', 97.0, 82.0, 2),
+    ('eye_movement', 60.0, 105.0, 2),
+    ('sleeping_hours', 9.0, 0.0, 2),
+    ('heart_rate', 50.0, 85.0, 0),
+]
+
+FULL_PATIENTS = 10000
+FULL_YEARS = 5
+START_DATE = date(2019, 1, 1)
+
+
+def patient_row(rng, patient_id):
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES)
+    city, state, zip_prefix = rng.choice(CITIES)
+    born = date(1940, 1, 1) + timedelta(days=rng.randrange(365 * 60))
+    return [patient_id, first, last, born.isoformat(), rng.choice(['male', 'female']),
+            '555-{:04d}'.format(rng.randrange(10000)), '{}.{}{}@example.com'.format(first, last, patient_id).lower(),
+            '{} Main St'.format(rng.randrange(1, 9999)), city, state, zip_prefix + '{:02d}'.format(rng.randrange(100))]
+
+
+def observation_rows(rng, patient_id, nights, start=START_DATE):
+    # A patient's baseline stress drifts slowly; each night adds noise
+    baseline = rng.uniform(0, 4)
+    for night in range(nights):
+        baseline = min(4.0, max(0.0, baseline + rng.gauss(0, 0.1)))
+        stress = min(4.0, max(0.0, baseline + rng.gauss(0, 0.6)))
+        row = [patient_id]
+        for _, at_zero, at_four, digits in VITAL_RANGES:
+            value = at_zero + (at_four - at_zero) * stress / 4.0 + rng.gauss(0, abs(at_four - at_zero) * 0.05)
+            row.append(round(value, digits) if digits else int(round(value)))
+        row.append(int(round(stress)))
+        row.append((start + timedelta(days=night)).isoformat())
+        yield row
+
+
+def generate(out_dir, patients=FULL_PATIENTS, years=FULL_YEARS, seed=0):
+    """Write patients.csv and sleep_observation.csv for `patients` x `years` of nights.
+
+    Returns the two file paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    nights = (START_DATE.replace(year=START_DATE.year + years) - START_DATE).days
+    patients_path = os.path.join(out_dir, 'patients.csv')
+    observations_path = os.path.join(out_dir, 'sleep_observation.csv')
+
+    with open(patients_path, 'w', newline='') as patients_file, \
+            open(observations_path, 'w', newline='') as observations_file:
+        patient_writer = csv.writer(patients_file)
+        observation_writer = csv.writer(observations_file)
+        patient_writer.writerow(PATIENT_HEADER)
+        observation_writer.writerow(OBSERVATION_HEADER)
+        for patient_id in range(1, patients + 1):
+            rng = random.Random('{}:{}'.format(seed, patient_id))
+            patient_writer.writerow(patient_row(rng, patient_id))
+            observation_writer.writerows(observation_rows(rng, patient_id, nights))
+
+    return patients_path, observations_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate deterministic synthetic sleep tracker CSVs.")
+    parser.add_argument('out_dir')
+    parser.add_argument('--patients', type=int, default=FULL_PATIENTS)
+    parser.add_argument('--years', type=int, default=FULL_YEARS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = generate(args.out_dir, args.patients, args.years, args.seed)
+    print(f"Wrote {', '.join(paths)}")
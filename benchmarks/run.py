@@ -0,0 +1,288 @@
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.generate_data import FULL_PATIENTS, FULL_YEARS, generate  # noqa: E402
+from db_pool import close_all_pools, connection  # noqa: E402
+from migrations import apply_migrations  # noqa: E402
+from sleep_db import (create_sleep_observations_table, create_table_from_csv,  # noqa: E402
+                      read_patient_observation_store, read_patient_sleep_data)
+
+
+# Benchmark harness: micro-benchmarks of CSV loading, reads (as rows and as an
+# ObservationStore), Bundle construction and JSON encoding, plus Flask
+# test-client requests against every /fhir route, all over a deterministic
+# synthetic dataset. Each run times enough back-to-back calls to fill
+# MIN_RUN_MS, and the fastest run (min_ms, which noise on a shared machine can
+# only make slower) is compared with the stored baselines in baselines.json; a
+# run fails when one is slower than its baseline by more than the threshold
+# percentage, e.g.
+#
+#   python benchmarks/run.py                    # quick scale, compare with baselines
+#   python benchmarks/run.py --full             # 10k patients x 5 years
+#   python benchmarks/run.py --save-baseline    # record new baselines for this scale
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.data')
+QUICK_PATIENTS = 100
+QUICK_YEARS = 1
+DEFAULT_THRESHOLD_PCT = 25.0
+# Each run of a benchmark without a setup repeats the call until it takes this long
+MIN_RUN_MS = 20.0
+MAX_CALLS_PER_RUN = 10000
+
+
+def load_app_module():
+    path = os.path.join(ROOT, 'fhir-sleepdata.py')
+    spec = importlib.util.spec_from_file_location('fhir_sleepdata', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['fhir_sleepdata'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _time_calls(fn, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - start) * 1000.0 / number
+
+
+def measure(fn, repeat, warmup=1, setup=None, min_run_ms=MIN_RUN_MS):
+    # Per-call wall-clock timings of fn() in milliseconds over `repeat` runs. A
+    # run calls fn() as often as fills min_run_ms, so that a sub-millisecond call
+    # is not lost in timer and scheduler noise; with a setup, which runs untimed
+    # before each call, a run is a single call.
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+    number = 1
+    if setup is None:
+        number = max(1, min(MAX_CALLS_PER_RUN, int(min_run_ms / max(_time_calls(fn, 1), 0.001))))
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        timings.append(_time_calls(fn, number))
+    timings.sort()
+    return {
+        'median_ms': statistics.median(timings),
+        'p95_ms': timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))],
+        'min_ms': timings[0],
+        'runs': repeat,
+        'calls_per_run': number,
+    }
+
+
+def _remove_db(db_name):
+    close_all_pools()
+    for path in (db_name, db_name + '-wal', db_name + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def micro_benchmarks(app_module, patients_csv, observations_csv, db_name, patient_ids, repeat):
+    # (name, fn, repeat[, setup]) for the building blocks behind the routes
+    from fhir.resources.bundle import Bundle, BundleEntry
+    from fhir_builders import loinc_observation
+
+    load_db = db_name + '.load'
+
+    def empty_load_db():
+        # Deleting and creating the file costs more than loading the quick-scale
+        # CSVs and varies with the disk, so it is left out of the timings
+        _remove_db(load_db)
+        with connection(load_db):
+            pass
+
+    def load_patients():
+        create_table_from_csv(load_db, patients_csv)
+
+    def load_observations():
+        create_sleep_observations_table(load_db, observations_csv)
+
+    ids = itertools.cycle(patient_ids)
+
+    def read_rows():
+        read_patient_sleep_data(db_name, next(ids))
+
+    def read_store():
+        read_patient_observation_store(db_name, next(ids))
+
+    rows = read_patient_sleep_data(db_name, patient_ids[0])
+    store = read_patient_observation_store(db_name, patient_ids[0])
+
+    def build_bundle():
+        bundle = Bundle(type="searchset")
+        bundle.entry = [BundleEntry(resource=loinc_observation(obs)) for obs in rows]
+        return bundle
+
+    bundle = build_bundle()
+    bundle_dict = bundle.dict()
+
+    return [
+        ('csv_load_patients', load_patients, repeat, empty_load_db),
+        ('csv_load_observations', load_observations, max(5, repeat // 2), empty_load_db),
+        ('read_patient_sleep_data', read_rows, repeat),
+        ('read_patient_observation_store', read_store, repeat),
+        ('observation_store_between', lambda: store.between('2019-03-01', '2019-03-31'), repeat),
+        ('bundle_construction', build_bundle, max(3, repeat // 5)),
+        ('bundle_construction_fast', lambda: app_module.fast_loinc_serializer.bundle(rows), repeat),
+        ('bundle_construction_fast_store', lambda: app_module.fast_loinc_serializer.bundle(store), repeat),
+        ('bundle_dict', bundle.dict, max(3, repeat // 5)),
+        ('json_encode_custom_encoder', lambda: json.dumps(bundle_dict, cls=app_module.CustomEncoder), repeat),
+    ]
+
+
+def route_benchmarks(app_module, patient_ids, repeat):
+    # (name, fn, repeat) issuing one request per call through the Flask test client
+    client = app_module.app.test_client()
+    patient_id = patient_ids[0]
+    batch_ids = patient_ids[:20]
+    rows = read_patient_sleep_data(app_module.db_name, patient_id)[:10]
+    batch = {'resourceType': 'Bundle', 'type': 'batch', 'entry': [
+        {'resource': dict(app_module.fast_loinc_serializer.observation(obs), effectiveDateTime=obs[10]),
+         'request': {'method': 'PUT', 'url': 'Observation'}} for obs in rows]}
+    batch = json.loads(json.dumps(batch, cls=app_module.CustomEncoder))
+
+    def get(url):
+        def fn():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+            response.get_data()
+        return fn
+
+    def post_batch():
+        response = client.post('/fhir', json=batch)
+        assert response.status_code == 200, response.status_code
+
+    return [
+        ('GET /fhir/patient/<id>', get('/fhir/patient/{}'.format(patient_id)), repeat),
+        ('GET /fhir/sleep-observations/<id>', get('/fhir/sleep-observations/{}'.format(patient_id)), repeat),
+        ('GET /fhir/sleep-observations/<id>?_fast=true',
+         get('/fhir/sleep-observations/{}?_fast=true'.format(patient_id)), repeat),
+        ('GET /fhir/sleep-observations-loinc/<id>', get('/fhir/sleep-observations-loinc/{}'.format(patient_id)), repeat),
+        ('GET /fhir/sleep-observations-loinc/<id>?_fast=true',
+         get('/fhir/sleep-observations-loinc/{}?_fast=true'.format(patient_id)), repeat),
+        ('GET /fhir/names', get('/fhir/names'), repeat),
+        ('GET /fhir/names/search?q=', get('/fhir/names/search?q=ja'), repeat),
+        ('GET /fhir/Patient?name=', get('/fhir/Patient?name=ja'), repeat),
+        ('GET /fhir/dates/<id>', get('/fhir/dates/{}'.format(patient_id)), repeat),
+        ('GET /fhir/Patient?_id= (20 ids)', get('/fhir/Patient?_id={}'.format(','.join(map(str, batch_ids)))), repeat),
+        ('GET /fhir/Observation?subject= (20 ids)&_fast=true',
+         get('/fhir/Observation?subject={}&_count=100&_fast=true'.format(','.join(map(str, batch_ids)))), repeat),
+        ('GET /fhir/Patient/<id>/$everything?_fast=true',
+         get('/fhir/Patient/{}/$everything?_fast=true'.format(patient_id)), repeat),
+        ('GET /analytics/rollups/patient/<id>?period=week',
+         get('/analytics/rollups/patient/{}?period=week'.format(patient_id)), repeat),
+        ('GET /analytics/rollups/cohort?period=month', get('/analytics/rollups/cohort?period=month'), repeat),
+        ('GET /fhir/$export?_type=Patient', get('/fhir/$export?_type=Patient'), max(3, repeat // 10)),
+        ('POST /fhir (batch of 10 PUTs)', post_batch, repeat),
+    ]
+
+
+def compare(results, baselines, default_threshold):
+    # Prints each benchmark's fastest run against its baseline; returns the names that regressed
+    regressions = []
+    print('\n{:<52} {:>11} {:>11} {:>9}'.format('benchmark', 'min ms', 'baseline', 'change'))
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print('{:<52} {:>11.3f} {:>11} {:>9}'.format(name, result['min_ms'], '-', 'new'))
+            continue
+        change = (result['min_ms'] - baseline['min_ms']) / baseline['min_ms'] * 100.0
+        threshold = baseline.get('threshold_pct', default_threshold)
+        flag = '  REGRESSION' if change > threshold else ''
+        print('{:<52} {:>11.3f} {:>11.3f} {:>+8.1f}%{}'.format(
+            name, result['min_ms'], baseline['min_ms'], change, flag))
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def run(patients, years, repeat, only=None):
+    data_dir = os.path.join(DATA_DIR, '{}x{}'.format(patients, years))
+    patients_csv = os.path.join(data_dir, 'patients.csv')
+    observations_csv = os.path.join(data_dir, 'sleep_observation.csv')
+    if not os.path.exists(observations_csv):
+        print(f"Generating {patients} patients x {years} years in {data_dir} ...")
+        generate(data_dir, patients, years)
+
+    app_module = load_app_module()
+    app_module.response_cache.max_bytes = 0  # Measure the routes, not the response cache
+    db_name = os.path.join(data_dir, 'bench.db')
+    app_module.db_name = db_name
+    _remove_db(db_name)
+    create_table_from_csv(db_name, patients_csv)
+    create_sleep_observations_table(db_name, observations_csv)
+    apply_migrations(db_name)
+
+    patient_ids = list(range(1, min(patients, 20) + 1))
+    results = {}
+    for name, fn, runs, *setup in (micro_benchmarks(app_module, patients_csv, observations_csv, db_name, patient_ids,
+                                                    repeat) +
+                                   route_benchmarks(app_module, patient_ids, repeat)):
+        if only and not any(part in name for part in only):
+            continue
+        results[name] = measure(fn, runs, setup=setup[0] if setup else None)
+        print(f"{name}: {results[name]['min_ms']:.3f} ms (median {results[name]['median_ms']:.3f} ms, "
+              f"p95 {results[name]['p95_ms']:.3f} ms, {runs} runs of {results[name]['calls_per_run']} calls)")
+    _remove_db(db_name + '.load')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark suite and check for regressions.")
+    parser.add_argument('--patients', type=int, default=QUICK_PATIENTS)
+    parser.add_argument('--years', type=int, default=QUICK_YEARS)
+    parser.add_argument('--full', action='store_true',
+                        help="use the full scale of {} patients x {} years".format(FULL_PATIENTS, FULL_YEARS))
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--only', nargs='*', help="run only benchmarks whose name contains one of these")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD_PCT,
+                        help="allowed slowdown in percent for baselines without their own threshold_pct")
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baselines")
+    args = parser.parse_args()
+    if args.full:
+        args.patients, args.years = FULL_PATIENTS, FULL_YEARS
+
+    results = run(args.patients, args.years, args.repeat, args.only)
+
+    scale = '{}x{}'.format(args.patients, args.years)
+    stored = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            stored = json.load(f)
+
+    if args.save_baseline:
+        previous = stored.get(scale, {}).get('benchmarks', {})
+        for name, result in results.items():
+            # Keep hand-tuned thresholds when re-recording
+            if 'threshold_pct' in previous.get(name, {}):
+                result['threshold_pct'] = previous[name]['threshold_pct']
+        stored[scale] = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'benchmarks': dict(stored.get(scale, {}).get('benchmarks', {}), **{
+                name: {key: round(value, 3) if isinstance(value, float) else value for key, value in result.items()}
+                for name, result in results.items()}),
+        }
+        with open(BASELINES, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nBaselines for {scale} written to {BASELINES}")
+    else:
+        regressions = compare(results, stored.get(scale, {}).get('benchmarks', {}), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,101 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from db_pool import close_all_pools, connection
+from generate_data import generate
+from shards import STRATEGIES, shard_for
+from sleep_db import init_db
+
+
+# Write-throughput benchmark for sharded storage: builds the same database on
+# 1, 2, 4 and 8 shards and has concurrent writer processes insert observations
+# one committed row at a time, as /fhir/insert_sleep_data does. A single file
+# serialises every commit behind one write lock; each shard has its own, so
+# throughput grows with the shard count until the writers or the disk run out,
+# e.g.
+#
+#   python benchmarks/shard_writes.py --writers 8 --rows 500 --shards 1 2 4 8
+
+INSERT = '''
+    INSERT INTO sleep_observations
+    (patient_id, observation_date, body_temperature, snoring_rate, respiratory_rate, eye_movement, sleeping_hours, heart_rate)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Inserted nights start well after the generated data
+FIRST_NIGHT = date(2100, 1, 1)
+
+
+def write_rows(db_name, writer, writers, patients, rows, start, finished, done):
+    # One writer process: `rows` single-row commits spread over its share of the patients.
+    # Closing the pools checkpoints the WALs, so that waits until every writer is done
+    patient_ids = range(writer + 1, patients + 1, writers)
+    start.wait()
+    for n in range(rows):
+        patient_id = patient_ids[n % len(patient_ids)]
+        night = FIRST_NIGHT + timedelta(days=n // len(patient_ids))
+        with connection(shard_for(db_name, patient_id)) as conn:
+            conn.execute(INSERT, (patient_id, night.isoformat(), 97.1, 60.0, 18.0, 80.0, 7.0, 60))
+            conn.commit()
+    finished.put(time.monotonic())
+    done.wait()
+    close_all_pools()
+
+
+def measure_writes(db_name, writers, patients, rows):
+    # Rows per second committed by `writers` concurrent processes
+    start = multiprocessing.Event()
+    done = multiprocessing.Event()
+    finished = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=write_rows,
+                                         args=(db_name, writer, writers, patients, rows, start, finished, done))
+                 for writer in range(writers)]
+    for process in processes:
+        process.start()
+    time.sleep(0.5)  # Let every writer reach the start line
+    started = time.monotonic()
+    start.set()
+    last = max(finished.get() for _ in processes)
+    done.set()
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            raise RuntimeError(f"writer exited with code {process.exitcode}")
+    return writers * rows / (last - started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure write throughput against the number of shards.")
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--strategy', choices=STRATEGIES, default='hash')
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--rows', type=int, default=500, help="committed rows per writer")
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--years', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        patients_csv, observations_csv = generate(os.path.join(tmp, 'data'), args.patients, args.years)
+        results = []
+        for shards in args.shards:
+            db_name = os.path.join(tmp, f'shards{shards}.db')
+            # Range shards split the patients evenly
+            init_db(db_name, patients_csv, observations_csv, shards=shards, strategy=args.strategy,
+                    range_size=-(-(args.patients + 1) // shards))
+            close_all_pools()
+            rate = measure_writes(db_name, args.writers, args.patients, args.rows)
+            results.append((shards, rate))
+            print(f"{shards} shard(s): {rate:,.0f} rows/sec ({args.writers} writers x {args.rows} commits)")
+
+        base = results[0][1]
+        print()
+        for shards, rate in results:
+            print(f"  {shards} shard(s): {rate / base:.2f}x")
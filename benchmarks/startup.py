@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Cold-start benchmark: imports the data-access layer alone (what batch jobs and
+# CLI tools load) and the full server module in fresh interpreters, and reports
+# the median import time of each. The run fails if the data-access layer pulls
+# in any of the server's heavy dependencies, e.g.
+#
+#   python benchmarks/startup.py --repeat 20
+
+HEAVY_MODULES = ('flask', 'fhir.resources', 'numpy', 'pyarrow')
+
+# Each target runs in `python -c`; it prints the import time and the heavy modules loaded
+_PROBE = '''
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{'ms': seconds * 1000.0,
+                  'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+TARGETS = [
+    ('data access (sleep_db)', 'import sleep_db'),
+    ('server (fhir-sleepdata.py)', '''
+import importlib.util
+spec = importlib.util.spec_from_file_location('fhir_sleepdata', {app!r})
+module = importlib.util.module_from_spec(spec)
+sys.modules['fhir_sleepdata'] = module
+spec.loader.exec_module(module)
+'''.strip()),
+]
+
+
+def measure_import(statement, repeat):
+    # Import times in milliseconds over `repeat` fresh interpreters, and the heavy modules loaded
+    code = _PROBE.format(root=ROOT, heavy=HEAVY_MODULES,
+                         statement=statement.format(app=os.path.join(ROOT, 'fhir-sleepdata.py')))
+    timings = []
+    heavy = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        timings.append(sample['ms'])
+        heavy = sample['heavy']
+    return timings, heavy
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the import time of the data-access layer and the server.")
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    medians = {}
+    failed = False
+    for name, statement in TARGETS:
+        timings, heavy = measure_import(statement, args.repeat)
+        medians[name] = statistics.median(timings)
+        print(f"{name}: {medians[name]:.1f} ms median (min {min(timings):.1f} ms, {args.repeat} runs); "
+              f"loads {', '.join(heavy) or 'no heavy modules'}")
+        if name.startswith('data access') and heavy:
+            print(f"  {name} must not import {', '.join(heavy)}")
+            failed = True
+
+    data_access, server = (medians[name] for name, _ in TARGETS)
+    print(f"\nThe data-access layer starts {server / data_access:.1f}x faster than the server.")
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,156 @@
+import argparse
+import gzip
+import json
+import os
+import zlib
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from db_pool import connection, get_pool
+from fhir_fast import ObservationBundleSerializer, patient_resource
+from shards import fan_out_iter
+
+
+# FHIR Bulk Data style export: every Patient and Observation as NDJSON, read
+# through a streaming cursor so memory use does not grow with the table size.
+# A sharded database is read and serialized by one thread per shard, and the
+# chunks are interleaved as they are ready.
+
+EXPORT_TYPES = ('Patient', 'Observation')
+
+# NDJSON lines are buffered into chunks of roughly this many bytes before being yielded
+CHUNK_BYTES = 64 * 1024
+
+_observation_serializer = ObservationBundleSerializer(coded=True)
+
+_QUERIES = {
+    'Patient': "SELECT * FROM Patients{} ORDER BY Patient_ID",
+    'Observation': "SELECT * FROM sleep_observations{} ORDER BY patient_id, observation_date",
+}
+_TABLES = {'Patient': 'Patients', 'Observation': 'sleep_observations'}
+
+
+def parse_since(value):
+    # FHIR instant -> the UTC 'YYYY-MM-DD HH:MM:SS' format of the updated_at columns
+    try:
+        since = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError('Invalid _since: {}'.format(value))
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def parse_types(value):
+    if not value:
+        return EXPORT_TYPES
+    types = tuple(t.strip() for t in value.split(',') if t.strip())
+    unknown = [t for t in types if t not in EXPORT_TYPES]
+    if unknown:
+        raise ValueError('Unsupported _type: {}'.format(', '.join(unknown)))
+    return types
+
+
+def _observation_resource(obs):
+    resource = dict(_observation_serializer.observation(obs))
+    resource['id'] = '{}-{}'.format(obs[0], obs[10])
+    resource['effectiveDateTime'] = obs[10]
+    return resource
+
+
+def _json_default(obj):
+    # Emit FHIR decimals as JSON numbers rather than strings
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() and obj.as_tuple().exponent >= 0 else float(obj)
+    return str(obj)
+
+
+def require_change_tracking(db_name, types):
+    # _since filters on the updated_at columns, which older databases may lack
+    with connection(db_name) as conn:
+        for resource_type in types:
+            columns = [info[1] for info in conn.execute("PRAGMA table_info({})".format(_TABLES[resource_type]))]
+            if 'updated_at' not in columns:
+                raise ValueError('_since requires the updated_at column on {}'.format(_TABLES[resource_type]))
+
+
+def iter_resources(db_name, resource_type, since=None):
+    # Yields resource dicts; `since` is a value returned by parse_since
+    if since is not None:
+        require_change_tracking(db_name, [resource_type])
+    return fan_out_iter(db_name, _shard_resources, resource_type, since)
+
+
+def _shard_resources(shard, resource_type, since):
+    build = patient_resource if resource_type == 'Patient' else _observation_resource
+    pool = get_pool(shard)
+    # The generator can outlive the request that started it, so it borrows its
+    # own connection instead of the request-scoped one
+    conn = pool.acquire()
+    try:
+        where, params = '', ()
+        if since is not None:
+            where, params = ' WHERE updated_at >= ?', (since,)
+
+        cursor = conn.execute(_QUERIES[resource_type].format(where), params)
+        for row in cursor:
+            yield build(row)
+    finally:
+        pool.release(conn)
+
+
+def iter_ndjson(db_name, resource_type, since=None):
+    # Yields NDJSON bytes in chunks of about CHUNK_BYTES
+    if since is not None:
+        require_change_tracking(db_name, [resource_type])
+    return fan_out_iter(db_name, _shard_ndjson, resource_type, since)
+
+
+def _shard_ndjson(shard, resource_type, since):
+    buffer, size = [], 0
+    for resource in _shard_resources(shard, resource_type, since):
+        line = json.dumps(resource, separators=(',', ':'), default=_json_default) + '\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            yield ''.join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 -> gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_to_files(db_name, out_dir, types=EXPORT_TYPES, since=None, compress=False):
+    # Writes <type>.ndjson (or .ndjson.gz) per resource type and returns the file names
+    os.makedirs(out_dir, exist_ok=True)
+    filenames = []
+    for resource_type in types:
+        filename = os.path.join(out_dir, resource_type + ('.ndjson.gz' if compress else '.ndjson'))
+        opener = gzip.open if compress else open
+        with opener(filename, 'wb') as f:
+            for chunk in iter_ndjson(db_name, resource_type, since):
+                f.write(chunk)
+        filenames.append(filename)
+    return filenames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Patients and Observations as FHIR NDJSON.")
+    parser.add_argument('db_name')
+    parser.add_argument('out_dir')
+    parser.add_argument('--type', default=None, help="comma separated resource types (default: all)")
+    parser.add_argument('--since', default=None, help="only export rows changed at or after this instant")
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+
+    since = parse_since(args.since) if args.since else None
+    for filename in export_to_files(args.db_name, args.out_dir, parse_types(args.type), since, args.gzip):
+        print(f"Exported '{filename}'.")
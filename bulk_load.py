@@ -0,0 +1,182 @@
+import argparse
+import csv
+import itertools
+import sqlite3
+import time
+
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# PRAGMAs applied for the duration of a bulk load. The load runs in a single
+# transaction and can simply be re-run from the CSV, so durability is traded for speed.
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # negative value is in KiB, i.e. 256 MiB
+    'temp_store': 'MEMORY',
+}
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def _apply_pragmas(conn, pragmas):
+    # Returns the previous values so they can be restored once the load is done
+    previous = {}
+    for name, value in pragmas.items():
+        current = conn.execute("PRAGMA {}".format(name)).fetchone()[0]
+        if name == 'journal_mode' and str(current).lower() == 'wal':
+            # Leaving WAL needs exclusive access, which pooled readers would block
+            continue
+        previous[name] = current
+        conn.execute("PRAGMA {} = {}".format(name, value))
+    return previous
+
+
+def _drop_indexes(conn, table):
+    # Automatic indexes (PRIMARY KEY / UNIQUE) have no SQL and cannot be dropped
+    indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table,)).fetchall()
+    for name, _ in indexes:
+        conn.execute("DROP INDEX {}".format(_quote(name)))
+    return [sql for _, sql in indexes]
+
+
+class _RejectWriter:
+    # Opens the reject file lazily so clean loads do not leave empty files behind
+
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = header
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, row, error):
+        if self._file is None:
+            self._file = open(self.filename, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(list(self.header) + ['error'])
+        self._writer.writerow(list(row) + [error])
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def bulk_load_csv(db_name, csv_filename, table, columns=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                  pragmas=None, rebuild_indexes=False, reject_filename=None, progress=None):
+    """Stream a CSV file (with a header row) into an existing table.
+
+    Rows are read in chunks of ``chunk_size`` and inserted with ``executemany``
+    inside one transaction. A chunk that fails is replayed row by row so that only
+    the offending rows are written to ``reject_filename`` instead of aborting the load.
+    ``progress`` is called as ``progress(rows_loaded, rows_rejected)`` after each chunk.
+
+    Returns a dict with the loaded/rejected row counts, elapsed seconds and rows/sec.
+    """
+    if pragmas is None:
+        pragmas = BULK_LOAD_PRAGMAS
+    if reject_filename is None:
+        reject_filename = csv_filename + '.rejects.csv'
+
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    if columns is None:
+        columns = [info[1] for info in conn.execute("PRAGMA table_info({})".format(_quote(table)))]
+    query = "INSERT INTO {} ({}) VALUES ({})".format(
+        _quote(table), ', '.join(_quote(c) for c in columns), ', '.join('?' * len(columns)))
+
+    loaded = 0
+    start = time.perf_counter()
+    previous_pragmas = _apply_pragmas(conn, pragmas)
+
+    with open(csv_filename, 'r', newline='') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header = next(csv_reader)  # Skip the header row
+        rejects = _RejectWriter(reject_filename, header)
+
+        try:
+            conn.execute("BEGIN")
+            index_sql = _drop_indexes(conn, table) if rebuild_indexes else []
+
+            while True:
+                chunk = list(itertools.islice(csv_reader, chunk_size))
+                if not chunk:
+                    break
+
+                rows = []
+                for row in chunk:
+                    if len(row) == len(columns):
+                        rows.append(row)
+                    else:
+                        rejects.write(row, 'expected {} fields, got {}'.format(len(columns), len(row)))
+
+                conn.execute("SAVEPOINT bulk_chunk")
+                try:
+                    conn.executemany(query, rows)
+                    loaded += len(rows)
+                except sqlite3.Error:
+                    # Replay the chunk one row at a time to isolate the bad rows
+                    conn.execute("ROLLBACK TO bulk_chunk")
+                    for row in rows:
+                        try:
+                            conn.execute(query, row)
+                            loaded += 1
+                        except sqlite3.Error as e:
+                            rejects.write(row, str(e))
+                conn.execute("RELEASE bulk_chunk")
+
+                if progress is not None:
+                    progress(loaded, rejects.count)
+
+            for sql in index_sql:
+                conn.execute(sql)
+
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            rejects.close()
+            _apply_pragmas(conn, previous_pragmas)
+            conn.close()
+
+    elapsed = time.perf_counter() - start
+    rows_per_sec = loaded / elapsed if elapsed > 0 else float(loaded)
+
+    print(f"Loaded {loaded} rows into '{table}' in {elapsed:.2f}s ({rows_per_sec:,.0f} rows/sec).")
+    if rejects.count:
+        print(f"{rejects.count} rejected rows written to '{reject_filename}'.")
+
+    return {
+        'rows': loaded,
+        'rejected': rejects.count,
+        'seconds': elapsed,
+        'rows_per_sec': rows_per_sec,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load a CSV file into an existing SQLite table.")
+    parser.add_argument('db_name')
+    parser.add_argument('csv_filename')
+    parser.add_argument('table')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--rebuild-indexes', action='store_true',
+                        help="drop the table's indexes before the load and recreate them afterwards")
+    parser.add_argument('--reject-file', default=None)
+    parser.add_argument('--journal-mode', default=BULK_LOAD_PRAGMAS['journal_mode'])
+    parser.add_argument('--synchronous', default=BULK_LOAD_PRAGMAS['synchronous'])
+    parser.add_argument('--cache-size', type=int, default=BULK_LOAD_PRAGMAS['cache_size'])
+    args = parser.parse_args()
+
+    pragmas = dict(BULK_LOAD_PRAGMAS, journal_mode=args.journal_mode,
+                   synchronous=args.synchronous, cache_size=args.cache_size)
+    bulk_load_csv(args.db_name, args.csv_filename, args.table, chunk_size=args.chunk_size,
+                  pragmas=pragmas, rebuild_indexes=args.rebuild_indexes,
+                  reject_filename=args.reject_file,
+                  progress=lambda rows, rejected: print(f"  {rows} rows loaded, {rejected} rejected"))
@@ -0,0 +1,149 @@
+import argparse
+from datetime import date
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from db_pool import connection
+from fhir_import import iter_resources
+from fhir_ingest import VITAL_COLUMNS, EntryError, _COLUMN_BY_TEXT, _patient_id_from_reference, observation_to_row
+from shards import fan_out_iter
+from terminology import terminology
+
+
+# FHIR -> columnar conversion. Observations from the sleep_observations table or
+# from FHIR Bundle / NDJSON files are written as an Arrow dataset partitioned by
+# patient and month (patient_id=<id>/month=YYYY-MM/), one typed column per
+# LOINC-coded component. Input is consumed in record batches so memory stays
+# bounded, and the "arrow" format writes uncompressed IPC files that consumers
+# can memory-map without copying.
+
+DEFAULT_BATCH_SIZE = 65536
+
+_EPOCH = date(1970, 1, 1)
+
+_LOINC_BY_COLUMN = {column: terminology.code(text) or '' for text, column in _COLUMN_BY_TEXT.items()}
+
+SCHEMA = pa.schema(
+    [pa.field('patient_id', pa.int64(), nullable=False),
+     pa.field('observation_date', pa.date32(), nullable=False),
+     pa.field('month', pa.string(), nullable=False)] +
+    [pa.field(column, pa.float64(), metadata={'loinc': _LOINC_BY_COLUMN[column]}) for column in VITAL_COLUMNS]
+)
+
+PARTITIONING = ds.partitioning(pa.schema([SCHEMA.field('patient_id'), SCHEMA.field('month')]), flavor='hive')
+
+
+def _record_batch(rows):
+    # rows are (patient_id, epoch day, month, vitals...) tuples
+    columns = list(zip(*rows))
+    arrays = [pa.array(columns[0], pa.int64()),
+              pa.array(columns[1], pa.int32()).cast(pa.date32()),
+              pa.array(columns[2], pa.string())]
+    arrays += [pa.array(values, pa.float64()) for values in columns[3:]]
+    return pa.RecordBatch.from_arrays(arrays, schema=SCHEMA)
+
+
+def table_batches(db_name, batch_size=DEFAULT_BATCH_SIZE):
+    # Streams the sleep_observations table as record batches, the shards of a sharded database in parallel
+    return fan_out_iter(db_name, _shard_batches, batch_size)
+
+
+def _shard_batches(shard, batch_size):
+    # Text that SQLite could not convert to a number (e.g. '') is exported as null
+    query = '''
+        SELECT patient_id, CAST(julianday(observation_date) - 2440587.5 AS INTEGER),
+               substr(observation_date, 1, 7), {}
+        FROM sleep_observations
+        WHERE julianday(observation_date) IS NOT NULL
+        ORDER BY patient_id, observation_date
+    '''.format(', '.join("CASE WHEN typeof({0}) IN ('integer', 'real') THEN {0} END".format(column)
+                          for column in VITAL_COLUMNS))
+    with connection(shard) as conn:
+        cursor = conn.execute(query)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield _record_batch(rows)
+
+
+def bundle_batches(paths, batch_size=DEFAULT_BATCH_SIZE, skipped=None):
+    # Streams Observations from FHIR Bundle / NDJSON files, optionally gzipped, as
+    # record batches; files are parsed incrementally as by fhir_import.py.
+    # Observations that cannot be mapped (e.g. no effectiveDateTime or
+    # "Observation Date" component) are counted in skipped['count'] when a dict is passed.
+    rows = []
+    for path in paths:
+        for resource, _ in iter_resources(path):
+            if not isinstance(resource, dict) or resource.get('resourceType') != 'Observation':
+                continue
+            try:
+                reference, values = observation_to_row(resource)
+                patient_id = _patient_id_from_reference(reference)
+            except EntryError:
+                if skipped is not None:
+                    skipped['count'] = skipped.get('count', 0) + 1
+                continue
+            observation_date = values['observation_date']
+            day = (date.fromisoformat(observation_date) - _EPOCH).days
+            rows.append((patient_id, day, observation_date[:7]) + tuple(values.get(c) for c in VITAL_COLUMNS))
+            if len(rows) >= batch_size:
+                yield _record_batch(rows)
+                rows = []
+    if rows:
+        yield _record_batch(rows)
+
+
+def write_dataset(batches, base_dir, format='parquet', max_rows_per_file=1000000, batch_size=DEFAULT_BATCH_SIZE):
+    # Writes record batches of at most `batch_size` rows as a hive-partitioned
+    # dataset under base_dir. A batch spans up to one partition per row (e.g.
+    # 65536 rows of a few thousand patient months), far past pyarrow's default
+    # limit of 1024, so the limit is the batch size.
+    if format == 'parquet':
+        file_format = ds.ParquetFileFormat()
+        file_options = file_format.make_write_options(compression='zstd')
+    elif format == 'arrow':
+        # Uncompressed IPC so readers can memory-map the buffers directly
+        file_format = ds.IpcFileFormat()
+        file_options = file_format.make_write_options(compression=None)
+    else:
+        raise ValueError('Unsupported format: {}'.format(format))
+
+    ds.write_dataset(batches, base_dir, schema=SCHEMA, format=file_format, file_options=file_options,
+                     partitioning=PARTITIONING, existing_data_behavior='overwrite_or_ignore',
+                     max_rows_per_file=max_rows_per_file, max_rows_per_group=min(max_rows_per_file, 1 << 20),
+                     max_partitions=max(batch_size, 1024))
+
+
+def open_dataset(base_dir, format='parquet'):
+    # Lazily opened dataset; filter with e.g. ds.field('patient_id') == 1
+    return ds.dataset(base_dir, format='ipc' if format == 'arrow' else 'parquet', partitioning=PARTITIONING)
+
+
+def read_arrow_file(path):
+    # Zero-copy read of one IPC file: the returned table's buffers point into the mapping
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert sleep observations to a partitioned Parquet/Arrow dataset.")
+    parser.add_argument('out_dir')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--db', help="read the sleep_observations table of this database")
+    source.add_argument('--fhir', nargs='+', help="read Observations from FHIR Bundle .json or .ndjson files, optionally .gz")
+    parser.add_argument('--format', choices=('parquet', 'arrow'), default='parquet')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    skipped = {}
+    if args.db:
+        batches = table_batches(args.db, args.batch_size)
+    else:
+        batches = bundle_batches(args.fhir, args.batch_size, skipped)
+    write_dataset(batches, args.out_dir, args.format, batch_size=args.batch_size)
+
+    print(f"Wrote {open_dataset(args.out_dir, args.format).count_rows()} observations to '{args.out_dir}'.")
+    if skipped:
+        print(f"Skipped {skipped['count']} observations without a usable date or subject.")
@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+# Number of idle connections kept per database file
+DEFAULT_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", 8))
+# Size of each connection's prepared-statement cache (sqlite3 default is 128)
+DEFAULT_CACHED_STATEMENTS = int(os.environ.get("SQLITE_CACHED_STATEMENTS", 256))
+# Milliseconds a connection waits on a locked database before raising
+DEFAULT_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+
+
+class ConnectionPool:
+    # Keeps up to `size` idle connections to one SQLite file and hands them out
+    # again instead of reconnecting (and re-parsing the schema) on every request.
+
+    def __init__(self, db_name, size=DEFAULT_POOL_SIZE, cached_statements=DEFAULT_CACHED_STATEMENTS,
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        self.db_name = db_name
+        self.size = size
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def _connect(self):
+        # Connections move between threads over their lifetime, but are only
+        # ever used by one thread at a time
+        conn = sqlite3.connect(self.db_name, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA busy_timeout = {}".format(int(self.busy_timeout)))
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                break
+            if self._is_healthy(conn):
+                with self._lock:
+                    self.hits += 1
+                return conn
+            self._discard(conn)
+
+        conn = self._connect()
+        with self._lock:
+            self.misses += 1
+        return conn
+
+    def release(self, conn):
+        try:
+            # Never hand out a connection with someone else's open transaction
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self.discarded += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'hits': self.hits,
+                'misses': self.misses,
+                'discarded': self.discarded,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pool_options = {}
+_flask_scoped = False
+
+
+def configure(**options):
+    # Sets the ConnectionPool options (size, cached_statements, busy_timeout) used
+    # for pools created from now on
+    _pool_options.update(options)
+
+
+def get_pool(db_name):
+    pool = _pools.get(db_name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_name)
+            if pool is None:
+                pool = _pools[db_name] = ConnectionPool(db_name, **_pool_options)
+    return pool
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {db_name: pool.stats() for db_name, pool in pools}
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _request_connections():
+    # Connections borrowed during the current Flask app context, keyed by db_name
+    if not _flask_scoped:
+        return None
+    from flask import g, has_app_context
+    if not has_app_context():
+        return None
+    if 'sqlite_connections' not in g:
+        g.sqlite_connections = {}
+    return g.sqlite_connections
+
+
+@contextmanager
+def connection(db_name):
+    # Inside a Flask app context the connection is reused for the rest of the
+    # request and returned to the pool on teardown; otherwise it goes straight back.
+    scoped = _request_connections()
+    if scoped is not None:
+        conn = scoped.get(db_name)
+        if conn is None:
+            conn = scoped[db_name] = get_pool(db_name).acquire()
+        yield conn
+        return
+
+    pool = get_pool(db_name)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def release_request_connections(exception=None):
+    from flask import g
+    connections = g.pop('sqlite_connections', None)
+    if connections:
+        for db_name, conn in connections.items():
+            get_pool(db_name).release(conn)
+
+
+def init_app(app):
+    global _flask_scoped
+    _flask_scoped = True
+    app.teardown_appcontext(release_request_connections)
@@ -1,133 +1,105 @@
 from flask import Flask, request, jsonify
 import os
-import csv
 import json
 import sqlite3
-from fhir.resources.patient import Patient
-from fhir.resources.reference import Reference
-from fhir.resources.coding import Coding
-from fhir.resources.observation import Observation,ObservationComponent
-from fhir.resources.identifier import Identifier
-from fhir.resources.humanname import HumanName
-from fhir.resources.contactpoint import ContactPoint
-from fhir.resources.address import Address
-from fhir.resources.codeableconcept import CodeableConcept
-from fhir.resources.quantity import Quantity
-from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryRequest
 from datetime import date
 from decimal import Decimal
+import base64
 from flask_cors import CORS
-from flask import make_response
-
+from flask import make_response, has_request_context, url_for, Response
+from db_pool import connection, pool_stats
+from fhir_fast import ObservationBundleSerializer, patient_resource
+from bulk_export import gzip_chunks, iter_ndjson, parse_since, parse_types, require_change_tracking
+from fhir_ingest import BundleError, process_bundle
+from response_cache import ResponseCache
+from instrumentation import get_logger, log_event, record_rows, span
+from write_queue import QueueFull, WriteBehindQueue, observation_row
+from patient_search import NAME_COLUMNS, search_patients
+from rollups import PERIODS as ROLLUP_PERIODS, cohort_rollups, patient_rollups
+from shards import DEFAULT_RANGE_SIZE, STRATEGIES, ShardConnections, allocate_patient_ids, patient_version, shard_for
+from sleep_db import (count_records, init_db, read_observation_dates, read_observations_page, read_patient_data,
+                      read_patient_everything, read_patient_names, read_patient_sleep_data_page, read_patients)
+import db_pool
+import instrumentation
+import logging
+import atexit
+import argparse
+
+# The fhir.resources models, fhir_builders and the NumPy analytics are imported
+# by the routes that use them, so the first request on a route pays for them
+# rather than every process start.
 
 
 db_name = "sleep_data.db"
+credentials_db_name = "credentials.db"
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})  # Enable CORS for all routes and all origins
+db_pool.init_app(app)  # Reuse pooled SQLite connections within a request and release them on teardown
+instrumentation.init_app(app)  # Latency histograms and stage spans for /metrics; ?_profile=1 with PROFILING_ENABLED
+logger = get_logger('fhir_sleepdata')
+app.config.setdefault('FHIR_FAST_SERIALIZATION', False)  # Build observation Bundles as plain dicts by default
+app.config.setdefault('FHIR_DEFAULT_COUNT', 100)  # Page size when a search has no _count
+app.config.setdefault('FHIR_MAX_COUNT', 1000)  # Upper bound for _count
+app.config.setdefault('FHIR_MAX_BATCH_IDS', 1000)  # Patients one Patient?_id= or Observation?subject= search may name
+app.config.setdefault('PATIENT_SEARCH_DEFAULT_LIMIT', 20)  # Typeahead results per page
+app.config.setdefault('PATIENT_SEARCH_MAX_LIMIT', 100)
+app.config.setdefault('RESPONSE_CACHE_MAX_BYTES', int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+app.config.setdefault('RESPONSE_CACHE_TTL', int(os.environ.get('RESPONSE_CACHE_TTL', 300)))  # Seconds
+# Entries are checked against the patient's write counter on every hit, so writes
+# by other workers and by the CLI tools (fhir_import.py, rollups.py) are seen too
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_MAX_BYTES'], app.config['RESPONSE_CACHE_TTL'],
+                               validator=lambda patient_id, resource_type: patient_version(db_name, patient_id))
+
+def invalidate_observation_cache(patient_id):
+    # Drops the cached observation Bundles and date list of one patient
+    try:
+        patient_id = int(patient_id)
+    except (TypeError, ValueError):
+        return
+    response_cache.invalidate_patient(patient_id, ('Observation', 'dates'))
+
+# Write-behind queue for /fhir/insert_sleep_data: accepted rows are journaled and
+# group-committed by a writer thread, and the route answers 202
+app.config.setdefault('WRITE_BEHIND_ENABLED', os.environ.get('WRITE_BEHIND_ENABLED', '1').lower() in ('1', 'true'))
+app.config.setdefault('WRITE_BEHIND_JOURNAL', os.environ.get('WRITE_BEHIND_JOURNAL', db_name + '-writeq'))
+app.config.setdefault('WRITE_BEHIND_MAX_BATCH', int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 500)))
+app.config.setdefault('WRITE_BEHIND_MAX_DELAY', float(os.environ.get('WRITE_BEHIND_MAX_DELAY', 0.05)))  # Seconds
+app.config.setdefault('WRITE_BEHIND_MAX_PENDING', int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 10000)))
+app.config.setdefault('WRITE_BEHIND_SUBMIT_TIMEOUT', float(os.environ.get('WRITE_BEHIND_SUBMIT_TIMEOUT', 1.0)))  # Seconds
+
+def invalidate_committed_observations(rows):
+    for patient_id in {row[0] for row in rows}:
+        invalidate_observation_cache(patient_id)
+
+write_queue = WriteBehindQueue(db_name, app.config['WRITE_BEHIND_JOURNAL'],
+                               max_batch=app.config['WRITE_BEHIND_MAX_BATCH'],
+                               max_delay=app.config['WRITE_BEHIND_MAX_DELAY'],
+                               max_pending=app.config['WRITE_BEHIND_MAX_PENDING'],
+                               on_commit=invalidate_committed_observations)
+app.extensions['write_queue'] = write_queue
+atexit.register(write_queue.close)  # Flush on shutdown
 
 
-# Function to create the Patients table from a CSV file
-def create_table_from_csv(db_name, csv_filename):
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute('''CREATE TABLE IF NOT EXISTS Patients (
-        Patient_ID INTEGER PRIMARY KEY,
-        First_Name TEXT,
-        Last_Name TEXT,
-        Date_of_Birth DATE,
-        Gender TEXT,
-        Phone_Number TEXT,
-        Email TEXT,
-        Address TEXT,
-        City TEXT,
-        State TEXT,
-        Zip_Code TEXT
-    )''')
-
-    with open(csv_filename, "r") as csv_file:
-        csv_reader = csv.reader(csv_file)
-        next(csv_reader)  # Skip the header row
-        for row in csv_reader:
-            cursor.execute("INSERT INTO Patients VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
-
-    conn.commit()
-    conn.close()
-
-    print(f"Table 'Patients' has been created and populated with data from '{csv_filename}'.")
-
-def create_sleep_observations_table(db_name, csv_filename):
-    # Connect to SQLite database (creates a new database if it doesn't exist)
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    # Create sleep_observations table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sleep_observations (
-            patient_id INTEGER,
-            snoring_rate REAL,
-            respiratory_rate REAL,
-            body_temperature REAL,
-            limb_movement REAL,
-            blood_oxygen REAL,
-            eye_movement REAL,
-            sleeping_hours REAL,
-            heart_rate INTEGER,
-            stress_level INTEGER,
-            observation_date TEXT,
-            PRIMARY KEY (patient_id, observation_date)
-        )
-    ''')
-
-    with open(csv_filename, 'r') as csvfile:
-            csvreader = csv.reader(csvfile)
-            next(csvreader) 
-
-            for row in csvreader:
-                cursor.execute('''
-                INSERT INTO sleep_observations (
-                    patient_id, snoring_rate, respiratory_rate, body_temperature,
-                    limb_movement, blood_oxygen, eye_movement, sleeping_hours,
-                    heart_rate, stress_level, observation_date
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', row)
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
-
-    print(f"Table 'sleep_observations' has been created and populated with data from '{csv_filename}'.")
-
-# Function to read patient data based on Patient_ID
-def read_patient_data(db_name, patient_id):
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM Patients WHERE Patient_ID = ?", (patient_id,))
-    patient_data = cursor.fetchone()
-
-    conn.close()
-
-    return patient_data
-
 def get_records_count(table_name):
-    with sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM {}".format(table_name))
-        count = cursor.fetchone()[0]
-        return count
+    # Summed over every shard
+    return count_records(db_name, table_name)
 
 def insert_new_patient(cursor, patient_data):
-    with sqlite3.connect(db_name) as conn:
+    # A sharded database hands out the Patient_ID before the shard is known;
+    # a single file leaves it NULL for SQLite to assign
+    patient_id = allocate_patient_ids(db_name)
+    with connection(shard_for(db_name, patient_id)) as conn:
         try:
             cursor = conn.cursor()
             
             query = '''
                 INSERT INTO Patients 
-                (First_Name, Last_Name, Date_of_Birth, Gender, Phone_Number, Email, Address, City, State, Zip_Code)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                (Patient_ID, First_Name, Last_Name, Date_of_Birth, Gender, Phone_Number, Email, Address, City, State, Zip_Code)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             '''
 
             values = (
+                patient_id,
                 patient_data['First_Name'],
                 patient_data['Last_Name'],
                 patient_data['Date_of_Birth'],
@@ -141,38 +113,20 @@ def insert_new_patient(cursor, patient_data):
             )
 
             cursor.execute(query, values)
-
-            complete_insert_statement = query.replace('?', '{}').format(*values)
-            print(complete_insert_statement)            
+            log_event(logger, logging.DEBUG, 'insert_statement', table='Patients', values=values)
 
             # Commit changes, no need to close the connection explicitly
             conn.commit()
-            print("Data inserted into sleep_observation table.\n")
-            print(patient_data)
+            response_cache.invalidate_resource('names')
+            log_event(logger, logging.INFO, 'patient_inserted', table='Patients', patient_id=cursor.lastrowid)
 
         except sqlite3.Error as e:
-            print(f"Error inserting data: {e}")
-
-
-def read_patient_sleep_data(db_name, patient_id):
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(f""" SELECT  * 
-                        FROM     (
-                            SELECT  *, ROW_NUMBER () OVER (ORDER BY observation_date) AS obs_desc_rnk 
-                            FROM  sleep_observations a WHERE  patient_id = ?
-                        )a 
-                        WHERE body_temperature is not null""", (patient_id,))
-    patient_obs_data = cursor.fetchall()
-
-    conn.close()
-    # Correct
-    return patient_obs_data
+            conn.rollback()
+            log_event(logger, logging.ERROR, 'insert_failed', table='Patients', error=str(e))
 
 
 def insert_sleep_data(db_name, data_dict):
-    with sqlite3.connect(db_name) as conn:
+    with connection(shard_for(db_name, data_dict['patient_id'])) as conn:
         try:
             cursor = conn.cursor()
             query = '''
@@ -193,33 +147,34 @@ def insert_sleep_data(db_name, data_dict):
             )
             
             cursor.execute(query, values)
-
-            complete_insert_statement = query.replace('?', '{}').format(*values)
-            print(complete_insert_statement)            
+            log_event(logger, logging.DEBUG, 'insert_statement', table='sleep_observations', values=values)
 
             # Commit changes, no need to close the connection explicitly
             conn.commit()
-            print("Data inserted into sleep_observation table.\n")
-            print(data_dict)
+            invalidate_observation_cache(data_dict['patient_id'])
+            log_event(logger, logging.INFO, 'observation_inserted', table='sleep_observations',
+                      patient_id=data_dict['patient_id'], observation_date=data_dict['observation_date'])
 
         except sqlite3.Error as e:
-            print(f"Error inserting data: {e}")
+            conn.rollback()
+            log_event(logger, logging.ERROR, 'insert_failed', table='sleep_observations',
+                      patient_id=data_dict['patient_id'], observation_date=data_dict['observation_date'], error=str(e))
 
 def delete_observation_data(db_name, patient_id, observation_date):
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
+    with connection(shard_for(db_name, patient_id)) as conn:
+        cursor = conn.cursor()
 
-    # Delete data from the sleep_observations table based on patient_id and observation_date
-    cursor.execute('''
-        DELETE FROM sleep_observations
-        WHERE patient_id = ? AND observation_date = ?
-    ''', (patient_id, observation_date))
+        # Delete data from the sleep_observations table based on patient_id and observation_date
+        cursor.execute('''
+            DELETE FROM sleep_observations
+            WHERE patient_id = ? AND observation_date = ?
+        ''', (patient_id, observation_date))
 
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
+        conn.commit()
+    invalidate_observation_cache(patient_id)
 
-    print('Observation data deleted.')
+    log_event(logger, logging.INFO, 'observation_deleted', table='sleep_observations',
+              patient_id=patient_id, observation_date=observation_date)
 
 @app.route('/fhir/add_new_patient', methods=['POST'])
 def api_add_new_patient():
@@ -247,12 +202,44 @@ def api_insert_sleep_data():
         if not all(field in data for field in required_fields):
             return jsonify({'error': 'Missing required fields'}), 400
 
+        if app.config['WRITE_BEHIND_ENABLED']:
+            try:
+                row = observation_row(data)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            try:
+                sequence = write_queue.submit(row, timeout=app.config['WRITE_BEHIND_SUBMIT_TIMEOUT'])
+            except QueueFull:
+                response = jsonify({'error': 'Write queue is full, retry later'})
+                response.headers['Retry-After'] = '1'
+                return response, 503
+            return jsonify({'accepted': True, 'sequence': sequence}), 202
+
         insert_sleep_data(db_name, data)
 
         return jsonify({'success': True}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Batch / transaction Bundle of Patients and Observations, written in one transaction per shard
+@app.route('/fhir', methods=['POST'])
+def api_process_bundle():
+    data = request.get_json(silent=True)
+    try:
+        with ShardConnections(db_name) as shards:
+            response_bundle = process_bundle(shards, data)
+    except BundleError as e:
+        return jsonify(e.outcome()), e.status
+
+    for entry in response_bundle['entry']:
+        location = entry['response'].get('location', '')
+        if location.startswith('Observation/'):
+            invalidate_observation_cache(location[len('Observation/'):].split('-', 1)[0])
+        elif location.startswith('Patient/'):
+            response_cache.invalidate_patient(int(location[len('Patient/'):]))
+            response_cache.invalidate_resource('names')
+    return jsonify(response_bundle), 200
+
 @app.route('/fhir/delete_patient_obs', methods=['POST'])
 def delete_observation_fhir():
     try:
@@ -277,139 +264,239 @@ class CustomEncoder(json.JSONEncoder):
 
 # API route to get patient data by Patient_ID in FHIR format
 @app.route('/fhir/patient/<int:patient_id>', methods=['GET'])
+@response_cache.cached('Patient')
 def get_patient_data_fhir(patient_id):
     
-    patient_data = read_patient_data(db_name, patient_id)
+    with span('db_fetch'):
+        patient_data = read_patient_data(db_name, patient_id)
+    record_rows(1 if patient_data else 0)
 
     if patient_data:
-        patient = Patient()
-        patient.id = str(patient_data[0])
-        patient.identifier = [Identifier(use="official", value=str(patient_data[0]))]
-        patient.name = [HumanName(use="official", given=[patient_data[1]], family=patient_data[2])]
-        patient.birthDate = str(patient_data[3])
-        patient.gender = patient_data[4]
-        patient.telecom = [ContactPoint(system="phone", value=patient_data[5])]
-        patient.telecom.append(ContactPoint(system="email", value=patient_data[6]))
-        patient.address = [Address(use="home", line=[patient_data[7]], city=patient_data[8], state=patient_data[9], postalCode=patient_data[10])]
-
-        return patient.dict()
+        patient = build_patient(patient_data)
+
+        with span('serialize'):
+            return patient.dict()
 
     else:
         return "Patient not found", 404
 
+def build_patient(patient_data):
+    # fhir.resources Patient for one Patients row
+    from fhir.resources.address import Address
+    from fhir.resources.contactpoint import ContactPoint
+    from fhir.resources.humanname import HumanName
+    from fhir.resources.identifier import Identifier
+    from fhir.resources.patient import Patient
+
+    patient = Patient()
+    patient.id = str(patient_data[0])
+    patient.identifier = [Identifier(use="official", value=str(patient_data[0]))]
+    patient.name = [HumanName(use="official", given=[patient_data[1]], family=patient_data[2])]
+    patient.birthDate = str(patient_data[3])
+    patient.gender = patient_data[4]
+    patient.telecom = [ContactPoint(system="phone", value=patient_data[5])]
+    patient.telecom.append(ContactPoint(system="email", value=patient_data[6]))
+    patient.address = [Address(use="home", line=[patient_data[7]], city=patient_data[8], state=patient_data[9], postalCode=patient_data[10])]
+    return patient
+
+def fast_serialization_requested():
+    # ?_fast=true|false overrides the FHIR_FAST_SERIALIZATION config flag
+    flag = request.args.get('_fast') if has_request_context() else None
+    if flag is None:
+        return app.config['FHIR_FAST_SERIALIZATION']
+    return flag.lower() in ('1', 'true', 'yes')
+
+fast_serializer = ObservationBundleSerializer()
+
+DATE_PREFIXES = {'eq': '=', 'ge': '>=', 'le': '<=', 'gt': '>', 'lt': '<'}
+
+def encode_page_cursor(direction, observation_date):
+    return base64.urlsafe_b64encode(json.dumps([direction, observation_date]).encode()).decode()
+
+def cursor_page_url(cursor):
+    # This request's URL with only _cursor replaced, so _fast, patient= and the
+    # other parameters carry over to the next or previous page
+    args = request.args.to_dict(flat=False)
+    args['_cursor'] = cursor
+    return url_for(request.endpoint, _external=True, **{**args, **request.view_args})
+
+def is_iso_date(value):
+    if not isinstance(value, str):
+        return False
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+def decode_page_cursor(token, batched=False):
+    # (direction, key) from a _cursor token. The key is the observation date of
+    # the boundary row, or its [patient_id, observation_date] for the batched
+    # searches; anything else is a ValueError rather than a bad SQL parameter.
+    try:
+        direction, key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid _cursor')
+    if direction not in ('next', 'previous'):
+        raise ValueError('Invalid _cursor')
+    if batched:
+        valid = isinstance(key, list) and len(key) == 2 and type(key[0]) is int and is_iso_date(key[1])
+    else:
+        valid = is_iso_date(key)
+    if not valid:
+        raise ValueError('Invalid _cursor')
+    return direction, key
+
+def read_sleep_observations_page(patient_id):
+    # Runs the paged observation search described by the request's _count, date,
+    # _sort and _cursor parameters. Returns the rows and the Bundle.link
+    # (relation, url) pairs; raises ValueError for malformed parameters.
+    args = request.args if has_request_context() else {}
+
+    count = args.get('_count', app.config['FHIR_DEFAULT_COUNT'])
+    try:
+        count = int(count)
+    except (TypeError, ValueError):
+        raise ValueError('_count must be an integer')
+    if count < 1:
+        raise ValueError('_count must be at least 1')
+    count = min(count, app.config['FHIR_MAX_COUNT'])
+
+    date_params = args.getlist('date') if args else []
+    date_filters = []
+    for value in date_params:
+        prefix, operator = 'eq', '='
+        if value[:2] in DATE_PREFIXES:
+            prefix, operator = value[:2], DATE_PREFIXES[value[:2]]
+            value = value[2:]
+        try:
+            date.fromisoformat(value)
+        except ValueError:
+            raise ValueError('Invalid date parameter: {}{}'.format(prefix, value))
+        date_filters.append((operator, value))
+
+    sort = args.get('_sort', 'date')
+    if sort not in ('date', '-date'):
+        raise ValueError('_sort must be date or -date')
+    descending = sort == '-date'
+
+    cursor = decode_page_cursor(args['_cursor']) if '_cursor' in args else None
+
+    observations, has_more = read_patient_sleep_data_page(
+        db_name, patient_id, count, date_filters=date_filters, descending=descending, cursor=cursor)
+
+    links = []
+    if has_request_context():
+        links.append(('self', request.url))
+        backwards = cursor is not None and cursor[0] == 'previous'
+        if observations and (has_more if not backwards else True):
+            links.append(('next', cursor_page_url(encode_page_cursor('next', observations[-1][10]))))
+        if observations and (has_more if backwards else cursor is not None):
+            links.append(('previous', cursor_page_url(encode_page_cursor('previous', observations[0][10]))))
+
+    return observations, links
+
 # API route to get sleep observations by Patient_ID in FHIR format
 @app.route('/fhir/sleep-observations/<int:patient_id>', methods=['GET'])
+@response_cache.cached('Observation')
 def get_sleep_observations_fhir(patient_id):
-    observations = read_patient_sleep_data(db_name, patient_id=patient_id)
-
-    if observations:
-        bundle = Bundle(type="searchset")
-        bundle.entry = []
-
-        for obs in observations:
-            # Define the code for the Observation
-            code = CodeableConcept()
-            code.coding = [Coding(system="http://loinc.org", code="LOINC_CODE", display="Sleep Observation")]
-            code.text = "Sleep Observation"
-
-            # Initialize the Observation object with the required code
-            observation = Observation(status="final", code=code)
-            reference = Reference(reference=f"Patient/{obs[0]}")
-            observation.subject = reference        
-
-            # Add components for each attribute of the observation
-            # Make sure the indices match the order in your database
-            observation.component = [
-                ObservationComponent(code=CodeableConcept(text="Snoring Rate"), valueQuantity=Quantity(value=float(obs[1])if obs[1] else "0")),
-                ObservationComponent(code=CodeableConcept(text="Respiratory Rate"), valueQuantity=Quantity(value=float(obs[2])if obs[2] else "0")),
-                ObservationComponent(code=CodeableConcept(text="Body Temperature"), valueQuantity=Quantity(value=float(obs[3])if obs[3] else "0")),
-                ObservationComponent(code=CodeableConcept(text="Limb Movement"), valueQuantity=Quantity(value=float(obs[4])if obs[4] else "0")),
-                ObservationComponent(code=CodeableConcept(text="Blood Oxygen"), valueQuantity=Quantity(value=float(obs[5])if obs[5] else "0")),
-                ObservationComponent(code=CodeableConcept(text="Eye Movement"), valueQuantity=Quantity(value=float(obs[6])if obs[6] else "0")),
-                ObservationComponent(code=CodeableConcept(text="Sleeping Hours"), valueQuantity=Quantity(value=float(obs[7]), unit="h")),
-                ObservationComponent(code=CodeableConcept(text="Heart Rate"), valueQuantity=Quantity(value=float(obs[8])if obs[8] else "0")),
-                ObservationComponent(code=CodeableConcept(text="Stress Level"), valueString=str(obs[9])if obs[9] else "0"),
-                ObservationComponent(code=CodeableConcept(text="Observation Date"), valueString=str(obs[10])if obs[10] else "0"),
-            ]
-
-            bundle_entry = BundleEntry(resource=observation)
-            bundle.entry.append(bundle_entry)
-
-        return bundle.dict()
+    try:
+        with span('db_fetch'):
+            observations, links = read_sleep_observations_page(patient_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    record_rows(len(observations))
+
+    if observations and fast_serialization_requested():
+        with span('build'):
+            return fast_serializer.bundle(observations, links)
+    elif observations:
+        with span('build'):
+            from fhir.resources.bundle import Bundle, BundleEntry, BundleLink
+            from fhir_builders import text_observation
+
+            bundle = Bundle(type="searchset")
+            bundle.link = [BundleLink(relation=relation, url=url) for relation, url in links] or None
+            bundle.entry = []
+
+            for obs in observations:
+                observation = text_observation(obs)
+
+                bundle_entry = BundleEntry(resource=observation)
+                bundle.entry.append(bundle_entry)
+
+        with span('serialize'):
+            return bundle.dict()
     else:
         return "Patient observations not found", 404
 
-loinc_codes = {
-    'Snoring Rate': 'R06.83',
-    'Limb Movement': 'G47.6',
-    'Heart Rate': '8889-8',
-    'Sleeping Hours': '45550-1',
-    'Stress Level': '76542-0',
-    'Eye Movement': 'H55.89',
-    'Blood Oxygen': '20564-1',
-    'Body Temperature': '8310-5',
-    'Respiratory Rate': '9279-1'
- }
+fast_loinc_serializer = ObservationBundleSerializer(coded=True)
 
 # API route to get sleep observations by Patient_ID in FHIR format with LOINC codes
 @app.route('/fhir/sleep-observations-loinc/<int:patient_id>', methods=['GET'])
+@response_cache.cached('Observation')
 def get_sleep_observations_fhir_with_loinc(patient_id):
-    observations = read_patient_sleep_data(db_name, patient_id=patient_id)
-    
-    if observations:
+    try:
+        with span('db_fetch'):
+            observations, links = read_sleep_observations_page(patient_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    record_rows(len(observations))
 
-        bundle = Bundle(type="searchset")
-        bundle.entry = []
-
-        for obs in observations:
-            observation_component_data = [
-                ("Snoring Rate", obs[1], None),
-                ("Respiratory Rate", obs[2], None),
-                ("Body Temperature", obs[3], None),
-                ("Limb Movement", obs[4], None),
-                ("Blood Oxygen", obs[5], None),
-                ("Eye Movement", obs[6], None),
-                ("Sleeping Hours", obs[7], "h"),
-                ("Heart Rate", obs[8], None),
-                ("Stress Level", obs[9], None),
-    #            ("Observation Date", observations[10], ),
-            ]
-
-            # Define the code for the Observation
-            code = CodeableConcept()
-            code.coding = [Coding(system="http://loinc.org", code="LOINC_CODE", display="Sleep Observation")]
-            code.text = "Sleep Observation"
-
-            # Initialize the Observation object with the required code
-            observation = Observation(status="final", code=code)
-            reference = Reference(reference=f"Patient/{obs[0]}")
-            observation.subject = reference        
-
-            observation.component = []
-
-            for text, value, unit in observation_component_data:
-                try:
-                    coding = [Coding(system="http://loinc.org", code=loinc_codes[text], display=text)]
-                    oc = ObservationComponent(code=CodeableConcept(text=text, coding=coding), valueQuantity=Quantity(value=value)) 
-                    observation.component.append(oc)
-                except (ValueError, TypeError):
-                    print('Skipped invalid data {0}, {1}, {2}'.format(text, value, unit))
-                    
-            bundle_entry = BundleEntry(resource=observation)
-            bundle.entry.append(bundle_entry)
+    if observations and fast_serialization_requested():
+        with span('build'):
+            return fast_loinc_serializer.bundle(observations, links)
+    elif observations:
 
-        return bundle.dict()
+        with span('build'):
+            from fhir.resources.bundle import Bundle, BundleEntry, BundleLink
+            from fhir_builders import loinc_observation
+
+            bundle = Bundle(type="searchset")
+            bundle.link = [BundleLink(relation=relation, url=url) for relation, url in links] or None
+            bundle.entry = []
+
+            for obs in observations:
+                observation = loinc_observation(obs)
+
+                bundle_entry = BundleEntry(resource=observation)
+                bundle.entry.append(bundle_entry)
+
+        with span('serialize'):
+            return bundle.dict()
     else:
         return "Patient observations not found", 404
 
+def searchset_bundle(patients, observations, links=()):
+    # searchset Bundle of Patients rows followed by observation rows, holding the
+    # same resources as /fhir/patient/<id> and /fhir/sleep-observations-loinc/<id>
+    if fast_serialization_requested():
+        with span('build'):
+            bundle = {"resourceType": "Bundle", "type": "searchset"}
+            if links:
+                bundle["link"] = [{"relation": relation, "url": url} for relation, url in links]
+            bundle["entry"] = ([{"resource": patient_resource(patient)} for patient in patients] +
+                               [{"resource": fast_loinc_serializer.observation(obs)} for obs in observations])
+            return bundle
+
+    with span('build'):
+        from fhir.resources.bundle import Bundle, BundleEntry, BundleLink
+        from fhir_builders import loinc_observation
+
+        bundle = Bundle(type="searchset")
+        bundle.link = [BundleLink(relation=relation, url=url) for relation, url in links] or None
+        bundle.entry = ([BundleEntry(resource=build_patient(patient)) for patient in patients] +
+                        [BundleEntry(resource=loinc_observation(obs)) for obs in observations]) or None
+
+    with span('serialize'):
+        return bundle.dict()
+
 @app.route('/fhir/names', methods=['GET'])
+@response_cache.cached('names')
 def get_patient_names():
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    # Query to select the required columns
-    cursor.execute("SELECT Patient_ID, First_Name, Last_Name FROM Patients")
-    patients = cursor.fetchall()
+    with span('db_fetch'):
+        patients = read_patient_names(db_name)
+    record_rows(len(patients))
 
     # Format the response
     response = [
@@ -417,17 +504,159 @@ def get_patient_names():
         for patient in patients
     ]
 
-    conn.close()
     return jsonify(response)
 
+def read_paging(count_param, offset_param, default, maximum):
+    # (count, offset) from the request; raises ValueError for malformed values
+    try:
+        count = int(request.args.get(count_param, default))
+        offset = int(request.args.get(offset_param, 0))
+    except ValueError:
+        raise ValueError('{} and {} must be integers'.format(count_param, offset_param))
+    if count < 1 or offset < 0:
+        raise ValueError('{} must be at least 1 and {} not negative'.format(count_param, offset_param))
+    return min(count, maximum), offset
+
+# Typeahead for the patient dropdown: prefix search over names, Email and
+# Phone_Number, one page at a time instead of the full /fhir/names list
+@app.route('/fhir/names/search', methods=['GET'])
+@response_cache.cached('names')
+def search_patient_names():
+    q = request.args.get('q', '')
+    try:
+        limit, offset = read_paging('limit', 'offset', app.config['PATIENT_SEARCH_DEFAULT_LIMIT'],
+                                    app.config['PATIENT_SEARCH_MAX_LIMIT'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    with span('db_fetch'):
+        patients, has_more = search_patients(db_name, q, limit, offset)
+    record_rows(len(patients))
+
+    results = [
+        {"value": str(patient[0]), "label": f"{patient[1]} {patient[2]}"}
+        for patient in patients
+    ]
+    next_url = url_for(request.endpoint, q=q, limit=limit, offset=offset + limit, _external=True) if has_more else None
+    return jsonify({'results': results, 'next': next_url})
+
+def read_patient_ids(param_names):
+    # Patient ids from repeated or comma-separated parameters, e.g.
+    # subject=Patient/1,Patient/2&subject=3; raises ValueError for malformed ids
+    patient_ids = []
+    for param_name in param_names:
+        for value in request.args.getlist(param_name):
+            for item in value.split(','):
+                item = item.strip()
+                if item.startswith('Patient/'):
+                    item = item[len('Patient/'):]
+                try:
+                    patient_ids.append(int(item))
+                except ValueError:
+                    raise ValueError('Invalid patient id: {}'.format(item))
+    if len(set(patient_ids)) > app.config['FHIR_MAX_BATCH_IDS']:
+        raise ValueError('At most {} patients per search'.format(app.config['FHIR_MAX_BATCH_IDS']))
+    return patient_ids
+
+def read_observation_cursor():
+    # (count, after) from _count and the (patient_id, observation_date) key in _cursor
+    count, _ = read_paging('_count', '_offset', app.config['FHIR_DEFAULT_COUNT'], app.config['FHIR_MAX_COUNT'])
+    after = None
+    if '_cursor' in request.args:
+        direction, after = decode_page_cursor(request.args['_cursor'], batched=True)
+        if direction != 'next':
+            raise ValueError('Invalid _cursor')
+        after = tuple(after)
+    return count, after
+
+
+# FHIR Patient search by name prefix or by _id list, as a paged searchset Bundle
+@app.route('/fhir/Patient', methods=['GET'])
+@response_cache.cached('names')
+def search_patients_fhir():
+    name = request.args.get('name', '')
+    ids = request.args.getlist('_id')
+    try:
+        count, offset = read_paging('_count', '_offset', app.config['FHIR_DEFAULT_COUNT'], app.config['FHIR_MAX_COUNT'])
+        patient_ids = read_patient_ids(['_id'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if ids and name:
+        return jsonify({'error': 'name and _id cannot be combined'}), 400
+
+    with span('db_fetch'):
+        if ids:
+            # Pages are taken from the sorted id list, then read with one query per shard
+            patient_ids = sorted(set(patient_ids))
+            patients = read_patients(db_name, patient_ids[offset:offset + count])
+            has_more = offset + count < len(patient_ids)
+        else:
+            patients, has_more = search_patients(db_name, name, count, offset, columns=NAME_COLUMNS, select='*')
+    record_rows(len(patients))
+
+    def page_url(page_offset):
+        return url_for(request.endpoint, name=name or None, _id=ids or None, _count=count, _offset=page_offset,
+                       _external=True)
+
+    with span('build'):
+        links = [{"relation": "self", "url": request.url}]
+        if has_more:
+            links.append({"relation": "next", "url": page_url(offset + count)})
+        if offset > 0:
+            links.append({"relation": "previous", "url": page_url(max(0, offset - count))})
+        bundle = {"resourceType": "Bundle", "type": "searchset", "link": links,
+                  "entry": [{"resource": patient_resource(patient)} for patient in patients]}
+    return bundle
+
+# Observations of several patients in one paged searchset Bundle, e.g.
+# /fhir/Observation?subject=Patient/1,Patient/2. Not cached: the cache drops
+# responses per patient, and these span many.
+@app.route('/fhir/Observation', methods=['GET'])
+def search_observations_fhir():
+    try:
+        patient_ids = read_patient_ids(['subject', 'patient'])
+        count, after = read_observation_cursor()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not patient_ids:
+        return jsonify({'error': 'subject is required'}), 400
+
+    with span('db_fetch'):
+        observations, has_more = read_observations_page(db_name, patient_ids, count, after)
+    record_rows(len(observations))
+
+    links = [('self', request.url)]
+    if has_more:
+        links.append(('next', cursor_page_url(encode_page_cursor('next', [observations[-1][0], observations[-1][10]]))))
+    return searchset_bundle([], observations, links)
+
+# The Patient and its observations in one searchset Bundle; the Patient leads the
+# first page and _count pages through the observations
+@app.route('/fhir/Patient/<int:patient_id>/$everything', methods=['GET'])
+@response_cache.cached('Observation')
+def get_patient_everything(patient_id):
+    try:
+        count, after = read_observation_cursor()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    with span('db_fetch'):
+        patient_data, observations, has_more = read_patient_everything(db_name, patient_id, count, after)
+    if patient_data is None:
+        return "Patient not found", 404
+    record_rows(len(observations) + (1 if after is None else 0))
+
+    links = [('self', request.url)]
+    if has_more:
+        links.append(('next', cursor_page_url(encode_page_cursor('next', [patient_id, observations[-1][10]]))))
+    return searchset_bundle([patient_data] if after is None else [], observations, links)
+
 @app.route('/fhir/dates/<int:patient_id>', methods=['GET'])
+@response_cache.cached('dates')
 def get_observation_dates(patient_id):
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    # Query to select observation dates for the specified patient_id
-    cursor.execute("SELECT observation_date FROM sleep_observations WHERE patient_id = ?", (patient_id,))
-    observation_dates = cursor.fetchall()
+    with span('db_fetch'):
+        observation_dates = read_observation_dates(db_name, patient_id)
+    record_rows(len(observation_dates))
 
     # Format the response
     response = [
@@ -435,9 +664,87 @@ def get_observation_dates(patient_id):
         for i, date in enumerate(observation_dates, start=1)
     ]
 
-    conn.close()
     return jsonify(response)
 
+# FHIR Bulk Data style export of all Patients and Observations as streamed NDJSON
+@app.route('/fhir/$export', methods=['GET'])
+def bulk_export_ndjson():
+    try:
+        types = parse_types(request.args.get('_type'))
+        since = parse_since(request.args['_since']) if '_since' in request.args else None
+        if since is not None:
+            require_change_tracking(db_name, types)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        for resource_type in types:
+            yield from iter_ndjson(db_name, resource_type, since)
+
+    if request.accept_encodings['gzip']:
+        return Response(gzip_chunks(generate()), mimetype='application/fhir+ndjson',
+                        headers={'Content-Encoding': 'gzip'})
+    return Response(generate(), mimetype='application/fhir+ndjson')
+
+# Rolling averages, percentiles, stress distribution and anomaly flags for one patient
+@app.route('/analytics/patient/<int:patient_id>', methods=['GET'])
+def get_patient_analytics(patient_id):
+    from sleep_analytics import patient_analytics
+
+    analytics = patient_analytics(db_name, patient_id)
+    if analytics is None:
+        return "Patient observations not found", 404
+    return jsonify(analytics)
+
+# The same metrics for every patient, computed in one pass
+@app.route('/analytics/cohort', methods=['GET'])
+def get_cohort_analytics():
+    from sleep_analytics import cohort_analytics
+
+    return jsonify(cohort_analytics(db_name))
+
+def read_rollup_range(default_period):
+    # (period, start, end) from ?period=day|week|month&start=&end=; raises ValueError
+    period = request.args.get('period', default_period)
+    if period not in ROLLUP_PERIODS:
+        raise ValueError('period must be one of {}'.format(', '.join(ROLLUP_PERIODS)))
+    bounds = []
+    for name in ('start', 'end'):
+        value = request.args.get(name)
+        if value is not None:
+            try:
+                date.fromisoformat(value)
+            except ValueError:
+                raise ValueError('{} must be a YYYY-MM-DD date'.format(name))
+        bounds.append(value)
+    return period, bounds[0], bounds[1]
+
+# Per-period summaries of one patient, served from the sleep_rollups table
+@app.route('/analytics/rollups/patient/<int:patient_id>', methods=['GET'])
+def get_patient_rollups(patient_id):
+    try:
+        period, start, end = read_rollup_range('week')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with span('db_fetch'):
+        periods = patient_rollups(db_name, patient_id, period, start, end)
+    record_rows(len(periods))
+    if not periods:
+        return "Patient observations not found", 404
+    return jsonify({'patient_id': patient_id, 'period': period, 'periods': periods})
+
+# The same summaries combined over every patient
+@app.route('/analytics/rollups/cohort', methods=['GET'])
+def get_cohort_rollups():
+    try:
+        period, start, end = read_rollup_range('month')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with span('db_fetch'):
+        periods = cohort_rollups(db_name, period, start, end)
+    record_rows(len(periods))
+    return jsonify({'period': period, 'periods': periods})
+
 @app.route('/verify_credentials', methods=['POST', 'OPTIONS'])
 def verify_credentials():
     if request.method == 'OPTIONS':
@@ -453,13 +760,11 @@ def verify_credentials():
         username = data['username']
         password = data['password']
 
-        conn = sqlite3.connect('credentials.db')
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
-        user = cursor.fetchone()
+        with connection(credentials_db_name) as conn:
+            cursor = conn.cursor()
 
-        conn.close()
+            cursor.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
+            user = cursor.fetchone()
 
         if user:
             response = jsonify({'exists': True})
@@ -477,21 +782,19 @@ def add_credentials():
         username = data['username']
         password = data['password']
 
-        conn = sqlite3.connect('credentials.db')
-        cursor = conn.cursor()
+        with connection(credentials_db_name) as conn:
+            cursor = conn.cursor()
 
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+            cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+            user = cursor.fetchone()
 
-        if user:
-            conn.close()
-            response = jsonify({'error': 'Username already exists'})
-            response.headers.add('Access-Control-Allow-Origin', '*')
-            return response
+            if user:
+                response = jsonify({'error': 'Username already exists'})
+                response.headers.add('Access-Control-Allow-Origin', '*')
+                return response
 
-        cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
-        conn.commit()
-        conn.close()
+            cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
+            conn.commit()
 
         response = jsonify({'success': True})
         response.status_code = 201  # Resource created successfully
@@ -501,33 +804,42 @@ def add_credentials():
 
 @app.route('/get_credentials', methods=['GET'])
 def get_credentials():
-    # Connect to the SQLite database
-    conn = sqlite3.connect('credentials.db')
-    cursor = conn.cursor()
-
-    # Execute the query to fetch all usernames and passwords
-    cursor.execute("SELECT username, password FROM users")
-    credentials = cursor.fetchall()
+    # Borrow a pooled connection to the credentials database
+    with connection(credentials_db_name) as conn:
+        cursor = conn.cursor()
 
-    # Close the database connection
-    conn.close()
+        # Execute the query to fetch all usernames and passwords
+        cursor.execute("SELECT username, password FROM users")
+        credentials = cursor.fetchall()
 
     # Format the data for the response
     credentials_list = [{'username': username, 'password': password} for username, password in credentials]
 
     return jsonify(credentials_list)
 
-if __name__ == "__main__":
-    
-    db_name = "sleep_data.db"
-
-    if os.path.exists(db_name):
-       os.remove(db_name)
-   
-    create_table_from_csv(db_name, "data/patients.csv")
-
-    create_sleep_observations_table(db_name, "data/sleep_observation.csv")
-
+@app.route('/pool_stats', methods=['GET'])
+def get_pool_stats():
+    # Connection pool hit/miss counters per database file
+    return jsonify(pool_stats())
+
+@app.route('/write_queue_stats', methods=['GET'])
+def get_write_queue_stats():
+    # Write-behind queue depth, batch and retry counters
+    return jsonify(write_queue.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus scrape endpoint for the request instrumentation
+    return Response(instrumentation.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    # Response cache hit/miss/eviction counters
+    return jsonify(response_cache.stats())
+
+def write_samples_and_check():
+    # Writes the sample Patient and Observation Bundle files and checks that
+    # inserting and deleting rows works against a freshly built database
     patient_id = 1
     #print(read_patient_data(patient_id))
 
@@ -589,9 +901,46 @@ if __name__ == "__main__":
     after_delete_cnt = get_records_count("sleep_observations")
     print('Before count: {} After count: {}'.format(after_cnt, after_delete_cnt))
 
-    # Set the port dynamically with a default to 5000 for local development
-    port = int(os.environ.get("PORT", 5000))
+def serve(port, debug=False):
+    # Replay uploads a crash left in the write-behind journal. With debug, the
+    # reloader runs the app in a child process, and only that one may write.
+    if app.config['WRITE_BEHIND_ENABLED'] and (not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        write_queue.start()
 
-    app.run(debug=True, host='0.0.0.0', port=port)
+    app.run(debug=debug, host='0.0.0.0', port=port)
     # http://127.0.0.1:5000/fhir/patient/1 in postman
-    # curl http://127.0.0.1:5000/fhir/patient/1 in terminal
\ No newline at end of file
+    # curl http://127.0.0.1:5000/fhir/patient/1 in terminal
+
+if __name__ == "__main__":
+    # `init-db` rebuilds the database from the CSVs and `serve` only serves it, so
+    # workers can start against an existing database. Without a command the
+    # database is rebuilt and checked before serving, as for local development.
+    parser = argparse.ArgumentParser(description="Sleep tracker FHIR API.")
+    subcommands = parser.add_subparsers(dest='command')
+    init = subcommands.add_parser('init-db', help="delete and rebuild the database from the CSV exports")
+    init.add_argument('--patients', default="data/patients.csv")
+    init.add_argument('--observations', default="data/sleep_observation.csv")
+    init.add_argument('--check', action='store_true',
+                      help="write the sample FHIR files and check that inserts and deletes work")
+    init.add_argument('--shards', type=int, default=1, help="spread the patients over this many SQLite files")
+    init.add_argument('--strategy', choices=STRATEGIES, default='hash', help="route patients to shards by hash or range")
+    init.add_argument('--range-size', type=int, default=DEFAULT_RANGE_SIZE)
+    serve_parser = subcommands.add_parser('serve', help="serve the API from the existing database")
+    # Set the port dynamically with a default to 5000 for local development
+    serve_parser.add_argument('--port', type=int, default=int(os.environ.get("PORT", 5000)))
+    serve_parser.add_argument('--debug', action='store_true',
+                              help="run Flask's debugger and reloader (local development only)")
+    args = parser.parse_args()
+
+    if args.command in (None, 'init-db'):
+        patients_csv = getattr(args, 'patients', "data/patients.csv")
+        observations_csv = getattr(args, 'observations', "data/sleep_observation.csv")
+        # The write-behind journal belongs to the database being replaced
+        init_db(db_name, patients_csv, observations_csv, extra_paths=[app.config['WRITE_BEHIND_JOURNAL'] + '.*'],
+                shards=getattr(args, 'shards', 1), strategy=getattr(args, 'strategy', 'hash'),
+                range_size=getattr(args, 'range_size', DEFAULT_RANGE_SIZE))
+        if args.command is None or args.check:
+            write_samples_and_check()
+
+    if args.command in (None, 'serve'):
+        serve(getattr(args, 'port', None) or int(os.environ.get("PORT", 5000)), getattr(args, 'debug', False))
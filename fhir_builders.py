@@ -0,0 +1,67 @@
+from fhir.resources.observation import Observation, ObservationComponent
+from fhir.resources.quantity import Quantity
+from fhir.resources.reference import Reference
+
+from fhir_fast import log_skipped_component
+from terminology import terminology
+
+
+# fhir.resources builders shared by the API routes and the batch converter, so
+# every path produces the same resources from a sleep_observations row. The
+# CodeableConcepts come prebuilt from the terminology and are shared between
+# observations; only the values are validated per row.
+
+
+def text_observation(obs):
+    # Observation with text-only components for one sleep_observations row
+    observation = Observation(status="final", code=terminology.observation_concept())
+    reference = Reference(reference=f"Patient/{obs[0]}")
+    observation.subject = reference
+
+    # Add components for each attribute of the observation
+    # Make sure the indices match the order in your database
+    concept = terminology.text_concept
+    observation.component = [
+        ObservationComponent(code=concept("Snoring Rate"), valueQuantity=Quantity(value=float(obs[1])if obs[1] else "0")),
+        ObservationComponent(code=concept("Respiratory Rate"), valueQuantity=Quantity(value=float(obs[2])if obs[2] else "0")),
+        ObservationComponent(code=concept("Body Temperature"), valueQuantity=Quantity(value=float(obs[3])if obs[3] else "0")),
+        ObservationComponent(code=concept("Limb Movement"), valueQuantity=Quantity(value=float(obs[4])if obs[4] else "0")),
+        ObservationComponent(code=concept("Blood Oxygen"), valueQuantity=Quantity(value=float(obs[5])if obs[5] else "0")),
+        ObservationComponent(code=concept("Eye Movement"), valueQuantity=Quantity(value=float(obs[6])if obs[6] else "0")),
+        ObservationComponent(code=concept("Sleeping Hours"), valueQuantity=Quantity(value=float(obs[7]), unit="h")),
+        ObservationComponent(code=concept("Heart Rate"), valueQuantity=Quantity(value=float(obs[8])if obs[8] else "0")),
+        ObservationComponent(code=concept("Stress Level"), valueString=str(obs[9])if obs[9] else "0"),
+        ObservationComponent(code=concept("Observation Date"), valueString=str(obs[10])if obs[10] else "0"),
+    ]
+    return observation
+
+
+def loinc_observation(obs):
+    # Observation with LOINC-coded components for one sleep_observations row
+    observation_component_data = [
+        ("Snoring Rate", obs[1], None),
+        ("Respiratory Rate", obs[2], None),
+        ("Body Temperature", obs[3], None),
+        ("Limb Movement", obs[4], None),
+        ("Blood Oxygen", obs[5], None),
+        ("Eye Movement", obs[6], None),
+        ("Sleeping Hours", obs[7], "h"),
+        ("Heart Rate", obs[8], None),
+        ("Stress Level", obs[9], None),
+    ]
+
+    # Initialize the Observation object with the required code
+    observation = Observation(status="final", code=terminology.observation_concept())
+    reference = Reference(reference=f"Patient/{obs[0]}")
+    observation.subject = reference
+
+    observation.component = []
+
+    for text, value, unit in observation_component_data:
+        try:
+            oc = ObservationComponent(code=terminology.concept(text), valueQuantity=Quantity(value=value))
+            observation.component.append(oc)
+        except (ValueError, TypeError):
+            log_skipped_component(text, value)
+
+    return observation
@@ -0,0 +1,185 @@
+import argparse
+import csv
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fhir_builders import loinc_observation
+
+
+# Batch CSV -> FHIR conversion. Each input CSV is split into byte ranges that
+# start on line boundaries; the shards are converted in a ProcessPoolExecutor,
+# each worker writing its own NDJSON part file, and the parts are merged in
+# shard order, so the output matches a single-process run line for line.
+
+INTEGER_COLUMNS = ('patient_id', 'heart_rate', 'stress_level')
+TEXT_COLUMNS = ('observation_date',)
+ROW_COLUMNS = ('patient_id', 'snoring_rate', 'respiratory_rate', 'body_temperature', 'limb_movement',
+               'blood_oxygen', 'eye_movement', 'sleeping_hours', 'heart_rate', 'stress_level', 'observation_date')
+
+# Shards smaller than this are not worth a process
+MIN_SHARD_BYTES = 1024 * 1024
+
+
+def _coerce(column, value):
+    # The value SQLite's column affinity would store for a CSV field
+    if column in TEXT_COLUMNS:
+        return value
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    if column in INTEGER_COLUMNS and number.is_integer():
+        return int(number)
+    return number
+
+
+def read_header(csv_filename):
+    with open(csv_filename, 'r', newline='') as f:
+        return next(csv.reader(f))
+
+
+def shard_ranges(csv_filename, shards):
+    # [(start, end)] byte ranges covering the file after its header
+    with open(csv_filename, 'rb') as f:
+        f.readline()
+        data_start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+    shards = max(1, min(shards, (size - data_start) // MIN_SHARD_BYTES or 1))
+    step = (size - data_start) // shards + 1
+    return [(start, min(start + step, size)) for start in range(data_start, size, step)] or [(data_start, size)]
+
+
+def _shard_lines(f, start, end):
+    # Lines whose first byte falls inside [start, end)
+    f.seek(start - 1)
+    f.readline()  # Finishes the line that straddles start (just its newline if start is a line start)
+    position = f.tell()
+    while position < end:
+        line = f.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line.decode('utf-8')
+
+
+def observation_resource(obs):
+    # The LOINC Observation of the API with the id and date of the $export output
+    observation = loinc_observation(obs)
+    observation.id = '{}-{}'.format(obs[0], obs[10])
+    observation.effectiveDateTime = obs[10]
+    return observation.json()
+
+
+def convert_shard(task):
+    """Convert one byte range of a CSV to an NDJSON part file (runs in a worker process).
+
+    Returns the shard's row count and timing for the per-worker report.
+    """
+    index, csv_filename, start, end, part_filename = task
+    began = time.perf_counter()
+    header = read_header(csv_filename)
+    positions = [header.index(column) for column in ROW_COLUMNS]
+
+    rows = 0
+    with open(csv_filename, 'rb') as source, open(part_filename, 'w', encoding='utf-8') as out:
+        for record in csv.reader(_shard_lines(source, start, end)):
+            if not record:
+                continue
+            obs = tuple(_coerce(column, record[i]) for column, i in zip(ROW_COLUMNS, positions))
+            out.write(observation_resource(obs))
+            out.write('\n')
+            rows += 1
+
+    seconds = time.perf_counter() - began
+    return {'shard': index, 'pid': os.getpid(), 'rows': rows, 'seconds': seconds,
+            'rows_per_sec': rows / seconds if seconds > 0 else 0.0}
+
+
+def merge_parts(part_filenames, output, format='ndjson'):
+    # Concatenates the part files in shard order, optionally wrapped in a collection Bundle
+    with open(output, 'w', encoding='utf-8') as out:
+        if format == 'bundle':
+            out.write('{"resourceType": "Bundle", "type": "collection", "entry": [')
+        first = True
+        for part_filename in part_filenames:
+            with open(part_filename, 'r', encoding='utf-8') as part:
+                if format == 'bundle':
+                    for line in part:
+                        out.write(('' if first else ', ') + '{"resource": ' + line.rstrip('\n') + '}')
+                        first = False
+                else:
+                    shutil.copyfileobj(part, out)
+        if format == 'bundle':
+            out.write(']}\n')
+
+
+def _digest(filename):
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def convert(csv_filenames, output, workers=None, format='ndjson', verify=False):
+    """Convert sleep observation CSVs to FHIR Observations in parallel.
+
+    Writes NDJSON (or a collection Bundle) to ``output`` and prints each
+    worker's throughput. With ``verify`` the files are converted again in this
+    process and the outputs compared; a mismatch raises AssertionError.
+    Returns the per-shard statistics.
+    """
+    workers = workers or os.cpu_count() or 1
+    began = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as parts_dir:
+        tasks = []
+        for csv_filename in csv_filenames:
+            for start, end in shard_ranges(csv_filename, workers):
+                tasks.append((len(tasks), csv_filename, start, end,
+                              os.path.join(parts_dir, 'part-{:05d}.ndjson'.format(len(tasks)))))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            stats = list(executor.map(convert_shard, tasks))
+        merge_parts([task[4] for task in tasks], output, format)
+
+        seconds = time.perf_counter() - began
+        rows = sum(s['rows'] for s in stats)
+        for s in stats:
+            print(f"Shard {s['shard']} (pid {s['pid']}): {s['rows']} rows in {s['seconds']:.2f}s "
+                  f"({s['rows_per_sec']:,.0f} rows/sec)")
+        print(f"Converted {rows} observations with {workers} workers in {seconds:.2f}s "
+              f"({rows / seconds if seconds > 0 else 0.0:,.0f} rows/sec) to '{output}'.")
+
+        if verify:
+            single_parts = []
+            for csv_filename in csv_filenames:
+                part_filename = os.path.join(parts_dir, 'single-{:05d}.ndjson'.format(len(single_parts)))
+                with open(csv_filename, 'rb') as f:
+                    f.readline()
+                    start, end = f.tell(), os.fstat(f.fileno()).st_size
+                convert_shard((len(single_parts), csv_filename, start, end, part_filename))
+                single_parts.append(part_filename)
+            single_output = os.path.join(parts_dir, 'single-output')
+            merge_parts(single_parts, single_output, format)
+            assert _digest(single_output) == _digest(output), \
+                "parallel output differs from the single-process conversion"
+            print("Output is identical to the single-process conversion.")
+
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert sleep observation CSVs to FHIR Observations in parallel.")
+    parser.add_argument('csv_files', nargs='+')
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--format', choices=('ndjson', 'bundle'), default='ndjson')
+    parser.add_argument('--verify', action='store_true',
+                        help="also convert in a single process and check the outputs are identical")
+    args = parser.parse_args()
+
+    convert(args.csv_files, args.output, args.workers, args.format, args.verify)
@@ -0,0 +1,168 @@
+import json
+import logging
+import math
+import random
+from decimal import Decimal, InvalidOperation
+
+from terminology import terminology as default_terminology
+
+
+# Fast-path serializer for sleep observation Bundles. Rows from sleep_observations
+# are turned straight into the dicts that Bundle(...).dict() would produce, without
+# constructing and validating a pydantic model per Observation, component and Quantity.
+# The static parts (codings, component CodeableConcepts, Bundle envelope) are built
+# once (see terminology.py) and shared between entries, so callers must treat the
+# output as read-only.
+
+# Row layout the serializers index into (obs[0] ... obs[10])
+OBSERVATION_ROW_COLUMNS = [
+    'patient_id', 'snoring_rate', 'respiratory_rate', 'body_temperature', 'limb_movement',
+    'blood_oxygen', 'eye_movement', 'sleeping_hours', 'heart_rate', 'stress_level', 'observation_date',
+]
+
+# (component text, row index) in the column order of the sleep_observations table
+COMPONENT_COLUMNS = [
+    ("Snoring Rate", 1),
+    ("Respiratory Rate", 2),
+    ("Body Temperature", 3),
+    ("Limb Movement", 4),
+    ("Blood Oxygen", 5),
+    ("Eye Movement", 6),
+    ("Sleeping Hours", 7),
+    ("Heart Rate", 8),
+    ("Stress Level", 9),
+]
+
+_ZERO = Decimal("0")
+
+
+def fhir_decimal(value):
+    # Same coercion the fhir.resources Decimal type applies; None means "no value"
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ValueError("value is not a valid decimal: {!r}".format(value))
+        return Decimal(str(value))
+    if isinstance(value, str):
+        value = value.strip()
+    try:
+        result = Decimal(value)
+    except (InvalidOperation, TypeError):
+        raise ValueError("value is not a valid decimal: {!r}".format(value))
+    if not result.is_finite():
+        raise ValueError("value is not a valid decimal: {!r}".format(value))
+    return result
+
+
+class ObservationBundleSerializer:
+    # With coded=True the output matches /fhir/sleep-observations-loinc/<id>,
+    # otherwise the text-only components of /fhir/sleep-observations/<id>.
+
+    def __init__(self, coded=False, terminology=None):
+        self.coded = coded
+        self.terminology = terminology or default_terminology
+        self._component_codes = []
+        for text, index in COMPONENT_COLUMNS:
+            code = self.terminology.fragment(text) if coded else self.terminology.text_fragment(text)
+            self._component_codes.append((text, index, code))
+        self._observation_date_code = self.terminology.text_fragment("Observation Date")
+        self._observation_code = self.terminology.observation_fragment()
+
+    def _text_components(self, obs):
+        components = []
+        for text, index, code in self._component_codes:
+            value = obs[index]
+            if text == "Stress Level":
+                components.append({"code": code, "valueString": str(value) if value else "0"})
+            elif text == "Sleeping Hours":
+                components.append({"code": code, "valueQuantity": {"value": fhir_decimal(float(value)), "unit": "h"}})
+            else:
+                components.append({"code": code, "valueQuantity": {"value": fhir_decimal(float(value)) if value else _ZERO}})
+        components.append({"code": self._observation_date_code, "valueString": str(obs[10]) if obs[10] else "0"})
+        return components
+
+    def _loinc_components(self, obs):
+        components = []
+        for text, index, code in self._component_codes:
+            value = obs[index]
+            try:
+                value = fhir_decimal(value)
+            except ValueError:
+                log_skipped_component(text, value)
+                continue
+            if value is None:
+                components.append({"code": code})
+            else:
+                components.append({"code": code, "valueQuantity": {"value": value}})
+        return components
+
+    def observation(self, obs):
+        if self.coded:
+            components = self._loinc_components(obs)
+        else:
+            components = self._text_components(obs)
+        return {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": self._observation_code,
+            "subject": {"reference": f"Patient/{obs[0]}"},
+            "component": components,
+        }
+
+    def bundle(self, observations, links=()):
+        # `links` are (relation, url) pairs for Bundle.link
+        bundle = {"resourceType": "Bundle", "type": "searchset"}
+        if links:
+            bundle["link"] = [{"relation": relation, "url": url} for relation, url in links]
+        bundle["entry"] = [{"resource": self.observation(obs)} for obs in observations]
+        return bundle
+
+
+def patient_resource(patient_data):
+    # Dict form of the Patient built by /fhir/patient/<id> from a Patients row
+    patient = {
+        "resourceType": "Patient",
+        "id": str(patient_data[0]),
+        "identifier": [{"use": "official", "value": str(patient_data[0])}],
+        "name": [_without_none({"use": "official", "family": patient_data[2], "given": [patient_data[1]]})],
+        "telecom": [_without_none({"system": "phone", "value": patient_data[5]}),
+                    _without_none({"system": "email", "value": patient_data[6]})],
+        "gender": patient_data[4],
+        "birthDate": str(patient_data[3]),
+        "address": [_without_none({"use": "home", "line": [patient_data[7]], "city": patient_data[8],
+                                   "state": patient_data[9], "postalCode": patient_data[10]})],
+    }
+    return _without_none(patient)
+
+
+def log_skipped_component(text, value):
+    # instrumentation imports Flask, which the data-access layer must not load up
+    # front, so it is only imported once a row actually has an invalid value
+    from instrumentation import get_logger, log_event
+
+    log_event(get_logger('fhir_fast'), logging.DEBUG, 'component_skipped', component=text, value=repr(value))
+
+
+def _without_none(fields):
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+def check_conformance(serializer, observations, sample_size=100, seed=0):
+    # Validates a random sample of rows against fhir.resources and checks that the
+    # round-tripped model serializes to exactly the same JSON as the fast path.
+    # Returns the number of rows checked; raises AssertionError on the first mismatch.
+    from fhir.resources.bundle import Bundle
+
+    observations = list(observations)
+    sample = random.Random(seed).sample(observations, min(sample_size, len(observations)))
+    for obs in sample:
+        fast = serializer.bundle([obs])
+        validated = Bundle.parse_obj(fast).dict()
+        fast_json = json.dumps(fast, sort_keys=True, default=str)
+        validated_json = json.dumps(validated, sort_keys=True, default=str)
+        if fast_json != validated_json:
+            raise AssertionError("fast serializer output differs for row {!r}".format(obs))
+    return len(sample)
@@ -0,0 +1,158 @@
+import argparse
+import gzip
+import json
+import os
+import time
+
+import ijson
+
+from fhir_ingest import VITAL_COLUMNS, EntryError, _patient_id_from_reference, observation_to_row, upsert_observations
+from shards import ShardConnections, migrate
+
+
+# Incremental import of FHIR Observations from partner Bundle / NDJSON files
+# into sleep_observations. Files are parsed as a stream (ijson for Bundles, one
+# line at a time for NDJSON, optionally gzipped), rows are upserted on
+# (patient_id, observation_date) in batched transactions, and each batch commits
+# together with a checkpoint in import_checkpoints (on a sharded database, the
+# shards commit first and the catalog's checkpoint last). Re-running an
+# interrupted import resumes after the last committed batch; re-importing a file
+# is harmless.
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+def _is_ndjson(path):
+    return path.endswith(('.ndjson', '.ndjson.gz', '.jsonl', '.jsonl.gz'))
+
+
+def _open(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def fingerprint(path):
+    # A changed file invalidates its checkpoint
+    stat = os.stat(path)
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def iter_resources(path, position=0):
+    # Yields (resource, position after it). Positions are byte offsets for NDJSON
+    # (resumed with a seek) and entry indexes for Bundles (earlier entries are
+    # parsed but skipped). Offsets into a gzipped file count uncompressed bytes,
+    # and GzipFile can only seek by decompressing from the start, so resuming one
+    # still inflates what was imported before (without parsing it).
+    with _open(path) as f:
+        if _is_ndjson(path):
+            f.seek(position)
+            for line in f:
+                position += len(line)
+                if line.strip():
+                    yield json.loads(line), position
+        else:
+            for index, entry in enumerate(ijson.items(f, 'entry.item')):
+                if index >= position:
+                    yield (entry or {}).get('resource'), index + 1
+
+
+def read_checkpoint(conn, source):
+    row = conn.execute('''
+        SELECT fingerprint, position, resources, imported, skipped, completed
+        FROM import_checkpoints WHERE source = ?
+    ''', (source,)).fetchone()
+    if row is None:
+        return None
+    return dict(zip(('fingerprint', 'position', 'resources', 'imported', 'skipped', 'completed'), row))
+
+
+def _write_checkpoint(conn, source, state):
+    conn.execute('''
+        INSERT INTO import_checkpoints (source, fingerprint, position, resources, imported, skipped, completed)
+        VALUES (:source, :fingerprint, :position, :resources, :imported, :skipped, :completed)
+        ON CONFLICT(source) DO UPDATE SET
+            fingerprint = excluded.fingerprint, position = excluded.position, resources = excluded.resources,
+            imported = excluded.imported, skipped = excluded.skipped, completed = excluded.completed,
+            updated_at = CURRENT_TIMESTAMP
+    ''', dict(state, source=source))
+
+
+def import_file(db_name, path, batch_size=DEFAULT_BATCH_SIZE, resume=True, progress=None):
+    """Import the Observations of a FHIR Bundle or NDJSON file into sleep_observations.
+
+    Each batch of ``batch_size`` rows is upserted and committed together with the
+    file's checkpoint, so an interrupted import continues from the last batch
+    when ``resume`` is true. Resources that are not Observations are ignored;
+    Observations that cannot be mapped are skipped and counted. Returns a dict of
+    counts plus the elapsed time.
+    """
+    migrate(db_name)
+    source = os.path.abspath(path)
+    state = {'fingerprint': fingerprint(path), 'position': 0, 'resources': 0,
+             'imported': 0, 'skipped': 0, 'completed': 0}
+    start = time.perf_counter()
+
+    with ShardConnections(db_name) as shards:
+        conn = shards.for_path(db_name)
+        checkpoint = read_checkpoint(conn, source)
+        if resume and checkpoint and checkpoint['fingerprint'] == state['fingerprint']:
+            if checkpoint['completed']:
+                print(f"'{path}' was already imported.")
+                return dict(checkpoint, resumed_from=checkpoint['position'], seconds=0.0, rows_per_sec=0.0)
+            state.update(checkpoint)
+            print(f"Resuming '{path}' after {checkpoint['resources']} resources.")
+        resumed_from = state['position']
+        previously_imported = state['imported']
+
+        def flush(rows):
+            try:
+                for shard, group in shards.split(rows, lambda row: row[0]):
+                    upsert_observations(shard, group)
+                _write_checkpoint(conn, source, state)
+                shards.commit()
+            except BaseException:
+                shards.rollback()
+                raise
+            if progress:
+                progress(state)
+
+        rows = []
+        for resource, position in iter_resources(path, state['position']):
+            state['resources'] += 1
+            if isinstance(resource, dict) and resource.get('resourceType') == 'Observation':
+                try:
+                    reference, values = observation_to_row(resource)
+                    patient_id = _patient_id_from_reference(reference)
+                    rows.append(tuple([patient_id, values['observation_date']] +
+                                      [values.get(c) for c in VITAL_COLUMNS]))
+                except EntryError as e:
+                    state['skipped'] += 1
+                    print(f"Skipped resource {state['resources']}: {e}")
+            # The checkpoint only ever advances to the end of a complete batch
+            state['position'] = position
+            if len(rows) >= batch_size:
+                state['imported'] += len(rows)
+                flush(rows)
+                rows = []
+
+        state['imported'] += len(rows)
+        state['completed'] = 1
+        flush(rows)
+
+    seconds = time.perf_counter() - start
+    imported = state['imported'] - previously_imported
+    rate = imported / seconds if seconds > 0 else 0.0
+    print(f"Imported {imported} observations from '{path}' in {seconds:.2f}s ({rate:,.0f} rows/sec); "
+          f"skipped {state['skipped']}.")
+    return dict(state, resumed_from=resumed_from, seconds=seconds, rows_per_sec=rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import FHIR Observations from Bundle or NDJSON files.")
+    parser.add_argument('db_name')
+    parser.add_argument('files', nargs='+', help="Bundle .json or .ndjson files, optionally gzipped")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--restart', action='store_true', help="ignore checkpoints and import from the start")
+    args = parser.parse_args()
+
+    for filename in args.files:
+        import_file(args.db_name, filename, args.batch_size, resume=not args.restart)
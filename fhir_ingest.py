@@ -0,0 +1,373 @@
+import sqlite3
+from datetime import date
+
+from fhir_fast import COMPONENT_COLUMNS, fhir_decimal
+from terminology import terminology
+
+
+# Maps FHIR Patient / Observation resources back onto the Patients and
+# sleep_observations tables, and applies batch/transaction Bundles of them
+# with one executemany per statement and shard, inside one SQLite transaction
+# per shard.
+
+PATIENT_COLUMNS = ['First_Name', 'Last_Name', 'Date_of_Birth', 'Gender', 'Phone_Number', 'Email',
+                   'Address', 'City', 'State', 'Zip_Code']
+
+VITAL_COLUMNS = [text.lower().replace(' ', '_') for text, _ in COMPONENT_COLUMNS]
+OBSERVATION_COLUMNS = ['patient_id', 'observation_date'] + VITAL_COLUMNS
+
+_COLUMN_BY_TEXT = {text: column for (text, _), column in zip(COMPONENT_COLUMNS, VITAL_COLUMNS)}
+
+
+class EntryError(ValueError):
+    # A single Bundle entry that cannot be applied; `status` is the HTTP status line
+    # reported in its transaction-response entry
+
+    def __init__(self, message, status='400 Bad Request'):
+        super().__init__(message)
+        self.status = status
+
+
+class BundleError(ValueError):
+    # The Bundle as a whole is rejected and nothing is written
+
+    def __init__(self, issues, status=400):
+        super().__init__('; '.join(issues))
+        self.issues = issues
+        self.status = status
+
+    def outcome(self):
+        return operation_outcome(self.issues)
+
+
+def operation_outcome(messages, code='invalid'):
+    return {
+        'resourceType': 'OperationOutcome',
+        'issue': [{'severity': 'error', 'code': code, 'diagnostics': message} for message in messages],
+    }
+
+
+def _has_column(conn, table, column):
+    return any(info[1] == column for info in conn.execute("PRAGMA table_info({})".format(table)))
+
+
+def _patient_id_from_reference(reference):
+    if not reference or not reference.startswith('Patient/'):
+        raise EntryError('subject must reference a Patient')
+    try:
+        return int(reference[len('Patient/'):])
+    except ValueError:
+        raise EntryError('Invalid subject reference: {}'.format(reference))
+
+
+def _component_column(component):
+    code = component.get('code') or {}
+    for coding in code.get('coding') or []:
+        text = terminology.component_text(coding.get('system'), coding.get('code'))
+        if text is not None:
+            return _COLUMN_BY_TEXT[text]
+    text = code.get('text')
+    if text == 'Observation Date':
+        return 'observation_date'
+    return _COLUMN_BY_TEXT.get(text)
+
+
+def observation_to_row(resource):
+    # Returns (subject reference, {column: value}) for a sleep Observation. The
+    # reference is resolved separately so it may point at a Patient created in
+    # the same Bundle.
+    if not isinstance(resource, dict) or resource.get('resourceType') != 'Observation':
+        raise EntryError('Expected an Observation resource')
+
+    values = {}
+    for component in resource.get('component') or []:
+        column = _component_column(component)
+        if column is None:
+            continue
+        if column == 'observation_date':
+            values[column] = _date_string(component.get('valueString'), 'Observation Date')
+            continue
+        if 'valueQuantity' in component:
+            value = (component['valueQuantity'] or {}).get('value')
+        else:
+            value = component.get('valueString')
+        try:
+            value = fhir_decimal(value)
+        except ValueError as e:
+            raise EntryError('{}: {}'.format(column, e))
+        values[column] = float(value) if value is not None else None
+
+    effective = _date_string(resource.get('effectiveDateTime'), 'effectiveDateTime')
+    if effective:
+        values['observation_date'] = effective[:10]
+    try:
+        date.fromisoformat(values.get('observation_date') or '')
+    except ValueError:
+        raise EntryError('Observation needs an effectiveDateTime (YYYY-MM-DD)')
+
+    reference = (resource.get('subject') or {}).get('reference')
+    if not reference:
+        raise EntryError('Observation needs a subject reference')
+    if not isinstance(reference, str):
+        raise EntryError('subject.reference must be a string')
+    return reference, values
+
+
+def _date_string(value, field):
+    if value is not None and not isinstance(value, str):
+        raise EntryError('{} must be a string'.format(field))
+    return value
+
+
+def patient_to_row(resource):
+    # Returns the Patients column values in PATIENT_COLUMNS order
+    if not isinstance(resource, dict) or resource.get('resourceType') != 'Patient':
+        raise EntryError('Expected a Patient resource')
+
+    name = (resource.get('name') or [{}])[0]
+    telecom = {t.get('system'): t.get('value') for t in resource.get('telecom') or []}
+    address = (resource.get('address') or [{}])[0]
+    if not name.get('family') and not name.get('given'):
+        raise EntryError('Patient needs a name')
+
+    return (
+        (name.get('given') or [None])[0],
+        name.get('family'),
+        resource.get('birthDate'),
+        resource.get('gender'),
+        telecom.get('phone'),
+        telecom.get('email'),
+        (address.get('line') or [None])[0],
+        address.get('city'),
+        address.get('state'),
+        address.get('postalCode'),
+    )
+
+
+def _patient_id_from_request(entry, resource):
+    url = (entry.get('request') or {}).get('url') or ''
+    raw = url.split('/', 1)[1] if url.startswith('Patient/') else resource.get('id')
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        raise EntryError('PUT Patient needs a numeric id')
+
+
+def _existing_observation_keys(conn, keys):
+    # Set-based lookup of which (patient_id, observation_date) keys already exist
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS batch_keys (patient_id INTEGER, observation_date TEXT)")
+    conn.execute("DELETE FROM batch_keys")
+    conn.executemany("INSERT INTO batch_keys VALUES (?, ?)", keys)
+    existing = conn.execute('''
+        SELECT k.patient_id, k.observation_date
+        FROM batch_keys k JOIN sleep_observations o
+          ON o.patient_id = k.patient_id AND o.observation_date = k.observation_date
+    ''').fetchall()
+    conn.execute("DELETE FROM batch_keys")
+    return set(existing)
+
+
+def upsert_observations(conn, rows):
+    # Inserts or replaces rows in OBSERVATION_COLUMNS order, keyed on (patient_id, observation_date)
+    conn.executemany(_upsert_statement(conn), rows)
+
+
+def _upsert_statement(conn):
+    touch = ", updated_at = CURRENT_TIMESTAMP" if _has_column(conn, 'sleep_observations', 'updated_at') else ""
+    return '''
+        INSERT INTO sleep_observations ({columns}) VALUES ({placeholders})
+        ON CONFLICT(patient_id, observation_date) DO UPDATE SET {updates}{touch}
+    '''.format(columns=', '.join(OBSERVATION_COLUMNS),
+               placeholders=', '.join('?' * len(OBSERVATION_COLUMNS)),
+               updates=', '.join('{0} = excluded.{0}'.format(c) for c in VITAL_COLUMNS),
+               touch=touch)
+
+
+def process_bundle(shards, bundle):
+    """Apply a FHIR batch or transaction Bundle of Patients and Observations.
+
+    POST creates (409 when an observation already exists for that patient and date),
+    PUT upserts on the primary key. `shards` is a shards.ShardConnections; every
+    row goes to its patient's shard and the shards commit once all entries are
+    applied, so a transaction Bundle is rolled back as a whole if any entry
+    fails. In a batch Bundle a row SQLite rejects fails only its own entry: the
+    statement is replayed with a SAVEPOINT per entry. Returns the batch-response
+    / transaction-response Bundle as a dict.
+    """
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+        raise BundleError(['Expected a Bundle resource'])
+    bundle_type = bundle.get('type')
+    if bundle_type not in ('batch', 'transaction'):
+        raise BundleError(['Bundle.type must be batch or transaction'])
+    atomic = bundle_type == 'transaction'
+
+    entries = bundle.get('entry') or []
+    if not isinstance(entries, list):
+        raise BundleError(['Bundle.entry must be a list'])
+    responses = [None] * len(entries)
+    patient_posts, patient_puts, observations = [], [], []
+
+    for i, entry in enumerate(entries):
+        entry = entry or {}
+        try:
+            if not isinstance(entry, dict) or not isinstance(entry.get('request') or {}, dict):
+                raise EntryError('Bundle entry and entry.request must be objects')
+            if not isinstance(entry.get('fullUrl') or '', str):
+                raise EntryError('entry.fullUrl must be a string')
+            resource = entry.get('resource')
+            method = ((entry.get('request') or {}).get('method') or 'POST').upper()
+            if method not in ('POST', 'PUT'):
+                raise EntryError('Unsupported request method {}'.format(method))
+            resource_type = resource.get('resourceType') if isinstance(resource, dict) else None
+            if resource_type == 'Patient':
+                row = patient_to_row(resource)
+                if method == 'PUT':
+                    patient_puts.append((i, _patient_id_from_request(entry, resource), row))
+                else:
+                    patient_posts.append((i, entry.get('fullUrl'), row))
+            elif resource_type == 'Observation':
+                reference, values = observation_to_row(resource)
+                observations.append((i, method, reference, values))
+            else:
+                raise EntryError('Unsupported resource type {}'.format(resource_type))
+        except EntryError as e:
+            responses[i] = e
+        except (AttributeError, TypeError) as e:
+            # A field of the wrong JSON type somewhere inside the resource
+            responses[i] = EntryError('Malformed entry: {}'.format(e))
+
+    def fail(i, error):
+        if atomic:
+            raise BundleError(['entry[{}]: {}'.format(i, error)], status=int(error.status.split()[0]))
+        responses[i] = error
+
+    def write_entry(conn, i, statement, params):
+        # One batch entry under its own SAVEPOINT, inside an explicit transaction
+        # so releasing it does not commit. Returns the cursor, or None when SQLite
+        # rejected the row and the entry failed.
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        conn.execute("SAVEPOINT bundle_entry")
+        try:
+            return conn.execute(statement, params)
+        except sqlite3.Error as e:
+            conn.execute("ROLLBACK TO bundle_entry")
+            responses[i] = EntryError(str(e), '500 Internal Server Error')
+            return None
+        finally:
+            conn.execute("RELEASE bundle_entry")
+
+    def write(conn, statement, entries):
+        # Runs statement for every (entry index, params) pair with one executemany.
+        # In a batch, a row SQLite rejects undoes the executemany, which is then
+        # replayed one entry at a time so only that entry fails.
+        if atomic:
+            conn.executemany(statement, [params for _, params in entries])
+            return
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        conn.execute("SAVEPOINT bundle_rows")
+        try:
+            conn.executemany(statement, [params for _, params in entries])
+        except sqlite3.Error:
+            conn.execute("ROLLBACK TO bundle_rows")
+            for i, params in entries:
+                write_entry(conn, i, statement, params)
+        finally:
+            conn.execute("RELEASE bundle_rows")
+
+    try:
+        for i, error in enumerate(responses):
+            if isinstance(error, EntryError):
+                fail(i, error)
+
+        # Patients first, so Observations can reference Patients created in this Bundle.
+        # A sharded database numbers them up front; a single file lets SQLite do it.
+        resolved = {}
+        first_id = shards.allocate_patient_ids(len(patient_posts)) if patient_posts else None
+        insert_patient = "INSERT INTO Patients (Patient_ID, {}) VALUES (?, {})".format(
+            ', '.join(PATIENT_COLUMNS), ', '.join('?' * len(PATIENT_COLUMNS)))
+        for n, (i, full_url, row) in enumerate(patient_posts):
+            patient_id = None if first_id is None else first_id + n
+            conn = shards.for_patient(patient_id)
+            if atomic:
+                cursor = conn.execute(insert_patient, (patient_id,) + row)
+            else:
+                cursor = write_entry(conn, i, insert_patient, (patient_id,) + row)
+                if cursor is None:
+                    continue
+            responses[i] = ('201 Created', 'Patient/{}'.format(cursor.lastrowid))
+            if full_url:
+                resolved[full_url] = 'Patient/{}'.format(cursor.lastrowid)
+
+        if patient_puts:
+            existing = set()
+            for conn, puts in shards.split(patient_puts, lambda put: put[1]):
+                ids = [patient_id for _, patient_id, _ in puts]
+                existing.update(row[0] for row in conn.execute(
+                    "SELECT Patient_ID FROM Patients WHERE Patient_ID IN ({})".format(', '.join('?' * len(ids))), ids))
+                touch = ", updated_at = CURRENT_TIMESTAMP" if _has_column(conn, 'Patients', 'updated_at') else ""
+                write(conn, '''
+                    INSERT INTO Patients (Patient_ID, {columns}) VALUES (?, {placeholders})
+                    ON CONFLICT(Patient_ID) DO UPDATE SET {updates}{touch}
+                '''.format(columns=', '.join(PATIENT_COLUMNS),
+                           placeholders=', '.join('?' * len(PATIENT_COLUMNS)),
+                           updates=', '.join('{0} = excluded.{0}'.format(c) for c in PATIENT_COLUMNS),
+                           touch=touch),
+                    [(i, (patient_id,) + row) for i, patient_id, row in puts])
+            shards.reserve_patient_ids(max(patient_id for _, patient_id, _ in patient_puts))
+            for i, patient_id, _ in patient_puts:
+                if isinstance(responses[i], EntryError):
+                    continue
+                status = '200 OK' if patient_id in existing else '201 Created'
+                responses[i] = (status, 'Patient/{}'.format(patient_id))
+
+        rows = []
+        for i, method, reference, values in observations:
+            try:
+                patient_id = _patient_id_from_reference(resolved.get(reference, reference))
+            except EntryError as e:
+                fail(i, e)
+                continue
+            rows.append((i, method, tuple([patient_id, values['observation_date']] +
+                                          [values.get(c) for c in VITAL_COLUMNS])))
+
+        existing = set()
+        for conn, group in shards.split(rows, lambda entry: entry[2][0]):
+            existing |= _existing_observation_keys(conn, [row[:2] for _, _, row in group])
+        inserts, upserts, seen = [], [], set()
+        for i, method, row in rows:
+            key = row[:2]
+            if method == 'POST' and (key in existing or key in seen):
+                fail(i, EntryError('Observation for Patient/{} on {} already exists'.format(*key), '409 Conflict'))
+                continue
+            (upserts if method == 'PUT' else inserts).append((i, row))
+            status = '200 OK' if key in existing or key in seen else '201 Created'
+            responses[i] = (status, 'Observation/{}-{}'.format(*key))
+            seen.add(key)
+
+        columns = ', '.join(OBSERVATION_COLUMNS)
+        placeholders = ', '.join('?' * len(OBSERVATION_COLUMNS))
+        for conn, group in shards.split(inserts, lambda entry: entry[1][0]):
+            write(conn, "INSERT INTO sleep_observations ({}) VALUES ({})".format(columns, placeholders), group)
+        for conn, group in shards.split(upserts, lambda entry: entry[1][0]):
+            write(conn, _upsert_statement(conn), group)
+
+        shards.commit()
+    except sqlite3.Error as e:
+        shards.rollback()
+        raise BundleError([str(e)], status=500)
+    except BaseException:
+        shards.rollback()
+        raise
+
+    response_entries = []
+    for response in responses:
+        if isinstance(response, EntryError):
+            response_entries.append({'response': {'status': response.status,
+                                                  'outcome': operation_outcome([str(response)])}})
+        else:
+            status, location = response
+            response_entries.append({'response': {'status': status, 'location': location}})
+
+    return {'resourceType': 'Bundle', 'type': bundle_type + '-response', 'entry': response_entries}
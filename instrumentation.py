@@ -0,0 +1,208 @@
+import bisect
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+
+# Request instrumentation: per-route latency histograms, per-stage timing spans
+# (db_fetch, build, serialize, encode), rows fetched and response bytes, rendered
+# in the Prometheus text format by metrics.render(). Also an opt-in cProfile mode
+# (?_profile=1 when PROFILING_ENABLED is set) and JSON structured logging.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_LINES = 40  # Functions listed in a ?_profile=1 report
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}  # (route, method) -> Histogram
+        self.stages = {}  # (route, stage) -> Histogram
+        self.requests = {}  # (route, method, status) -> count
+        self.rows = {}  # route -> rows fetched
+        self.response_bytes = {}  # route -> bytes sent
+
+    def record_request(self, route, method, status, seconds, size, spans, rows):
+        with self._lock:
+            self.latency.setdefault((route, method), Histogram()).observe(seconds)
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for stage, stage_seconds in spans.items():
+                self.stages.setdefault((route, stage), Histogram()).observe(stage_seconds)
+            self.rows[route] = self.rows.get(route, 0) + rows
+            if size is not None:
+                self.response_bytes[route] = self.response_bytes.get(route, 0) + size
+
+    def clear(self):
+        with self._lock:
+            self.latency.clear()
+            self.stages.clear()
+            self.requests.clear()
+            self.rows.clear()
+            self.response_bytes.clear()
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        with self._lock:
+            _histogram_lines(lines, 'fhir_request_duration_seconds', 'Request latency by route.',
+                             self.latency, ('route', 'method'))
+            _histogram_lines(lines, 'fhir_stage_duration_seconds', 'Time spent per request stage.',
+                             self.stages, ('route', 'stage'))
+            _counter_lines(lines, 'fhir_requests_total', 'Requests by route and status.',
+                           self.requests, ('route', 'method', 'status'))
+            _counter_lines(lines, 'fhir_rows_fetched_total', 'Database rows fetched by route.',
+                           {(route,): value for route, value in self.rows.items()}, ('route',))
+            _counter_lines(lines, 'fhir_response_bytes_total', 'Response body bytes by route.',
+                           {(route,): value for route, value in self.response_bytes.items()}, ('route',))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _histogram_lines(lines, name, help_text, histograms, label_names):
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} histogram'.format(name))
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, _labels(label_names, key, [('le', bound)]), cumulative))
+        lines.append('{}_sum{} {!r}'.format(name, _labels(label_names, key), histogram.sum))
+        lines.append('{}_count{} {}'.format(name, _labels(label_names, key), histogram.count))
+
+
+def _counter_lines(lines, name, help_text, counters, label_names):
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} counter'.format(name))
+    for key, value in sorted(counters.items()):
+        lines.append('{}{} {}'.format(name, _labels(label_names, key), value))
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def span(stage):
+    # Times the enclosed block as one stage of the current request; repeated
+    # spans of the same stage add up. A no-op outside a request.
+    if not has_request_context() or 'instrumentation_spans' not in g:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans = g.instrumentation_spans
+        spans[stage] = spans.get(stage, 0.0) + time.perf_counter() - start
+
+
+def record_rows(count):
+    # Adds database rows fetched by the current request
+    if has_request_context() and 'instrumentation_spans' in g:
+        g.instrumentation_rows += count
+
+
+def _profiling_requested(app):
+    return app.config.get('PROFILING_ENABLED') and request.args.get('_profile', '').lower() in ('1', 'true')
+
+
+def init_app(app):
+    # Times every request, adds 'encode' spans around JSON responses and serves
+    # ?_profile=1 reports when PROFILING_ENABLED is set
+    app.config.setdefault('PROFILING_ENABLED', os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true'))
+
+    class TimedJSONProvider(type(app.json)):
+        def response(self, *args, **kwargs):
+            with span('encode'):
+                return super().response(*args, **kwargs)
+
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_request():
+        g.instrumentation_start = time.perf_counter()
+        g.instrumentation_spans = {}
+        g.instrumentation_rows = 0
+        if _profiling_requested(app):
+            g.instrumentation_profile = cProfile.Profile()
+            g.instrumentation_profile.enable()
+
+    @app.after_request
+    def finish_request(response):
+        profile = g.pop('instrumentation_profile', None)
+        if profile is not None:
+            profile.disable()
+            report = io.StringIO()
+            stats = pstats.Stats(profile, stream=report)
+            stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+            response = app.response_class(report.getvalue(), mimetype='text/plain')
+
+        if 'instrumentation_start' in g:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            size = None if response.is_streamed else response.calculate_content_length()
+            metrics.record_request(route, request.method, response.status_code,
+                                   time.perf_counter() - g.instrumentation_start, size,
+                                   g.instrumentation_spans, g.instrumentation_rows)
+        return response
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line: time, level, logger, event plus the event's fields
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + '.{:03d}Z'.format(int(record.msecs)),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+
+def get_logger(name):
+    # Logger writing JSON lines to stderr, at LOG_LEVEL (default INFO)
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+        logger.propagate = False
+    return logger
+
+
+def log_event(logger, level, event, **fields):
+    logger.log(level, event, extra={'fields': fields})
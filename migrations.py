@@ -0,0 +1,336 @@
+import argparse
+import sqlite3
+
+from db_pool import connection
+from fhir_fast import OBSERVATION_ROW_COLUMNS
+from rollups import create_rollup_schema, rebuild as rebuild_rollups
+
+
+# Versioned schema migrations for the sleep database. Each migration is
+# (version, name, apply(conn), plan_checks); the versions applied so far are
+# recorded in schema_version. plan_checks are (query, params, expected, forbidden)
+# tuples asserting which index EXPLAIN QUERY PLAN reports for the query shapes the
+# migration was written for - see verify_query_plans().
+
+OBSERVATION_SELECT = ', '.join(OBSERVATION_ROW_COLUMNS)
+
+
+def _columns(conn, table):
+    return [info[1] for info in conn.execute("PRAGMA table_info({})".format(table))]
+
+
+def _base_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS Patients (
+        Patient_ID INTEGER PRIMARY KEY,
+        First_Name TEXT,
+        Last_Name TEXT,
+        Date_of_Birth DATE,
+        Gender TEXT,
+        Phone_Number TEXT,
+        Email TEXT,
+        Address TEXT,
+        City TEXT,
+        State TEXT,
+        Zip_Code TEXT
+    )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sleep_observations (
+            patient_id INTEGER,
+            snoring_rate REAL,
+            respiratory_rate REAL,
+            body_temperature REAL,
+            limb_movement REAL,
+            blood_oxygen REAL,
+            eye_movement REAL,
+            sleeping_hours REAL,
+            heart_rate INTEGER,
+            stress_level INTEGER,
+            observation_date TEXT,
+            PRIMARY KEY (patient_id, observation_date)
+        )
+    ''')
+
+
+def _change_tracking(conn):
+    # Tables created before updated_at existed get the column plus triggers that
+    # stamp inserts and updates; SQLite cannot ALTER in a CURRENT_TIMESTAMP default.
+    for table, key in (('Patients', 'Patient_ID = NEW.Patient_ID'),
+                       ('sleep_observations', 'patient_id = NEW.patient_id AND observation_date = NEW.observation_date')):
+        if 'updated_at' not in _columns(conn, table):
+            conn.execute("ALTER TABLE {} ADD COLUMN updated_at TEXT".format(table))
+            conn.execute("UPDATE {} SET updated_at = CURRENT_TIMESTAMP".format(table))
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS {0}_stamp_insert AFTER INSERT ON {0}
+            WHEN NEW.updated_at IS NULL
+            BEGIN
+                UPDATE {0} SET updated_at = CURRENT_TIMESTAMP WHERE {1};
+            END
+        '''.format(table, key))
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS {0}_stamp_update AFTER UPDATE ON {0}
+            WHEN NEW.updated_at IS OLD.updated_at
+            BEGIN
+                UPDATE {0} SET updated_at = CURRENT_TIMESTAMP WHERE {1};
+            END
+        '''.format(table, key))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_updated_at ON Patients (updated_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sleep_observations_updated_at ON sleep_observations (updated_at)")
+
+
+def _observation_covering_index(conn):
+    # Serves the paged, date-filtered and latest-N reads entirely from the index
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sleep_observations_patient_date
+        ON sleep_observations (patient_id, observation_date DESC, {})
+    '''.format(', '.join(c for c in OBSERVATION_ROW_COLUMNS if c not in ('patient_id', 'observation_date'))))
+
+
+def _patient_name_index(conn):
+    # Patient_ID is the rowid, so this also covers the /fhir/names listing
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_name ON Patients (Last_Name, First_Name)")
+
+
+def _import_checkpoints(conn):
+    # Resume points of fhir_import.py, written in the same transaction as each batch
+    conn.execute('''CREATE TABLE IF NOT EXISTS import_checkpoints (
+        source TEXT PRIMARY KEY,
+        fingerprint TEXT,
+        position INTEGER,
+        resources INTEGER,
+        imported INTEGER,
+        skipped INTEGER,
+        completed INTEGER DEFAULT 0,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+def _write_queue_state(conn):
+    # Last committed journal sequence of each write_queue.py journal
+    conn.execute('''CREATE TABLE IF NOT EXISTS write_queue_state (
+        journal TEXT PRIMARY KEY,
+        committed_seq INTEGER NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+def _fts5_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("DROP TABLE temp.fts5_probe")
+    return True
+
+
+def _patient_search_index(conn):
+    # FTS5 index for patient_search.py over the names and contact details,
+    # stored as an external-content table over Patients and kept in sync by
+    # triggers. Without FTS5, patient_search.py falls back to LIKE.
+    if not _fts5_available(conn):
+        print("SQLite has no FTS5; patient search will scan the Patients table")
+        return
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+            First_Name, Last_Name, Email, Phone_Number,
+            content='Patients', content_rowid='Patient_ID',
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+        )
+    ''')
+    columns = 'First_Name, Last_Name, Email, Phone_Number'
+    old_values = 'OLD.First_Name, OLD.Last_Name, OLD.Email, OLD.Phone_Number'
+    new_values = 'NEW.First_Name, NEW.Last_Name, NEW.Email, NEW.Phone_Number'
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON Patients BEGIN
+            INSERT INTO patients_fts (rowid, {0}) VALUES (NEW.Patient_ID, {1});
+        END
+    '''.format(columns, new_values))
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON Patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, {0}) VALUES ('delete', OLD.Patient_ID, {1});
+        END
+    '''.format(columns, old_values))
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE OF Patient_ID, {0} ON Patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, {0}) VALUES ('delete', OLD.Patient_ID, {1});
+            INSERT INTO patients_fts (rowid, {0}) VALUES (NEW.Patient_ID, {2});
+        END
+    '''.format(columns, old_values, new_values))
+    conn.execute("INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')")
+
+
+def _sleep_rollups(conn):
+    # Daily/weekly/monthly rollups maintained by triggers (see rollups.py), backfilled here
+    create_rollup_schema(conn)
+    rebuild_rollups(conn)
+
+
+# Tables whose writes bump the patient's row in patient_versions, with the column naming the patient
+VERSIONED_TABLES = [('Patients', 'Patient_ID'), ('sleep_observations', 'patient_id')]
+
+
+def _bump_version(row, key, condition='1'):
+    return '''
+        INSERT INTO patient_versions (patient_id, version) SELECT {0}.{1}, 1 WHERE {0}.{1} IS NOT NULL AND {2}
+        ON CONFLICT(patient_id) DO UPDATE SET version = version + 1;
+    '''.format(row, key, condition)
+
+
+def create_version_triggers(conn):
+    for table, key in VERSIONED_TABLES:
+        conn.execute("CREATE TRIGGER IF NOT EXISTS {0}_version_insert AFTER INSERT ON {0} BEGIN {1} END".format(
+            table, _bump_version('NEW', key)))
+        conn.execute("CREATE TRIGGER IF NOT EXISTS {0}_version_update AFTER UPDATE ON {0} BEGIN {1} {2} END".format(
+            table, _bump_version('NEW', key),
+            _bump_version('OLD', key, 'OLD.{0} IS NOT NEW.{0}'.format(key))))  # Moved to another patient
+        conn.execute("CREATE TRIGGER IF NOT EXISTS {0}_version_delete AFTER DELETE ON {0} BEGIN {1} END".format(
+            table, _bump_version('OLD', key)))
+
+
+def drop_version_triggers(conn):
+    # For bulk copies into a fresh file, whose versions may start over
+    for table, _ in VERSIONED_TABLES:
+        for event in ('insert', 'update', 'delete'):
+            conn.execute("DROP TRIGGER IF EXISTS {}_version_{}".format(table, event))
+
+
+def _patient_versions(conn):
+    # A write counter per patient, bumped by triggers inside every writing
+    # transaction, whoever writes. The response cache checks its entries against
+    # it (shards.patient_version), so a write only makes that patient's entries stale.
+    conn.execute('''CREATE TABLE IF NOT EXISTS patient_versions (
+        patient_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL
+    )''')
+    create_version_triggers(conn)
+
+
+MIGRATIONS = [
+    (1, 'base schema', _base_schema, []),
+    (2, 'change tracking', _change_tracking, [
+        ("SELECT * FROM sleep_observations WHERE updated_at >= ?", ('2024-01-01 00:00:00',),
+         'idx_sleep_observations_updated_at', None),
+        ("SELECT * FROM Patients WHERE updated_at >= ?", ('2024-01-01 00:00:00',),
+         'idx_patients_updated_at', None),
+    ]),
+    (3, 'covering observation index', _observation_covering_index, [
+        ("SELECT {} FROM sleep_observations WHERE patient_id = ? AND body_temperature is not null "
+         "ORDER BY observation_date DESC LIMIT ?".format(OBSERVATION_SELECT), (1, 100),
+         'COVERING INDEX idx_sleep_observations_patient_date', 'TEMP B-TREE'),
+        ("SELECT {} FROM sleep_observations WHERE patient_id = ? AND body_temperature is not null "
+         "AND observation_date >= ? AND observation_date <= ? ORDER BY observation_date LIMIT ?".format(OBSERVATION_SELECT),
+         (1, '2023-01-01', '2023-12-31', 100),
+         'COVERING INDEX idx_sleep_observations_patient_date', 'TEMP B-TREE'),
+        ("SELECT observation_date FROM sleep_observations WHERE patient_id = ? ORDER BY observation_date", (1,),
+         'COVERING INDEX', 'TEMP B-TREE'),
+    ]),
+    (4, 'patient name index', _patient_name_index, [
+        ("SELECT Patient_ID, First_Name, Last_Name FROM Patients", (),
+         'COVERING INDEX idx_patients_name', None),
+        ("SELECT Patient_ID, First_Name, Last_Name FROM Patients WHERE Last_Name = ?", ('Doe',),
+         'COVERING INDEX idx_patients_name', None),
+    ]),
+    (5, 'import checkpoints', _import_checkpoints, []),
+    (6, 'write queue state', _write_queue_state, []),
+    (7, 'patient search index', _patient_search_index, [
+        ("SELECT p.Patient_ID, p.First_Name, p.Last_Name FROM Patients p "
+         "ORDER BY p.Last_Name, p.First_Name, p.Patient_ID LIMIT ? OFFSET ?", (20, 0),
+         'COVERING INDEX idx_patients_name', 'TEMP B-TREE'),
+    ]),
+    (8, 'sleep rollups', _sleep_rollups, [
+        ("SELECT period_start, nights FROM sleep_rollups WHERE period = ? AND patient_id = ? "
+         "AND period_start >= ? AND period_start <= ? ORDER BY period_start", ('week', 1, '2023-01-02', '2023-12-25'),
+         'PRIMARY KEY', 'TEMP B-TREE'),
+        ("SELECT period_start, COUNT(*), SUM(nights) FROM sleep_rollups WHERE period = ? "
+         "AND period_start >= ? AND period_start <= ? GROUP BY period_start ORDER BY period_start",
+         ('month', '2023-01-01', '2023-12-01'), 'idx_sleep_rollups_period_start', 'TEMP B-TREE'),
+    ]),
+    (9, 'patient versions', _patient_versions, [
+        ("SELECT version FROM patient_versions WHERE patient_id = ?", (1,), 'INTEGER PRIMARY KEY', None),
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_version_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.commit()
+
+
+def current_version(conn):
+    _ensure_version_table(conn)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def apply_migrations(db_name, target=LATEST_VERSION):
+    # Applies pending migrations up to `target`, each in its own transaction, and
+    # returns the versions applied. Safe to run from several processes at once:
+    # the write lock is taken before the version is re-read.
+    applied = []
+    with connection(db_name) as conn:
+        _ensure_version_table(conn)
+        for version, name, apply, _ in MIGRATIONS:
+            if version > target:
+                break
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                    conn.rollback()
+                    continue
+                apply(conn)
+                conn.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            applied.append(version)
+            print(f"Applied migration {version}: {name}")
+        if applied:
+            conn.execute("PRAGMA optimize")
+    return applied
+
+
+def explain_query_plan(conn, query, params=()):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+
+
+def verify_query_plans():
+    # Applies every migration to a scratch in-memory database and checks each
+    # migration's EXPLAIN QUERY PLAN assertions against the schema as of that
+    # migration. Raises AssertionError on a mismatch; returns the number of plans checked.
+    # A scratch database keeps the plans free of the statistics of any real data.
+    checked = 0
+    conn = sqlite3.connect(':memory:')
+    try:
+        for version, name, apply, plan_checks in MIGRATIONS:
+            apply(conn)
+            for query, params, expected, forbidden in plan_checks:
+                plan = ' | '.join(explain_query_plan(conn, query, params))
+                if expected not in plan:
+                    raise AssertionError("migration {} ({}): expected '{}' in plan for {!r}, got: {}".format(
+                        version, name, expected, query, plan))
+                if forbidden is not None and forbidden in plan:
+                    raise AssertionError("migration {} ({}): unexpected '{}' in plan for {!r}, got: {}".format(
+                        version, name, forbidden, query, plan))
+                checked += 1
+    finally:
+        conn.close()
+    return checked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply schema migrations to a sleep database.")
+    parser.add_argument('db_name')
+    parser.add_argument('--target', type=int, default=LATEST_VERSION)
+    parser.add_argument('--verify', action='store_true', help="check the migrations' EXPLAIN QUERY PLAN assertions")
+    args = parser.parse_args()
+
+    apply_migrations(args.db_name, args.target)
+    with connection(args.db_name) as conn:
+        print(f"Schema version: {current_version(conn)}")
+    if args.verify:
+        print(f"{verify_query_plans()} query plans verified.")
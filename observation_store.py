@@ -0,0 +1,238 @@
+from collections import namedtuple
+
+import numpy as np
+
+from fhir_fast import OBSERVATION_ROW_COLUMNS
+
+
+# Compact columnar storage for one patient's sleep observations. Instead of a
+# list of wide tuples (a tuple, a float object per vital and a date string per
+# night, several hundred bytes each) every vital is one float64 NumPy array with
+# NaN for NULL and the dates are one int32 array of days since 1970-01-01, so a
+# night costs 76 bytes. Slicing by position or date range returns a store over
+# views of the same arrays.
+#
+# Iterating a store yields ObservationRow namedtuples in the row layout of
+# read_patient_sleep_data (obs[0] ... obs[10], also readable by name), with the
+# values SQLite would have returned, so the Bundle builders and serializers take
+# a store wherever they take a list of rows.
+
+ObservationRow = namedtuple('ObservationRow', OBSERVATION_ROW_COLUMNS)
+
+VALUE_COLUMNS = OBSERVATION_ROW_COLUMNS[1:-1]
+# Columns with INTEGER affinity in sleep_observations: whole numbers come back as int
+INTEGER_COLUMNS = frozenset(['heart_rate', 'stress_level'])
+
+MISSING_DAY = np.iinfo(np.int32).min  # Day of a row whose observation_date is not a date
+FETCH_ROWS = 10000
+
+_EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def to_day(value):
+    # 'YYYY-MM-DD' (or a date) to days since 1970-01-01
+    return int((np.datetime64(value, 'D') - _EPOCH).astype(np.int64))
+
+
+def _float_column(values, column, offset, raw):
+    # float64 array of one column; values SQLite left as text are kept in `raw`
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        array = np.empty(len(values), dtype=np.float64)
+        for i, value in enumerate(values):
+            if value is None:
+                array[i] = np.nan
+            elif isinstance(value, (int, float)):
+                array[i] = value
+            else:
+                array[i] = np.nan
+                raw[(offset + i, column)] = value
+        return array
+
+
+def _day_column(values, offset, raw):
+    # int32 epoch days; anything that is not exactly 'YYYY-MM-DD' is kept in `raw`
+    text = np.array([value if isinstance(value, str) else '' for value in values])
+    try:
+        days = text.astype('datetime64[D]')
+        exact = days.astype(str) == text
+    except ValueError:
+        days = np.empty(len(values), dtype='datetime64[D]')
+        exact = np.zeros(len(values), dtype=bool)
+        for i, value in enumerate(text.tolist()):
+            try:
+                days[i] = np.datetime64(value, 'D')
+                exact[i] = str(days[i]) == value
+            except ValueError:
+                pass
+    result = np.where(exact, (days - _EPOCH).astype(np.int64), MISSING_DAY).astype(np.int32)
+    for i in np.flatnonzero(~exact).tolist():
+        raw[(offset + i, 'observation_date')] = values[i]
+    return result
+
+
+class ObservationStore:
+    __slots__ = ('patient_id', 'day') + tuple(VALUE_COLUMNS) + ('_raw', '_ordered')
+
+    def __init__(self, patient_id, day, columns, raw=None, ordered=None):
+        # `columns` maps every VALUE_COLUMNS name to a float64 array as long as `day`;
+        # `raw` holds {(row, column): value} for values no array can represent
+        self.patient_id = patient_id
+        self.day = day
+        for name in VALUE_COLUMNS:
+            setattr(self, name, columns[name])
+        self._raw = raw or {}
+        if ordered is None:
+            ordered = not (day == MISSING_DAY).any() and bool((np.diff(day) >= 0).all())
+        self._ordered = ordered
+
+    @classmethod
+    def from_cursor(cls, cursor, patient_id=None):
+        """Build a store from a cursor over OBSERVATION_SELECT rows of one patient.
+
+        Rows are fetched in chunks and converted column by column, so the wide
+        tuples never all exist at once. Raises ValueError if the rows belong to
+        more than one patient.
+        """
+        return cls._from_chunks(iter(lambda: cursor.fetchmany(FETCH_ROWS), []), patient_id)
+
+    @classmethod
+    def from_rows(cls, rows, patient_id=None):
+        # Same as from_cursor for an already fetched list of rows
+        return cls._from_chunks([rows] if rows else [], patient_id)
+
+    @classmethod
+    def _from_chunks(cls, chunks, patient_id):
+        raw = {}
+        offset = 0
+        days = []
+        values = {name: [] for name in VALUE_COLUMNS}
+        for rows in chunks:
+            columns = list(zip(*rows))
+            for value in set(columns[0]):
+                if patient_id is None:
+                    patient_id = value
+                elif value != patient_id:
+                    raise ValueError('rows of patients {} and {} in one store'.format(patient_id, value))
+            for i, name in enumerate(VALUE_COLUMNS, 1):
+                values[name].append(_float_column(columns[i], name, offset, raw))
+            days.append(_day_column(columns[-1], offset, raw))
+            offset += len(rows)
+
+        def joined(parts, dtype):
+            if len(parts) == 1:
+                return parts[0]
+            return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+        return cls(patient_id, joined(days, np.int32),
+                   {name: joined(parts, np.float64) for name, parts in values.items()}, raw)
+
+    def __len__(self):
+        return len(self.day)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('only contiguous slices are supported')
+            return self._slice(start, stop)
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('observation index out of range')
+        return next(self._rows(index, index + 1))
+
+    def __iter__(self):
+        return self._rows(0, len(self))
+
+    def __repr__(self):
+        return '<ObservationStore patient {} with {} observations>'.format(self.patient_id, len(self))
+
+    def _slice(self, start, stop):
+        raw = {(row - start, column): value for (row, column), value in self._raw.items() if start <= row < stop}
+        return ObservationStore(self.patient_id, self.day[start:stop],
+                                {name: getattr(self, name)[start:stop] for name in VALUE_COLUMNS},
+                                raw, self._ordered)
+
+    def between(self, start=None, end=None):
+        """Observations dated from `start` to `end` inclusive (dates or 'YYYY-MM-DD').
+
+        The result shares this store's arrays unless rows with unparseable dates
+        broke the date order. Rows without a valid date are never included.
+        """
+        low = np.iinfo(np.int32).min + 1 if start is None else to_day(start)
+        high = np.iinfo(np.int32).max if end is None else to_day(end)
+        if self._ordered:
+            return self._slice(int(np.searchsorted(self.day, low, 'left')),
+                               int(np.searchsorted(self.day, high, 'right')))
+        # Rows out of date order (only possible with unparseable dates): copy the matches
+        indices = np.flatnonzero((self.day >= low) & (self.day <= high))
+        raw = {}
+        for new, row in enumerate(indices.tolist()):
+            for column in OBSERVATION_ROW_COLUMNS:
+                if (row, column) in self._raw:
+                    raw[(new, column)] = self._raw[(row, column)]
+        return ObservationStore(self.patient_id, self.day[indices],
+                                {name: getattr(self, name)[indices] for name in VALUE_COLUMNS}, raw)
+
+    def _column_values(self, name, start, stop):
+        array = getattr(self, name)[start:stop]
+        missing = np.isnan(array)
+        if not missing.any() and name not in INTEGER_COLUMNS:
+            return array.tolist()
+        if name in INTEGER_COLUMNS:
+            whole = ~missing & (array == np.trunc(array))
+            if whole.all():
+                return array.astype(np.int64).tolist()
+            values = array.astype(object)
+            values[whole] = array[whole].astype(np.int64).astype(object)
+        else:
+            values = array.astype(object)
+        values[missing] = None
+        return values.tolist()
+
+    def _rows(self, start, stop):
+        # Materializes rows [start, stop) column by column, then zips them
+        columns = [[self.patient_id] * (stop - start)]
+        columns.extend(self._column_values(name, start, stop) for name in VALUE_COLUMNS)
+        days = self.day[start:stop]
+        dates = (days.astype(np.int64) + _EPOCH).astype(str).astype(object)
+        dates[days == MISSING_DAY] = None
+        columns.append(dates.tolist())
+        for (row, column), value in self._raw.items():
+            if start <= row < stop:
+                columns[OBSERVATION_ROW_COLUMNS.index(column)][row - start] = value
+        return map(ObservationRow._make, zip(*columns))
+
+    def dates(self):
+        # observation_date strings, as stored
+        return [row.observation_date for row in self] if self._raw else \
+            (self.day.astype(np.int64) + _EPOCH).astype(str).tolist()
+
+    def columns(self):
+        """Arrays in the layout of sleep_analytics.load_columns.
+
+        Views of this store's arrays when every row has a valid date; rows
+        without one are left out, as load_columns does.
+        """
+        valid = self.day != MISSING_DAY
+        select = slice(None) if valid.all() else valid
+        result = {'patient_id': np.full(int(valid.sum()), self.patient_id, dtype=np.int64),
+                  'day': self.day[select]}
+        for name in VALUE_COLUMNS:
+            result[name] = getattr(self, name)[select]
+        return result
+
+    def nbytes(self):
+        return self.day.nbytes + sum(getattr(self, name).nbytes for name in VALUE_COLUMNS)
+
+
+def combined_columns(stores):
+    # load_columns-style arrays over several stores, ordered by patient and date
+    parts = [store.columns() for store in sorted(stores, key=lambda store: store.patient_id)]
+    if not parts:
+        return {name: np.empty(0, dtype=np.float64 if name in VALUE_COLUMNS else np.int64)
+                for name in ['patient_id', 'day'] + VALUE_COLUMNS}
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
@@ -0,0 +1,96 @@
+import heapq
+import itertools
+import re
+
+from db_pool import connection
+from shards import fan_out, shard_paths
+
+
+# Typeahead search over Patients. Migration 7 builds patients_fts, an FTS5 index
+# over the names, Email and Phone_Number kept in sync by triggers on Patients
+# (so every write path, including bulk loads and Bundles, updates it). The
+# query is split into words and every word must prefix-match a word of one of
+# the searched columns: "jo do" finds "John Doe", "555-01" finds "555-0123" and
+# "john.d" finds "john.doe@example.com". Results are ordered by name.
+#
+# Where SQLite was built without FTS5 the migration skips the index and the
+# same matching is done with LIKE over a table scan. On a sharded database every
+# shard returns its first offset + limit + 1 matches and the pages are merged by
+# name.
+
+SEARCH_COLUMNS = ['First_Name', 'Last_Name', 'Email', 'Phone_Number']
+NAME_COLUMNS = ['First_Name', 'Last_Name']
+
+_fts_databases = set()  # Databases known to have patients_fts; emptied by shards.reset_routers()
+
+
+def query_terms(text):
+    # Lower-cased words of a search string, split like the unicode61 tokenizer does
+    return re.findall(r'[^\W_]+', (text or '').lower())
+
+
+def match_expression(terms, columns):
+    # FTS5 query: every term is a prefix of a token in one of `columns`
+    return '{{{}}}: ({})'.format(' '.join(columns), ' AND '.join('"{}"*'.format(term) for term in terms))
+
+
+def reset_fts_cache():
+    # Called whenever database files may have been replaced, e.g. by a rebuild or rebalance
+    _fts_databases.clear()
+
+
+def _has_fts(conn, db_name):
+    # Only a hit is remembered: the migration may still be about to run
+    if db_name not in _fts_databases and conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'").fetchone():
+        _fts_databases.add(db_name)
+    return db_name in _fts_databases
+
+
+def search_patients(db_name, text, limit, offset=0, columns=SEARCH_COLUMNS, select='Patient_ID, First_Name, Last_Name'):
+    """Return (rows, has_more) for one page of patients matching `text`.
+
+    `select` lists the Patients columns returned. An empty search lists every
+    patient by name, which the name index serves without sorting.
+    """
+    terms = query_terms(text)
+    select = ', '.join('p.' + column.strip() for column in select.split(','))
+
+    if len(shard_paths(db_name)) == 1:
+        rows = _search_shard(db_name, terms, columns, select, limit + 1, offset)
+    else:
+        # The sort key rides along after the selected columns
+        pages = fan_out(db_name, _search_shard, terms, columns,
+                        select + ', p.Last_Name, p.First_Name, p.Patient_ID', offset + limit + 1, 0)
+        merged = heapq.merge(*pages, key=lambda row: tuple((value is not None, value) for value in row[-3:]))
+        rows = [row[:-3] for row in itertools.islice(merged, offset, offset + limit + 1)]
+
+    return rows[:limit], len(rows) > limit
+
+
+def _search_shard(shard, terms, columns, select, limit, offset):
+    # Up to `limit` matching rows of one database file, in name order
+    order = "ORDER BY p.Last_Name, p.First_Name, p.Patient_ID LIMIT ? OFFSET ?"
+    with connection(shard) as conn:
+        if not terms:
+            query = "SELECT {} FROM Patients p {}".format(select, order)
+            params = []
+        elif _has_fts(conn, shard):
+            query = '''
+                SELECT {} FROM patients_fts JOIN Patients p ON p.Patient_ID = patients_fts.rowid
+                WHERE patients_fts MATCH ? {}
+            '''.format(select, order)
+            params = [match_expression(terms, columns)]
+        else:
+            # No FTS5: a term matches the start of a column or of a word within it
+            conditions = []
+            params = []
+            for term in terms:
+                conditions.append('(' + ' OR '.join(
+                    "p.{0} LIKE ? OR p.{0} LIKE ? OR p.{0} LIKE ? OR p.{0} LIKE ? OR p.{0} LIKE ?".format(column)
+                    for column in columns) + ')')
+                for _ in columns:
+                    params.extend([term + '%', '% ' + term + '%', '%-' + term + '%', '%.' + term + '%',
+                                   '%@' + term + '%'])
+            query = "SELECT {} FROM Patients p WHERE {} {}".format(select, ' AND '.join(conditions), order)
+        return conn.execute(query, params + [limit, offset]).fetchall()
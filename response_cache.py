@@ -0,0 +1,173 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import current_app, has_request_context, request
+
+
+# In-process cache of rendered FHIR read responses, keyed by resource type,
+# patient and request path. Entries are evicted least-recently-used once the
+# cached bodies exceed `max_bytes`, expire after `ttl` seconds, and are dropped
+# by the write paths through invalidate_patient() / invalidate_resource().
+# Those only see this process's writes, so with a `validator` every entry also
+# records a token of the database state it was built from, e.g. the patient's
+# write counter, and is dropped as stale once the token changes.
+
+
+class CacheEntry:
+    __slots__ = ('body', 'mimetype', 'etag', 'last_modified', 'expires', 'size', 'patient_id', 'resource_type',
+                 'version')
+
+    def __init__(self, body, mimetype, patient_id, resource_type, ttl, version=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        self.expires = time.monotonic() + ttl
+        self.size = len(body)
+        self.patient_id = patient_id
+        self.resource_type = resource_type
+        self.version = version
+
+    def to_response(self):
+        response = current_app.response_class(self.body, mimetype=self.mimetype)
+        response.set_etag(self.etag)
+        response.last_modified = self.last_modified
+        response.headers['Cache-Control'] = 'no-cache'  # Clients revalidate with If-None-Match
+        return response.make_conditional(request)
+
+
+class ResponseCache:
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300, validator=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.validator = validator  # validator(patient_id, resource_type) -> token of the data read
+        self._entries = OrderedDict()
+        self._keys_by_patient = {}
+        self._keys_by_resource = {}
+        # Bumped on every invalidation so a response built from data read before
+        # a write is not cached after it
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def generation(self, patient_id, resource_type):
+        with self._lock:
+            return (self._generations.get(('patient', patient_id), 0),
+                    self._generations.get(('resource', resource_type), 0))
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is not None and entry.version != version:
+                self._remove(key)  # Written to since, possibly by another process
+                self.stale += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry, generation):
+        with self._lock:
+            if generation != (self._generations.get(('patient', entry.patient_id), 0),
+                              self._generations.get(('resource', entry.resource_type), 0)):
+                return
+            if entry.size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.bytes += entry.size
+            self._keys_by_patient.setdefault(entry.patient_id, set()).add(key)
+            self._keys_by_resource.setdefault(entry.resource_type, set()).add(key)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+        self._keys_by_patient.get(entry.patient_id, set()).discard(key)
+        self._keys_by_resource.get(entry.resource_type, set()).discard(key)
+
+    def invalidate_patient(self, patient_id, resource_types=None):
+        # Drops the patient's cached responses, optionally only those of `resource_types`
+        with self._lock:
+            self._generations[('patient', patient_id)] = self._generations.get(('patient', patient_id), 0) + 1
+            for key in list(self._keys_by_patient.get(patient_id, ())):
+                if resource_types is None or self._entries[key].resource_type in resource_types:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def invalidate_resource(self, resource_type):
+        # Drops every cached response of one resource type, e.g. the patient name list
+        with self._lock:
+            self._generations[('resource', resource_type)] = self._generations.get(('resource', resource_type), 0) + 1
+            for key in list(self._keys_by_resource.get(resource_type, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            for key in list(self._entries):
+                self._remove(key)
+            self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'stale': self.stale,
+            }
+
+    def cached(self, resource_type):
+        # Route decorator: serves 200 responses from the cache and answers
+        # conditional GETs with 304. Calls outside a request go straight through.
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if not has_request_context() or request.method != 'GET':
+                    return view(*args, **kwargs)
+
+                patient_id = kwargs.get('patient_id')
+                key = (resource_type, patient_id, request.full_path)
+                # Taken before the view reads, so a concurrent write leaves the entry stale
+                version = None if self.validator is None else self.validator(patient_id, resource_type)
+                entry = self.get(key, version)
+                if entry is None:
+                    generation = self.generation(patient_id, resource_type)
+                    response = current_app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    entry = CacheEntry(response.get_data(), response.mimetype, patient_id, resource_type, self.ttl,
+                                       version)
+                    self.put(key, entry, generation)
+                return entry.to_response()
+            return wrapper
+        return decorator
@@ -0,0 +1,283 @@
+import argparse
+import math
+import time
+from datetime import date
+
+from db_pool import connection
+from fhir_ingest import VITAL_COLUMNS
+from shards import fan_out, migrate, shard_for, shard_paths
+
+
+# Materialized per-patient daily, weekly and monthly rollups of
+# sleep_observations. For every vital a rollup row keeps the count of non-NULL
+# values, their sum, sum of squares, min and max, so means and standard
+# deviations can be derived and rollups can be combined across patients.
+#
+# Triggers created by migration 8 keep sleep_rollups in step with every write
+# path, inside the writing transaction: an insert is folded into its day, week
+# and month incrementally, while a delete or update recomputes the affected
+# buckets from the observations (at most a month of one patient's rows, read
+# through the primary key), since a min or max cannot be un-applied. Rollups are
+# per patient, so they shard with the observations; cohort queries combine the
+# shards' totals. A full or per-patient backfill is
+#
+#   python rollups.py sleep_data.db --rebuild [--patient 42]
+
+ROLLUP_VITALS = VITAL_COLUMNS
+STATS = ('count', 'sum', 'sumsq', 'min', 'max')
+
+# period -> (SQL for the start of the period containing a date, step to the next period)
+PERIODS = {
+    'day': ("date({})", '+1 day'),
+    'week': ("date({}, '-6 days', 'weekday 1')", '+7 days'),  # Weeks start on Monday
+    'month': ("date({}, 'start of month')", '+1 month'),
+}
+
+ROLLUP_COLUMNS = ['period', 'patient_id', 'period_start', 'nights'] + [
+    '{}_{}'.format(vital, stat) for vital in ROLLUP_VITALS for stat in STATS]
+
+
+def period_start(period, value):
+    # Start of the `period` containing `value` (a date or 'YYYY-MM-DD'), as 'YYYY-MM-DD'
+    day = value if isinstance(value, date) else date.fromisoformat(value)
+    if period == 'week':
+        return date.fromordinal(day.toordinal() - day.weekday()).isoformat()
+    if period == 'month':
+        return day.replace(day=1).isoformat()
+    return day.isoformat()
+
+
+def _number(column):
+    # Text that SQLite could not convert is not a measurement
+    return "CASE WHEN typeof({0}) IN ('integer', 'real') THEN {0} END".format(column)
+
+
+def _aggregate_select(period, where):
+    # INSERT ... SELECT of the rollups of the observations matching `where`
+    bucket = PERIODS[period][0].format('observation_date')
+    aggregates = []
+    for vital in ROLLUP_VITALS:
+        value = _number(vital)
+        aggregates.extend([
+            "COUNT({})".format(value),
+            "TOTAL({})".format(value),
+            "TOTAL(({0}) * ({0}))".format(value),
+            "MIN({})".format(value),
+            "MAX({})".format(value),
+        ])
+    return '''
+        INSERT INTO sleep_rollups ({columns})
+        SELECT '{period}', patient_id, {bucket}, COUNT(*), {aggregates}
+        FROM sleep_observations
+        WHERE {bucket} IS NOT NULL AND {where}
+        GROUP BY patient_id, {bucket}
+    '''.format(columns=', '.join(ROLLUP_COLUMNS), period=period, bucket=bucket,
+               aggregates=', '.join(aggregates), where=where)
+
+
+def _fold_insert(period):
+    # Trigger statement adding NEW to its bucket
+    bucket = PERIODS[period][0].format('NEW.observation_date')
+    values = []
+    updates = ['nights = nights + 1']
+    for vital in ROLLUP_VITALS:
+        value = _number('NEW.' + vital)
+        values.extend(["({}) IS NOT NULL".format(value), "COALESCE({}, 0)".format(value),
+                       "COALESCE(({0}) * ({0}), 0)".format(value), value, value])
+        for stat in ('count', 'sum', 'sumsq'):
+            updates.append("{0}_{1} = {0}_{1} + excluded.{0}_{1}".format(vital, stat))
+        updates.append("{0}_min = COALESCE(min({0}_min, excluded.{0}_min), {0}_min, excluded.{0}_min)".format(vital))
+        updates.append("{0}_max = COALESCE(max({0}_max, excluded.{0}_max), {0}_max, excluded.{0}_max)".format(vital))
+    return '''
+        INSERT INTO sleep_rollups ({columns}) VALUES ('{period}', NEW.patient_id, {bucket}, 1, {values})
+        ON CONFLICT(period, patient_id, period_start) DO UPDATE SET {updates};
+    '''.format(columns=', '.join(ROLLUP_COLUMNS), period=period, bucket=bucket,
+               values=', '.join(values), updates=', '.join(updates))
+
+
+def _recompute(period, row):
+    # Trigger statements recomputing the bucket of `row` (OLD or NEW) from the observations
+    bucket, step = PERIODS[period]
+    start = bucket.format(row + '.observation_date')
+    return '''
+        DELETE FROM sleep_rollups WHERE period = '{period}' AND patient_id = {row}.patient_id
+            AND period_start = {start};
+        {insert};
+    '''.format(period=period, row=row, start=start, insert=_aggregate_select(period, '''
+            patient_id = {row}.patient_id
+            AND observation_date >= {start} AND observation_date < date({start}, '{step}')
+        '''.format(row=row, start=start, step=step)).strip())
+
+
+def create_rollup_schema(conn):
+    # sleep_rollups and the triggers that maintain it; called by migration 8
+    columns = ['{}_{} {}'.format(vital, stat, 'INTEGER NOT NULL' if stat == 'count' else
+                                 'REAL NOT NULL' if stat in ('sum', 'sumsq') else 'REAL')
+               for vital in ROLLUP_VITALS for stat in STATS]
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sleep_rollups (
+            period TEXT NOT NULL,
+            patient_id INTEGER NOT NULL,
+            period_start TEXT NOT NULL,
+            nights INTEGER NOT NULL,
+            {},
+            PRIMARY KEY (period, patient_id, period_start)
+        ) WITHOUT ROWID
+    '''.format(',\n            '.join(columns)))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sleep_rollups_period_start ON sleep_rollups (period, period_start)")
+
+    watched = ['patient_id', 'observation_date'] + ROLLUP_VITALS
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS sleep_rollups_insert AFTER INSERT ON sleep_observations
+        WHEN date(NEW.observation_date) IS NOT NULL
+        BEGIN {} END
+    '''.format(''.join(_fold_insert(period) for period in PERIODS)))
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS sleep_rollups_delete AFTER DELETE ON sleep_observations
+        WHEN date(OLD.observation_date) IS NOT NULL
+        BEGIN {} END
+    '''.format(''.join(_recompute(period, 'OLD') for period in PERIODS)))
+    # Only measurement changes: the updated_at stamp triggers and upserts that
+    # rewrite the same values must not recompute
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS sleep_rollups_update AFTER UPDATE OF {} ON sleep_observations
+        WHEN {}
+        BEGIN {} END
+    '''.format(', '.join(watched), ' OR '.join('OLD.{0} IS NOT NEW.{0}'.format(column) for column in watched),
+               ''.join(_recompute(period, 'OLD') + _recompute(period, 'NEW') for period in PERIODS)))
+
+
+def _patient_condition():
+    # One patient's rows; naming the periods lets SQLite seek on the primary key
+    return "period IN ({}) AND patient_id = ?".format(', '.join("'{}'".format(period) for period in PERIODS))
+
+
+def rebuild(conn, patient_id=None):
+    # Recomputes the rollups of one patient, or of everyone, in the caller's transaction
+    if patient_id is None:
+        conn.execute("DELETE FROM sleep_rollups")
+        where, params = '1', ()
+    else:
+        conn.execute("DELETE FROM sleep_rollups WHERE {}".format(_patient_condition()), (patient_id,))
+        where, params = 'patient_id = ?', (patient_id,)
+    for period in PERIODS:
+        conn.execute(_aggregate_select(period, where), params)
+
+
+def rebuild_rollups(db_name, patient_id=None):
+    # Backfill in one transaction per shard; returns the number of rollup rows
+    if patient_id is None:
+        return sum(_rebuild_shard(shard) for shard in shard_paths(db_name))
+    return _rebuild_shard(shard_for(db_name, patient_id), patient_id)
+
+
+def _rebuild_shard(shard, patient_id=None):
+    with connection(shard) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rebuild(conn, patient_id)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if patient_id is None:
+            return conn.execute("SELECT COUNT(*) FROM sleep_rollups").fetchone()[0]
+        return conn.execute("SELECT COUNT(*) FROM sleep_rollups WHERE {}".format(_patient_condition()),
+                            (patient_id,)).fetchone()[0]
+
+
+def _summary(nights, stats):
+    # {vital: {count, mean, min, max, stddev}} from rollup columns in ROLLUP_COLUMNS order
+    result = {'nights': nights}
+    for i, vital in enumerate(ROLLUP_VITALS):
+        count, total, sumsq, low, high = stats[i * len(STATS):(i + 1) * len(STATS)]
+        if not count:
+            result[vital] = {'count': 0, 'mean': None, 'min': None, 'max': None, 'stddev': None}
+            continue
+        mean = total / count
+        variance = max(sumsq / count - mean * mean, 0.0)  # Population variance
+        result[vital] = {'count': count, 'mean': round(mean, 3), 'min': low, 'max': high,
+                         'stddev': round(math.sqrt(variance), 3)}
+    return result
+
+
+def _range(period, start, end):
+    conditions, params = [], []
+    if start is not None:
+        conditions.append("period_start >= ?")
+        params.append(period_start(period, start))
+    if end is not None:
+        conditions.append("period_start <= ?")
+        params.append(period_start(period, end))
+    return ''.join(' AND ' + condition for condition in conditions), params
+
+
+def patient_rollups(db_name, patient_id, period='week', start=None, end=None):
+    """One patient's rollups for the periods overlapping `start`..`end`.
+
+    Returns a list of {'period_start', 'nights', vital: {count, mean, min,
+    max, stddev}} in date order: a year of weekly trends is 52 rows.
+    """
+    conditions, params = _range(period, start, end)
+    stats = ', '.join(ROLLUP_COLUMNS[4:])
+    with connection(shard_for(db_name, patient_id)) as conn:
+        rows = conn.execute('''
+            SELECT period_start, nights, {} FROM sleep_rollups
+            WHERE period = ? AND patient_id = ?{} ORDER BY period_start
+        '''.format(stats, conditions), [period, patient_id] + params).fetchall()
+    return [dict(period_start=row[0], **_summary(row[1], row[2:])) for row in rows]
+
+
+def _cohort_totals(shard, period, conditions, params):
+    # (period_start, patients, nights, STATS per vital) of one shard
+    aggregates = []
+    for vital in ROLLUP_VITALS:
+        aggregates.extend(['SUM({}_count)'.format(vital), 'SUM({}_sum)'.format(vital),
+                           'SUM({}_sumsq)'.format(vital), 'MIN({}_min)'.format(vital), 'MAX({}_max)'.format(vital)])
+    with connection(shard) as conn:
+        return conn.execute('''
+            SELECT period_start, COUNT(*), SUM(nights), {} FROM sleep_rollups
+            WHERE period = ?{} GROUP BY period_start ORDER BY period_start
+        '''.format(', '.join(aggregates), conditions), [period] + params).fetchall()
+
+
+def _combine(total, row):
+    # Adds one shard's totals for a period to those of the shards before it
+    combined = [total[0] + row[0], total[1] + row[1]]
+    for i, (a, b) in enumerate(zip(total[2:], row[2:])):
+        stat = STATS[i % len(STATS)]
+        if a is None or b is None:
+            combined.append(b if a is None else a)
+        elif stat in ('min', 'max'):
+            combined.append(min(a, b) if stat == 'min' else max(a, b))
+        else:
+            combined.append(a + b)
+    return combined
+
+
+def cohort_rollups(db_name, period='month', start=None, end=None):
+    # Every patient's rollups combined per period, plus the number of patients observed
+    conditions, params = _range(period, start, end)
+    totals = {}
+    for rows in fan_out(db_name, _cohort_totals, period, conditions, params):
+        for row in rows:
+            total = totals.get(row[0])
+            totals[row[0]] = list(row[1:]) if total is None else _combine(total, row[1:])
+    return [dict(period_start=period_start, patients=total[0], **_summary(total[1], total[2:]))
+            for period_start, total in sorted(totals.items())]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the sleep rollup tables from sleep_observations.")
+    parser.add_argument('db_name')
+    parser.add_argument('--rebuild', action='store_true', help="recompute the rollups (all patients by default)")
+    parser.add_argument('--patient', type=int, help="only rebuild this patient's rollups")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        migrate(args.db_name)
+        start = time.perf_counter()
+        rows = rebuild_rollups(args.db_name, args.patient)
+        print(f"Rebuilt {rows} rollup rows in {time.perf_counter() - start:.2f}s.")
+    else:
+        parser.print_help()
@@ -0,0 +1,563 @@
+import argparse
+import glob
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from db_pool import close_all_pools, connection
+
+
+# Patient-sharded storage. A logical database (the server's db_name, e.g.
+# sleep_data.db) can spread its Patients, sleep_observations and sleep_rollups
+# over N SQLite files, so writes for different patients take different database
+# locks and no single file grows without bound. Each patient_id lives on exactly
+# one shard, chosen by hash (patient_id mod N) or by range (range_size
+# consecutive ids per shard, the last shard taking every id above).
+#
+# Once sharded, the db_name file is the catalog: shard_layout records the layout
+# and the next Patient_ID, and write_queue_state and import_checkpoints stay
+# there, while the patient rows live in <name>-g<generation>-s<index>.db. A
+# database without shard_layout is a single file as before, and every helper
+# here then reduces to plain db_name access.
+#
+# Rebalancing copies the rows into the files of the next generation, then
+# switches the layout in one catalog transaction and removes the old files, so a
+# reader sees either layout but never half of one. Stop writers first and
+# restart servers afterwards, e.g.
+#
+#   python shards.py sleep_data.db --rebalance --shards 4 [--strategy range --range-size 50000]
+
+STRATEGIES = ('hash', 'range')
+DEFAULT_RANGE_SIZE = 100000
+# Threads running the per-shard queries of one fan-out
+FANOUT_WORKERS = int(os.environ.get('SHARD_FANOUT_WORKERS', 8))
+
+# Tables whose rows belong to one patient, with the column naming the patient
+SHARDED_TABLES = [('Patients', 'Patient_ID'), ('sleep_observations', 'patient_id'), ('sleep_rollups', 'patient_id')]
+
+
+def shard_path(db_name, generation, index):
+    root, ext = os.path.splitext(db_name)
+    return '{}-g{}-s{}{}'.format(root, generation, index, ext)
+
+
+def shard_files(db_name):
+    # Every shard file of db_name on disk, of any generation, with its -wal/-shm files
+    root, ext = os.path.splitext(db_name)
+    return sorted(glob.glob(glob.escape(root) + '-g*-s*' + glob.escape(ext) + '*'))
+
+
+class ShardRouter:
+    # Maps patient ids onto the shard files of one layout. Generation 0 is the
+    # unsharded layout: a single shard, the db_name file itself.
+
+    def __init__(self, db_name, shards=1, strategy='hash', range_size=DEFAULT_RANGE_SIZE, generation=0):
+        if strategy not in STRATEGIES:
+            raise ValueError('strategy must be one of {}'.format(', '.join(STRATEGIES)))
+        if shards < 1 or range_size < 1:
+            raise ValueError('shards and range_size must be at least 1')
+        self.db_name = db_name
+        self.shards = shards
+        self.strategy = strategy
+        self.range_size = range_size
+        self.generation = generation
+        if generation == 0:
+            self.paths = [db_name]
+        else:
+            self.paths = [shard_path(db_name, generation, index) for index in range(shards)]
+
+    @property
+    def sharded(self):
+        return self.generation > 0
+
+    def shard_index(self, patient_id):
+        patient_id = abs(int(patient_id))
+        if self.strategy == 'hash':
+            return patient_id % self.shards
+        return min(patient_id // self.range_size, self.shards - 1)
+
+    def shard_condition(self, column, index):
+        # SQL selecting the rows of shard `index`; the same arithmetic as shard_index
+        if self.strategy == 'hash':
+            return 'abs({}) % {} = {}'.format(column, self.shards, index)
+        return 'min(abs({}) / {}, {}) = {}'.format(column, self.range_size, self.shards - 1, index)
+
+    def path_for(self, patient_id):
+        if len(self.paths) == 1:
+            return self.paths[0]
+        return self.paths[self.shard_index(patient_id)]
+
+    def split(self, items, key):
+        # {path: [item, ...]} grouping items by the shard of the patient id key(item), in input order
+        groups = {}
+        for item in items:
+            groups.setdefault(self.path_for(key(item)), []).append(item)
+        return groups
+
+    def describe(self):
+        return {'generation': self.generation, 'strategy': self.strategy, 'shards': self.shards,
+                'range_size': self.range_size, 'paths': list(self.paths)}
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def read_layout(conn):
+    # (generation, strategy, shards, range_size) from a catalog, or None for a single file
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shard_layout'").fetchone():
+        return None
+    return conn.execute("SELECT generation, strategy, shards, range_size FROM shard_layout").fetchone()
+
+
+def get_router(db_name):
+    # The layout is read once per process; restart after rebalancing
+    router = _routers.get(db_name)
+    if router is None:
+        with _routers_lock:
+            router = _routers.get(db_name)
+            if router is None:
+                layout = None
+                if os.path.exists(db_name):
+                    with connection(db_name) as conn:
+                        layout = read_layout(conn)
+                if layout is None:
+                    router = ShardRouter(db_name)
+                else:
+                    generation, strategy, shards, range_size = layout
+                    router = ShardRouter(db_name, shards, strategy, range_size, generation)
+                _routers[db_name] = router
+    return router
+
+
+def reset_routers():
+    # Forgets everything cached about the files of a database, which a rebuild
+    # or rebalance may have replaced
+    global _watcher_generation
+    from patient_search import reset_fts_cache  # patient_search imports this module
+
+    with _routers_lock:
+        _routers.clear()
+    reset_fts_cache()
+    with _watchers_lock:
+        for conn in _watcher_connections:
+            conn.close()
+        _watcher_connections.clear()
+        _watcher_generation += 1
+
+
+def shard_for(db_name, patient_id):
+    # The file holding `patient_id`'s rows
+    return get_router(db_name).path_for(patient_id)
+
+
+def shard_paths(db_name):
+    return list(get_router(db_name).paths)
+
+
+# Per thread, one idle connection per file, never used for writing, whose PRAGMA
+# data_version changes whenever any other connection commits to the file, in
+# this process or another one. Thread-local, so cached reads do not queue behind
+# each other; reset_routers() closes them all.
+_watchers = threading.local()
+_watcher_connections = []
+_watchers_lock = threading.Lock()
+_watcher_generation = 0
+
+
+class _Watcher:
+    __slots__ = ('connection', 'data_version', 'patients')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.data_version = None
+        self.patients = {}  # patient_id -> patient_versions.version as of data_version
+
+
+def _watcher(path):
+    # This thread's watcher of `path`, or None while the file does not exist
+    if getattr(_watchers, 'generation', None) != _watcher_generation:
+        _watchers.generation = _watcher_generation
+        _watchers.files = {}
+    watcher = _watchers.files.get(path)
+    if watcher is None:
+        if not os.path.exists(path):
+            return None
+        conn = sqlite3.connect(path, check_same_thread=False)
+        with _watchers_lock:
+            _watcher_connections.append(conn)
+        watcher = _watchers.files[path] = _Watcher(conn)
+    return watcher
+
+
+def data_versions(db_name, patient_id=None):
+    # A token that changes whenever `patient_id`'s shard (every shard for None)
+    # is committed to by anyone, e.g. another server worker or a CLI import
+    paths = shard_paths(db_name) if patient_id is None else [shard_for(db_name, patient_id)]
+    versions = []
+    for path in paths:
+        watcher = _watcher(path)
+        versions.append(None if watcher is None else watcher.connection.execute("PRAGMA data_version").fetchone()[0])
+    return tuple(versions)
+
+
+def patient_version(db_name, patient_id=None):
+    # A token that changes whenever `patient_id`'s rows are written by anyone,
+    # but not with writes to other patients on the same shard; for None, the
+    # data_versions() of every shard. The shard's data_version only decides
+    # whether the patient_versions row must be read again.
+    if patient_id is None:
+        return data_versions(db_name)
+    path = shard_for(db_name, patient_id)
+    watcher = _watcher(path)
+    if watcher is None:
+        return None
+    data_version = watcher.connection.execute("PRAGMA data_version").fetchone()[0]
+    if data_version != watcher.data_version:
+        watcher.data_version = data_version
+        watcher.patients.clear()
+    version = watcher.patients.get(patient_id)
+    if version is None:
+        try:
+            row = watcher.connection.execute("SELECT version FROM patient_versions WHERE patient_id = ?",
+                                             (patient_id,)).fetchone()
+        except sqlite3.OperationalError:
+            return path, None, data_version  # Not migrated to version 9: any write to the file counts
+        version = watcher.patients[patient_id] = 0 if row is None else row[0]
+    return path, version  # The path changes with the generation, as a rebalanced file starts over
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='shard-fanout')
+    return _executor
+
+
+def fan_out(db_name, fn, *args):
+    """Call fn(shard_path, *args) for every shard of db_name, in parallel.
+
+    Returns the results in shard order. A single-file database is queried on
+    the calling thread, with the request's connection. `fn` must not fan out
+    itself, or the worker threads can all end up waiting on each other.
+    """
+    paths = shard_paths(db_name)
+    if len(paths) == 1:
+        return [fn(paths[0], *args)]
+    return list(_get_executor().map(lambda path: fn(path, *args), paths))
+
+
+def fan_out_patients(db_name, patient_ids, fn, *args):
+    # Like fan_out, but calls fn(shard_path, ids_on_that_shard, *args) only for
+    # the shards holding some of `patient_ids`
+    groups = list(get_router(db_name).split(patient_ids, int).items())
+    if len(groups) <= 1:
+        return [fn(path, ids, *args) for path, ids in groups]
+    return list(_get_executor().map(lambda group: fn(group[0], group[1], *args), groups))
+
+
+_DONE = object()
+
+
+def fan_out_iter(db_name, fn, *args, buffer=64):
+    # Yields the items of the iterators fn(shard_path, *args) of every shard,
+    # produced by one thread per shard and interleaved as they arrive. Closing
+    # the generator stops the producers.
+    paths = shard_paths(db_name)
+    if len(paths) == 1:
+        yield from fn(paths[0], *args)
+        return
+
+    items = queue.Queue(buffer)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(path):
+        iterator = iter(())
+        try:
+            iterator = fn(path, *args)
+            for item in iterator:
+                if not put((None, item)):
+                    return
+            put((None, _DONE))
+        except BaseException as e:
+            put((e, None))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    for path in paths:
+        threading.Thread(target=produce, args=(path,), name='shard-stream', daemon=True).start()
+    remaining = len(paths)
+    try:
+        while remaining:
+            error, item = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+def allocate_patient_ids(db_name, count=1):
+    # Reserves `count` consecutive Patient_IDs of a sharded database and returns
+    # the first; None for a single file, where SQLite numbers new patients
+    if not get_router(db_name).sharded:
+        return None
+    with connection(db_name) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            first = conn.execute("SELECT next_patient_id FROM shard_layout").fetchone()[0]
+            conn.execute("UPDATE shard_layout SET next_patient_id = ?", (first + count,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return first
+
+
+def reserve_patient_ids(db_name, patient_id):
+    # Moves the sequence past an id written explicitly, e.g. by PUT Patient/<id>
+    if not get_router(db_name).sharded:
+        return
+    with connection(db_name) as conn:
+        try:
+            conn.execute("UPDATE shard_layout SET next_patient_id = max(next_patient_id, ?)", (int(patient_id) + 1,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+class ShardConnections:
+    # Connections to the shards one multi-patient write touches, borrowed on
+    # first use. Statements run on every shard before any commits, so an error
+    # while applying the rows rolls back everything; only a failure between two
+    # commits can leave the write applied to some shards.
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.router = get_router(db_name)
+        self._connections = {}
+        self._stack = ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+
+    @property
+    def sharded(self):
+        return self.router.sharded
+
+    def for_path(self, path):
+        conn = self._connections.get(path)
+        if conn is None:
+            conn = self._connections[path] = self._stack.enter_context(connection(path))
+        return conn
+
+    def for_patient(self, patient_id):
+        return self.for_path(self.router.path_for(patient_id))
+
+    def split(self, items, key):
+        # [(conn, [item, ...])] grouping items by the shard of the patient id key(item)
+        return [(self.for_path(path), group) for path, group in self.router.split(items, key).items()]
+
+    def allocate_patient_ids(self, count=1):
+        return allocate_patient_ids(self.db_name, count)
+
+    def reserve_patient_ids(self, patient_id):
+        reserve_patient_ids(self.db_name, patient_id)
+
+    def commit(self):
+        # The catalog commits last, so the write_queue_state or import_checkpoints
+        # written with a batch never get ahead of the batch's rows
+        for path, conn in self._connections.items():
+            if path != self.db_name:
+                conn.commit()
+        if self.db_name in self._connections:
+            self._connections[self.db_name].commit()
+
+    def rollback(self):
+        for conn in self._connections.values():
+            conn.rollback()
+
+
+def migrate(db_name):
+    # Applies pending migrations to db_name and every shard file; returns the versions applied to db_name
+    from migrations import apply_migrations  # migrations imports modules that import this one
+
+    applied = apply_migrations(db_name)
+    for path in shard_paths(db_name):
+        if path != db_name:
+            apply_migrations(path)
+    return applied
+
+
+def _remove_files(paths):
+    for path in paths:
+        for name in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def _table_columns(conn, schema, table):
+    return [info[1] for info in conn.execute("PRAGMA {}.table_info({})".format(schema, table))]
+
+
+def _copy_shard(router, index, sources):
+    # Creates shard `index` of `router` and copies its patients' rows from the `sources` files.
+    # The file is new, so the rollups are copied as they are instead of being folded in row by row,
+    # and its patient versions start over (patient_version() tokens include the path).
+    from migrations import apply_migrations, create_version_triggers, drop_version_triggers
+    from rollups import create_rollup_schema
+
+    path = router.paths[index]
+    apply_migrations(path)
+    copied = 0
+    with connection(path) as conn:
+        conn.execute("DROP TRIGGER sleep_rollups_insert")
+        drop_version_triggers(conn)
+        conn.commit()
+        for source in sources:
+            conn.execute("ATTACH DATABASE ? AS source", (source,))
+            try:
+                for table, key in SHARDED_TABLES:
+                    available = _table_columns(conn, 'source', table)
+                    columns = ', '.join(c for c in _table_columns(conn, 'main', table) if c in available)
+                    copied += conn.execute("INSERT INTO main.{0} ({1}) SELECT {1} FROM source.{0} WHERE {2}".format(
+                        table, columns, router.shard_condition(key, index))).rowcount
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute("DETACH DATABASE source")
+        create_rollup_schema(conn)
+        create_version_triggers(conn)
+        conn.commit()
+    return copied
+
+
+def _clear_patient_rows(conn):
+    # Empties the sharded tables of a file that has become the catalog
+    from migrations import create_version_triggers, drop_version_triggers
+    from rollups import create_rollup_schema
+
+    conn.execute("DROP TRIGGER IF EXISTS sleep_rollups_delete")  # Every bucket is going anyway
+    drop_version_triggers(conn)
+    for table, _ in reversed(SHARDED_TABLES):
+        conn.execute("DELETE FROM {}".format(table))
+    conn.execute("DELETE FROM patient_versions")
+    create_rollup_schema(conn)
+    create_version_triggers(conn)
+
+
+def rebalance(db_name, shards, strategy='hash', range_size=DEFAULT_RANGE_SIZE):
+    """Move every patient's rows onto a layout of `shards` files.
+
+    The new generation's files are filled in parallel from the current shards,
+    then the catalog switches to the new layout in one transaction and the old
+    files are removed. Writers must be stopped while it runs, and servers pick
+    up the new layout when restarted. Returns the new ShardRouter.
+    """
+    migrate(db_name)
+    old = get_router(db_name)
+    new = ShardRouter(db_name, shards, strategy, range_size, old.generation + 1)
+    _remove_files(new.paths)  # Left by an interrupted rebalance
+
+    list(_get_executor().map(lambda index: _copy_shard(new, index, old.paths), range(shards)))
+
+    next_patient_id = 1
+    for path in new.paths:
+        with connection(path) as conn:
+            next_patient_id = max(next_patient_id, conn.execute("SELECT COALESCE(MAX(Patient_ID), 0) + 1 FROM Patients").fetchone()[0])
+
+    with connection(db_name) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute('''CREATE TABLE IF NOT EXISTS shard_layout (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                generation INTEGER NOT NULL,
+                strategy TEXT NOT NULL,
+                shards INTEGER NOT NULL,
+                range_size INTEGER NOT NULL,
+                next_patient_id INTEGER NOT NULL,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )''')
+            row = conn.execute("SELECT next_patient_id FROM shard_layout").fetchone()
+            if row is not None:
+                next_patient_id = max(next_patient_id, row[0])
+            conn.execute('''
+                INSERT OR REPLACE INTO shard_layout (id, generation, strategy, shards, range_size, next_patient_id)
+                VALUES (1, ?, ?, ?, ?, ?)
+            ''', (new.generation, strategy, shards, range_size, next_patient_id))
+            if not old.sharded:
+                _clear_patient_rows(conn)  # Until now the catalog held the rows itself
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if not old.sharded:
+            conn.execute("VACUUM")
+
+    reset_routers()
+    close_all_pools()
+    if old.sharded:
+        _remove_files(old.paths)
+    return new
+
+
+def shard_counts(db_name):
+    # [(path, patients, observations)] for every shard
+    def count(path):
+        with connection(path) as conn:
+            return (path, conn.execute("SELECT COUNT(*) FROM Patients").fetchone()[0],
+                    conn.execute("SELECT COUNT(*) FROM sleep_observations").fetchone()[0])
+
+    return fan_out(db_name, count)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show or change how a sleep database is sharded by patient.")
+    parser.add_argument('db_name')
+    parser.add_argument('--rebalance', action='store_true', help="move every patient onto a new layout")
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--strategy', choices=STRATEGIES, default='hash')
+    parser.add_argument('--range-size', type=int, default=DEFAULT_RANGE_SIZE,
+                        help="consecutive patient ids per shard with --strategy range")
+    args = parser.parse_args()
+
+    if args.rebalance:
+        start = time.perf_counter()
+        router = rebalance(args.db_name, args.shards, args.strategy, args.range_size)
+        print(f"Rebalanced onto {router.shards} {router.strategy} shard(s) in {time.perf_counter() - start:.2f}s.")
+
+    router = get_router(args.db_name)
+    print(f"Layout: generation {router.generation}, {router.shards} {router.strategy} shard(s)"
+          + (f", {router.range_size} ids per range" if router.strategy == 'range' else ""))
+    for path, patients, observations in shard_counts(args.db_name):
+        print(f"  {path}: {patients} patients, {observations} observations")
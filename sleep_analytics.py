@@ -0,0 +1,267 @@
+import numpy as np
+
+from db_pool import connection
+from observation_store import ObservationStore, combined_columns
+from shards import fan_out, shard_for
+
+
+# Per-patient and cohort sleep analytics over sleep_observations. Everything is
+# computed with NumPy over column arrays loaded by a single ordered query per
+# shard (or taken from ObservationStores); the only Python loops are over
+# metrics and percentiles, never over rows.
+
+VITALS = ['snoring_rate', 'respiratory_rate', 'body_temperature', 'limb_movement',
+          'blood_oxygen', 'eye_movement', 'sleeping_hours', 'heart_rate']
+ROLLING_METRICS = ('sleeping_hours', 'heart_rate', 'blood_oxygen')
+ROLLING_WINDOWS = (7, 30)  # Calendar days, so missing nights do not stretch a window
+PERCENTILES = (10, 25, 50, 75, 90)
+
+SPO2_DIP_THRESHOLD = 90.0  # Nightly SpO2 below this is flagged
+SPO2_DIP_DROP = 4.0  # ... as is a drop of this many points below the previous 30 days
+HEART_RATE_OUTLIER_Z = 3.5  # Robust (median/MAD) z-score that flags a heart rate
+
+FETCH_ROWS = 100000
+
+# Keys combine patient and day so one searchsorted never crosses patients
+_KEY_STRIDE = 10 ** 7
+
+
+def load_columns(db_name, patient_id=None):
+    # Returns {'patient_id', 'day' (days since 1970-01-01), vitals..., 'stress_level'}
+    # as arrays ordered by patient and date; NULLs become NaN.
+    if patient_id is not None:
+        return _load_shard_columns(shard_for(db_name, patient_id), patient_id)
+    parts = fan_out(db_name, _load_shard_columns)
+    if len(parts) == 1:
+        return parts[0]
+    # Each shard is ordered by patient and date, so a stable sort on the patient restores the order
+    result = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    order = np.argsort(result['patient_id'], kind='stable')
+    return {name: values[order] for name, values in result.items()}
+
+
+def _load_shard_columns(shard, patient_id=None):
+    columns = ['patient_id', 'day'] + VITALS + ['stress_level']
+    # Text that SQLite could not convert (e.g. '' from a CSV) is not a measurement and becomes NaN
+    values = ["CASE WHEN typeof({0}) IN ('integer', 'real') THEN {0} END".format(column)
+              for column in VITALS + ['stress_level']]
+    query = '''
+        SELECT patient_id, CAST(julianday(observation_date) - 2440587.5 AS INTEGER), {}
+        FROM sleep_observations
+        WHERE julianday(observation_date) IS NOT NULL{}
+        ORDER BY patient_id, observation_date
+    '''.format(', '.join(values), '' if patient_id is None else ' AND patient_id = ?')
+    params = () if patient_id is None else (patient_id,)
+
+    chunks = []
+    with connection(shard) as conn:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.float64))
+    data = np.concatenate(chunks) if chunks else np.empty((0, len(columns)))
+
+    result = {name: data[:, i] for i, name in enumerate(columns)}
+    result['patient_id'] = result['patient_id'].astype(np.int64)
+    result['day'] = result['day'].astype(np.int64)
+    return result
+
+
+def as_columns(source):
+    # load_columns-style arrays from a columns dict, an ObservationStore or a list of stores
+    if isinstance(source, ObservationStore):
+        return source.columns()
+    if isinstance(source, dict):
+        return source
+    return combined_columns(source)
+
+
+def _rolling_sums(keys, values, window):
+    # Sum and count of the non-NaN values in the `window` days ending at each row
+    valid = ~np.isnan(values)
+    total = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    count = np.concatenate(([0], np.cumsum(valid)))
+    start = np.searchsorted(keys, keys - (window - 1), side='left')
+    end = np.arange(1, len(keys) + 1)
+    return total[end] - total[start], count[end] - count[start]
+
+
+def _divide(numerator, denominator):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), np.nan)
+
+
+def _group_percentiles(group, n_groups, values, percentiles):
+    # Linear-interpolated percentiles of `values` per group, ignoring NaN;
+    # returns an (n_groups, len(percentiles)) array
+    order = np.lexsort((values, group))  # NaN sorts last within each group
+    ordered = values[order]
+    sizes = np.bincount(group, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    valid = np.bincount(group, weights=~np.isnan(values), minlength=n_groups).astype(np.int64)
+
+    result = np.full((n_groups, len(percentiles)), np.nan)
+    has = valid > 0
+    for j, q in enumerate(percentiles):
+        position = (valid[has] - 1) * (q / 100.0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        low_values = ordered[starts[has] + lower]
+        high_values = ordered[starts[has] + upper]
+        result[has, j] = low_values + (high_values - low_values) * (position - lower)
+    return result
+
+
+def compute_metrics(columns):
+    """Compute every analytic over the arrays returned by load_columns.
+
+    Also accepts what as_columns() does. Returns a dict of arrays: per-row
+    rolling averages and anomaly flags, and per-patient summaries (indexed
+    like ``patients``).
+    """
+    columns = as_columns(columns)
+    patient_id = columns['patient_id']
+    n = len(patient_id)
+    boundaries = np.concatenate(([True], patient_id[1:] != patient_id[:-1])) if n else np.zeros(0, bool)
+    group = np.cumsum(boundaries) - 1
+    starts = np.flatnonzero(boundaries)
+    patients = patient_id[starts]
+    n_groups = len(patients)
+    keys = patient_id * _KEY_STRIDE + columns['day']
+
+    metrics = {'patients': patients, 'group': group, 'rows': np.bincount(group, minlength=n_groups)}
+
+    for name in ROLLING_METRICS:
+        for window in ROLLING_WINDOWS:
+            total, count = _rolling_sums(keys, columns[name], window)
+            metrics['{}_{}d'.format(name, window)] = _divide(total, count)
+
+    for name in VITALS:
+        values = columns[name]
+        valid = ~np.isnan(values)
+        count = np.bincount(group, weights=valid, minlength=n_groups)
+        total = np.bincount(group, weights=np.where(valid, values, 0.0), minlength=n_groups)
+        metrics[name + '_mean'] = _divide(total, count)
+        metrics[name + '_min'] = np.fmin.reduceat(values, starts) if n else np.zeros(0)
+        metrics[name + '_max'] = np.fmax.reduceat(values, starts) if n else np.zeros(0)
+        metrics[name + '_percentiles'] = _group_percentiles(group, n_groups, values, PERCENTILES)
+
+    # Stress level distribution as (patient index, level, nights) triples
+    stress = columns['stress_level']
+    valid = ~np.isnan(stress)
+    if valid.any():
+        pairs, counts = np.unique(np.stack([group[valid], stress[valid].astype(np.int64)]), axis=1, return_counts=True)
+    else:
+        pairs, counts = np.zeros((2, 0), np.int64), np.zeros(0, np.int64)
+    metrics['stress_distribution'] = (pairs[0], pairs[1], counts)
+
+    # SpO2 dips: low in absolute terms, or well below the preceding 30 days
+    spo2 = columns['blood_oxygen']
+    total, count = _rolling_sums(keys, spo2, 30)
+    previous = _divide(total - np.nan_to_num(spo2), count - ~np.isnan(spo2))
+    with np.errstate(invalid='ignore'):
+        metrics['spo2_dip'] = (spo2 < SPO2_DIP_THRESHOLD) | (previous - spo2 >= SPO2_DIP_DROP)
+
+    # Heart rate outliers by robust z-score against the patient's median / MAD
+    heart_rate = columns['heart_rate']
+    median = _group_percentiles(group, n_groups, heart_rate, (50,))[:, 0]
+    deviation = np.abs(heart_rate - median[group]) if n else np.zeros(0)
+    mad = _group_percentiles(group, n_groups, deviation, (50,))[:, 0] * 1.4826
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics['heart_rate_outlier'] = (mad[group] > 0) & (deviation / mad[group] > HEART_RATE_OUTLIER_Z)
+
+    return metrics
+
+
+def _values(array):
+    return np.where(np.isnan(array), None, np.round(array, 3)).tolist()
+
+
+def _patient_summary(metrics, index):
+    summary = {}
+    for name in VITALS:
+        percentiles = metrics[name + '_percentiles'][index]
+        summary[name] = dict(
+            zip(['mean', 'min', 'max'] + ['p{}'.format(q) for q in PERCENTILES],
+                _values(np.concatenate(([metrics[name + '_mean'][index], metrics[name + '_min'][index],
+                                         metrics[name + '_max'][index]], percentiles)))))
+    return summary
+
+
+def _stress_distribution(metrics, index):
+    groups, levels, counts = metrics['stress_distribution']
+    # np.unique sorted the pairs by patient index first
+    lo, hi = np.searchsorted(groups, index, 'left'), np.searchsorted(groups, index, 'right')
+    return {str(level): int(count) for level, count in zip(levels[lo:hi].tolist(), counts[lo:hi].tolist())}
+
+
+def patient_analytics(db_name, patient_id):
+    # Full analytics for one patient, including the daily rolling series and
+    # flagged nights; None when the patient has no observations
+    return patient_report(load_columns(db_name, patient_id))
+
+
+def patient_report(source):
+    # patient_analytics over one patient's columns or ObservationStore
+    columns = as_columns(source)
+    if not len(columns['patient_id']):
+        return None
+    patient_id = columns['patient_id'][0]
+    metrics = compute_metrics(columns)
+
+    dates = columns['day'].astype('datetime64[D]').astype(str).tolist()
+    series = {'date': dates}
+    for name in ROLLING_METRICS:
+        series[name] = _values(columns[name])
+        for window in ROLLING_WINDOWS:
+            key = '{}_{}d'.format(name, window)
+            series[key] = _values(metrics[key])
+
+    anomalies = []
+    for flag in ('spo2_dip', 'heart_rate_outlier'):
+        for i in np.flatnonzero(metrics[flag]).tolist():
+            anomalies.append({'date': dates[i], 'flag': flag,
+                              'blood_oxygen': _values(columns['blood_oxygen'][i:i + 1])[0],
+                              'heart_rate': _values(columns['heart_rate'][i:i + 1])[0]})
+    anomalies.sort(key=lambda anomaly: anomaly['date'])
+
+    return {
+        'patient_id': int(patient_id),
+        'nights': int(metrics['rows'][0]),
+        'summary': _patient_summary(metrics, 0),
+        'stress_levels': _stress_distribution(metrics, 0),
+        'rolling': series,
+        'anomalies': anomalies,
+    }
+
+
+def cohort_analytics(db_name):
+    # Summaries, stress distributions and anomaly counts for every patient, from one pass
+    return cohort_report(load_columns(db_name))
+
+
+def cohort_report(source):
+    # cohort_analytics over columns or a list of ObservationStores
+    columns = as_columns(source)
+    metrics = compute_metrics(columns)
+    n_groups = len(metrics['patients'])
+    spo2_dips = np.bincount(metrics['group'], weights=metrics['spo2_dip'], minlength=n_groups)
+    heart_rate_outliers = np.bincount(metrics['group'], weights=metrics['heart_rate_outlier'], minlength=n_groups)
+
+    # Latest rolling values: the last row of each patient
+    last = np.concatenate((np.flatnonzero(np.diff(metrics['group'])), [len(metrics['group']) - 1])) if n_groups else []
+    cohort = []
+    for index, patient in enumerate(metrics['patients'].tolist()):
+        latest = {'{}_{}d'.format(name, window): _values(metrics['{}_{}d'.format(name, window)][last[index]:last[index] + 1])[0]
+                  for name in ROLLING_METRICS for window in ROLLING_WINDOWS}
+        cohort.append({
+            'patient_id': patient,
+            'nights': int(metrics['rows'][index]),
+            'summary': _patient_summary(metrics, index),
+            'stress_levels': _stress_distribution(metrics, index),
+            'latest_rolling': latest,
+            'anomalies': {'spo2_dip': int(spo2_dips[index]), 'heart_rate_outlier': int(heart_rate_outliers[index])},
+        })
+    return {'patients': cohort}
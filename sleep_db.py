@@ -0,0 +1,268 @@
+import argparse
+import glob
+import heapq
+import json
+import os
+
+from bulk_load import bulk_load_csv
+from db_pool import close_all_pools, connection
+from migrations import OBSERVATION_SELECT, apply_migrations
+from shards import (DEFAULT_RANGE_SIZE, STRATEGIES, fan_out, fan_out_patients, rebalance, reset_routers, shard_for,
+                    shard_files)
+
+
+# SQLite data-access layer for the sleep database: building it from the CSV
+# exports and the read queries behind the API. Nothing here imports Flask or the
+# fhir.resources models, so batch jobs and CLI tools that only need the tables
+# start in a fraction of the server's import time. Reads of one patient go to
+# the shard holding the patient and reads over everyone fan out to every shard
+# (see shards.py), e.g.
+#
+#   python sleep_db.py init sleep_data.db data/patients.csv data/sleep_observation.csv [--shards 4]
+
+DEFAULT_PATIENTS_CSV = "data/patients.csv"
+DEFAULT_OBSERVATIONS_CSV = "data/sleep_observation.csv"
+
+
+# Function to create the Patients table from a CSV file
+def create_table_from_csv(db_name, csv_filename, **load_options):
+    with connection(db_name) as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS Patients (
+            Patient_ID INTEGER PRIMARY KEY,
+            First_Name TEXT,
+            Last_Name TEXT,
+            Date_of_Birth DATE,
+            Gender TEXT,
+            Phone_Number TEXT,
+            Email TEXT,
+            Address TEXT,
+            City TEXT,
+            State TEXT,
+            Zip_Code TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+        conn.commit()
+
+    bulk_load_csv(db_name, csv_filename, 'Patients', columns=[
+        'Patient_ID', 'First_Name', 'Last_Name', 'Date_of_Birth', 'Gender', 'Phone_Number',
+        'Email', 'Address', 'City', 'State', 'Zip_Code'
+    ], **load_options)
+
+    print(f"Table 'Patients' has been created and populated with data from '{csv_filename}'.")
+
+def create_sleep_observations_table(db_name, csv_filename, **load_options):
+    # Connect to SQLite database (creates a new database if it doesn't exist)
+    with connection(db_name) as conn:
+        cursor = conn.cursor()
+
+        # Create sleep_observations table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sleep_observations (
+                patient_id INTEGER,
+                snoring_rate REAL,
+                respiratory_rate REAL,
+                body_temperature REAL,
+                limb_movement REAL,
+                blood_oxygen REAL,
+                eye_movement REAL,
+                sleeping_hours REAL,
+                heart_rate INTEGER,
+                stress_level INTEGER,
+                observation_date TEXT,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (patient_id, observation_date)
+            )
+        ''')
+
+        conn.commit()
+
+    # Stream the CSV in with executemany, one chunk at a time
+    bulk_load_csv(db_name, csv_filename, 'sleep_observations', columns=[
+        'patient_id', 'snoring_rate', 'respiratory_rate', 'body_temperature',
+        'limb_movement', 'blood_oxygen', 'eye_movement', 'sleeping_hours',
+        'heart_rate', 'stress_level', 'observation_date'
+    ], **load_options)
+
+    print(f"Table 'sleep_observations' has been created and populated with data from '{csv_filename}'.")
+
+def remove_database(db_name, extra_paths=()):
+    # Deletes the database file, its WAL/SHM files, its shard files and `extra_paths` (glob patterns)
+    close_all_pools()
+    reset_routers()
+    paths = [db_name, db_name + "-wal", db_name + "-shm"] + shard_files(db_name)
+    for pattern in extra_paths:
+        paths.extend(glob.glob(pattern))
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def init_db(db_name, patients_csv=DEFAULT_PATIENTS_CSV, observations_csv=DEFAULT_OBSERVATIONS_CSV, extra_paths=(),
+            shards=1, strategy='hash', range_size=DEFAULT_RANGE_SIZE):
+    """Rebuild the database from the CSV exports.
+
+    Any existing database (and the files matched by `extra_paths`) is removed
+    first; indexes and change tracking are added by the migrations after the
+    bulk load. With `shards` above 1 the rows are then spread over that many
+    shard files.
+    """
+    remove_database(db_name, extra_paths)
+    create_table_from_csv(db_name, patients_csv)
+    create_sleep_observations_table(db_name, observations_csv)
+    apply_migrations(db_name)
+    if shards > 1:
+        rebalance(db_name, shards, strategy, range_size)
+
+# Function to read patient data based on Patient_ID
+def read_patient_data(db_name, patient_id):
+    with connection(shard_for(db_name, patient_id)) as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT * FROM Patients WHERE Patient_ID = ?", (patient_id,))
+        patient_data = cursor.fetchone()
+
+    return patient_data
+
+def read_patient_sleep_data(db_name, patient_id):
+    with connection(shard_for(db_name, patient_id)) as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(""" SELECT  {}
+                           FROM    sleep_observations
+                           WHERE   patient_id = ? AND body_temperature is not null
+                           ORDER BY observation_date""".format(OBSERVATION_SELECT), (patient_id,))
+        patient_obs_data = cursor.fetchall()
+    # Correct
+    return patient_obs_data
+
+def read_patient_observation_store(db_name, patient_id):
+    # The same rows as read_patient_sleep_data, as a compact ObservationStore
+    from observation_store import ObservationStore  # NumPy is only loaded by callers that need it
+
+    with connection(shard_for(db_name, patient_id)) as conn:
+        cursor = conn.execute(""" SELECT  {}
+                                  FROM    sleep_observations
+                                  WHERE   patient_id = ? AND body_temperature is not null
+                                  ORDER BY observation_date""".format(OBSERVATION_SELECT), (patient_id,))
+        return ObservationStore.from_cursor(cursor, patient_id)
+
+def read_patient_sleep_data_page(db_name, patient_id, count, date_filters=(), descending=False, cursor=None):
+    # Keyset pagination over the (patient_id, observation_date) primary key.
+    # `date_filters` is a list of (operator, date) pairs and `cursor` a
+    # ('next' | 'previous', observation_date) pair taken from the neighbouring page.
+    # Returns the page in display order and whether more rows lie beyond it.
+    conditions = ["patient_id = ?", "body_temperature is not null"]
+    params = [patient_id]
+    for operator, value in date_filters:
+        conditions.append("observation_date {} ?".format(operator))
+        params.append(value)
+
+    backwards = False
+    if cursor is not None:
+        direction, boundary = cursor
+        backwards = direction == 'previous'
+        conditions.append("observation_date {} ?".format('<' if descending != backwards else '>'))
+        params.append(boundary)
+
+    query = "SELECT {} FROM sleep_observations WHERE {} ORDER BY observation_date {} LIMIT ?".format(
+        OBSERVATION_SELECT, " AND ".join(conditions), 'DESC' if descending != backwards else 'ASC')
+    params.append(count + 1)
+
+    with connection(shard_for(db_name, patient_id)) as conn:
+        rows = conn.execute(query, params).fetchall()
+
+    has_more = len(rows) > count
+    rows = rows[:count]
+    if backwards:
+        rows.reverse()
+    return rows, has_more
+
+def read_observation_dates(db_name, patient_id):
+    with connection(shard_for(db_name, patient_id)) as conn:
+        cursor = conn.execute("SELECT observation_date FROM sleep_observations WHERE patient_id = ? ORDER BY observation_date",
+                              (patient_id,))
+        return cursor.fetchall()
+
+def _read_patients(shard, patient_ids):
+    # The whole id list is one json_each parameter, so its length is not bound by SQLite's variable limit
+    with connection(shard) as conn:
+        return conn.execute("SELECT * FROM Patients WHERE Patient_ID IN (SELECT value FROM json_each(?)) ORDER BY Patient_ID",
+                            (json.dumps(patient_ids),)).fetchall()
+
+def read_patients(db_name, patient_ids):
+    # Patients rows of the given ids that exist, ordered by Patient_ID; one query per shard
+    return list(heapq.merge(*fan_out_patients(db_name, sorted(set(patient_ids)), _read_patients)))
+
+def _observations_page(conn, patient_ids, count, after):
+    # Up to `count` rows of the patients, ordered by (patient_id, observation_date)
+    # and starting after the `after` key. Patients before the key are left out of
+    # the IN list, so the primary key is walked from the key on without a sort.
+    conditions = ["patient_id IN (SELECT value FROM json_each(?))", "body_temperature is not null"]
+    params = []
+    if after is not None:
+        patient_ids = [patient_id for patient_id in patient_ids if patient_id >= after[0]]
+        conditions.append("(patient_id > ? OR observation_date > ?)")
+        params = list(after)
+    query = "SELECT {} FROM sleep_observations WHERE {} ORDER BY patient_id, observation_date LIMIT ?".format(
+        OBSERVATION_SELECT, " AND ".join(conditions))
+    return conn.execute(query, [json.dumps(patient_ids)] + params + [count]).fetchall()
+
+def _read_observations_page(shard, patient_ids, count, after):
+    with connection(shard) as conn:
+        return _observations_page(conn, patient_ids, count, after)
+
+def read_observations_page(db_name, patient_ids, count, after=None):
+    # Keyset pagination over the observations of several patients, in
+    # (patient_id, observation_date) order. `after` is the (patient_id,
+    # observation_date) of the last row of the previous page. Every shard returns
+    # its first count + 1 rows and the pages are merged. Returns the page and
+    # whether more rows lie beyond it.
+    pages = fan_out_patients(db_name, sorted(set(patient_ids)), _read_observations_page, count + 1, after)
+    rows = list(heapq.merge(*pages, key=lambda row: (row[0], row[10])))[:count + 1]
+    return rows[:count], len(rows) > count
+
+def read_patient_everything(db_name, patient_id, count, after=None):
+    # The Patients row and one page of read_observations_page for one patient,
+    # read on one connection. Returns (patient, rows, has_more); patient is None
+    # when there is no such patient.
+    with connection(shard_for(db_name, patient_id)) as conn:
+        patient = conn.execute("SELECT * FROM Patients WHERE Patient_ID = ?", (patient_id,)).fetchone()
+        if patient is None:
+            return None, [], False
+        rows = _observations_page(conn, [patient_id], count + 1, after)
+    return patient, rows[:count], len(rows) > count
+
+def _read_names(shard):
+    # Without the ORDER BY, SQLite answers from the name index in name order
+    with connection(shard) as conn:
+        return conn.execute("SELECT Patient_ID, First_Name, Last_Name FROM Patients ORDER BY Patient_ID").fetchall()
+
+def read_patient_names(db_name):
+    # (Patient_ID, First_Name, Last_Name) of every patient in Patient_ID order, read from the shards in parallel
+    return list(heapq.merge(*fan_out(db_name, _read_names)))
+
+def _count_rows(shard, table_name):
+    with connection(shard) as conn:
+        return conn.execute("SELECT COUNT(*) FROM {}".format(table_name)).fetchone()[0]
+
+def count_records(db_name, table_name):
+    return sum(fan_out(db_name, _count_rows, table_name))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the sleep database from the CSV exports.")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    init = subcommands.add_parser('init', help="delete and rebuild the database, then apply the migrations")
+    init.add_argument('db_name')
+    init.add_argument('patients_csv', nargs='?', default=DEFAULT_PATIENTS_CSV)
+    init.add_argument('observations_csv', nargs='?', default=DEFAULT_OBSERVATIONS_CSV)
+    init.add_argument('--shards', type=int, default=1, help="spread the patients over this many SQLite files")
+    init.add_argument('--strategy', choices=STRATEGIES, default='hash')
+    init.add_argument('--range-size', type=int, default=DEFAULT_RANGE_SIZE)
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        init_db(args.db_name, args.patients_csv, args.observations_csv,
+                shards=args.shards, strategy=args.strategy, range_size=args.range_size)
@@ -0,0 +1,161 @@
+import json
+import os
+
+
+# Code systems for the sleep Observation and its components. A Terminology is
+# built once at startup: the CodeableConcept of every component is precomputed
+# both as the dict that fhir.resources' .dict() would produce (shared by the fast
+# serializers) and, on first use, as a validated fhir.resources CodeableConcept
+# (shared by the pydantic builders). Everything handed out is shared between
+# observations, so callers must treat it as read-only.
+#
+# Alternative or additional codings (e.g. SNOMED CT, ICD-10) are loaded from a
+# JSON file named by FHIR_TERMINOLOGY_FILE:
+#
+#   {"observation": [{"system": "loinc", "code": "LOINC_CODE", "display": "Sleep Observation"}],
+#    "components": {"Heart Rate": [{"system": "loinc", "code": "8867-4"},
+#                                  {"system": "snomed", "code": "364075005"}]}}
+#
+# Components missing from the file keep their default LOINC coding; a display
+# defaults to the component text.
+
+LOINC_SYSTEM = "http://loinc.org"
+SNOMED_SYSTEM = "http://snomed.info/sct"
+ICD10_SYSTEM = "http://hl7.org/fhir/sid/icd-10"
+
+SYSTEM_ALIASES = {
+    'loinc': LOINC_SYSTEM,
+    'snomed': SNOMED_SYSTEM,
+    'snomed-ct': SNOMED_SYSTEM,
+    'icd-10': ICD10_SYSTEM,
+    'icd10': ICD10_SYSTEM,
+}
+
+loinc_codes = {
+    'Snoring Rate': 'R06.83',
+    'Limb Movement': 'G47.6',
+    'Heart Rate': '8889-8',
+    'Sleeping Hours': '45550-1',
+    'Stress Level': '76542-0',
+    'Eye Movement': 'H55.89',
+    'Blood Oxygen': '20564-1',
+    'Body Temperature': '8310-5',
+    'Respiratory Rate': '9279-1'
+ }
+
+# Placeholder code of the Observation itself, as published by the API so far
+SLEEP_OBSERVATION_TEXT = "Sleep Observation"
+SLEEP_OBSERVATION_CODINGS = [(LOINC_SYSTEM, "LOINC_CODE", SLEEP_OBSERVATION_TEXT)]
+
+
+def _coding_fragment(system, code, display):
+    return {"system": system, "code": code, "display": display}
+
+
+class Terminology:
+
+    def __init__(self, component_codings, observation_codings=SLEEP_OBSERVATION_CODINGS):
+        # component_codings: {component text: [(system, code, display), ...]}
+        self.component_codings = {text: [tuple(coding) for coding in codings]
+                                  for text, codings in component_codings.items()}
+        self.observation_codings = [tuple(coding) for coding in observation_codings]
+
+        self._fragments = {
+            text: {"coding": [_coding_fragment(*coding) for coding in codings], "text": text}
+            for text, codings in self.component_codings.items()
+        }
+        self._text_fragments = {text: {"text": text} for text in self.component_codings}
+        self._text_fragments["Observation Date"] = {"text": "Observation Date"}
+        self._observation_fragment = {"coding": [_coding_fragment(*coding) for coding in self.observation_codings],
+                                      "text": SLEEP_OBSERVATION_TEXT}
+        # (system, code) -> component text, for mapping incoming FHIR back to columns
+        self._texts_by_code = {(system, code): text
+                               for text, codings in self.component_codings.items()
+                               for system, code, _ in codings}
+        self._concepts = {}
+
+    @classmethod
+    def from_loinc(cls, codes):
+        return cls({text: [(LOINC_SYSTEM, code, text)] for text, code in codes.items()})
+
+    def code(self, text, system=LOINC_SYSTEM):
+        # The component's code in `system`, or None
+        for coding_system, code, _ in self.component_codings.get(text, ()):
+            if coding_system == system:
+                return code
+        return None
+
+    def component_text(self, system, code):
+        return self._texts_by_code.get((system, code))
+
+    # Dict fragments for the fast serializers
+
+    def fragment(self, text):
+        return self._fragments[text]
+
+    def text_fragment(self, text):
+        return self._text_fragments[text]
+
+    def observation_fragment(self):
+        return self._observation_fragment
+
+    # Validated fhir.resources objects for the pydantic builders, built on first use
+
+    def _concept(self, key, build):
+        concept = self._concepts.get(key)
+        if concept is None:
+            from fhir.resources.codeableconcept import CodeableConcept
+            concept = self._concepts[key] = CodeableConcept.parse_obj(build())
+        return concept
+
+    def concept(self, text):
+        return self._concept(('coded', text), lambda: self._fragments[text])
+
+    def text_concept(self, text):
+        return self._concept(('text', text), lambda: self._text_fragments[text])
+
+    def observation_concept(self):
+        return self._concept(('observation',), lambda: self._observation_fragment)
+
+
+def _system(value):
+    return SYSTEM_ALIASES.get(value.lower(), value) if value else LOINC_SYSTEM
+
+
+def load_terminology(path):
+    """Build a Terminology from a JSON code system file, over the default LOINC codes.
+
+    Raises ValueError when the file names an unknown component or a coding
+    without a code.
+    """
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    def codings(entries, display):
+        result = []
+        for entry in entries:
+            if not entry.get('code'):
+                raise ValueError('{}: every coding needs a code'.format(path))
+            result.append((_system(entry.get('system')), str(entry['code']), entry.get('display') or display))
+        return result
+
+    component_codings = {text: [(LOINC_SYSTEM, code, text)] for text, code in loinc_codes.items()}
+    for text, entries in (config.get('components') or {}).items():
+        if text not in component_codings:
+            raise ValueError('{}: unknown component {!r}'.format(path, text))
+        component_codings[text] = codings(entries, text)
+
+    observation_codings = SLEEP_OBSERVATION_CODINGS
+    if config.get('observation'):
+        observation_codings = codings(config['observation'], SLEEP_OBSERVATION_TEXT)
+
+    return Terminology(component_codings, observation_codings)
+
+
+default_terminology = Terminology.from_loinc(loinc_codes)
+
+# The terminology every builder and serializer uses
+if os.environ.get('FHIR_TERMINOLOGY_FILE'):
+    terminology = load_terminology(os.environ['FHIR_TERMINOLOGY_FILE'])
+else:
+    terminology = default_terminology
@@ -0,0 +1,34 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def db(tmp_path):
+    # An empty, fully migrated sleep database
+    from db_pool import close_all_pools
+    from shards import migrate, reset_routers
+
+    db_name = str(tmp_path / 'sleep_data.db')
+    migrate(db_name)
+    yield db_name
+    close_all_pools()
+    reset_routers()
+
+
+@pytest.fixture(scope='module')
+def app_module():
+    # fhir-sleepdata.py with the response cache off; point its db_name at a test database
+    spec = importlib.util.spec_from_file_location('fhir_sleepdata', os.path.join(ROOT, 'fhir-sleepdata.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.response_cache.max_bytes = 0
+    yield module
+    sys.modules.pop('fhir_sleepdata', None)
@@ -0,0 +1,168 @@
+import asyncio
+import importlib.util
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT
+
+
+@pytest.fixture
+def asgi(db, monkeypatch):
+    # A fresh asgi.py, whose app reads the `db` fixture's sleep_data.db and the
+    # credentials.db and write-behind journal beside it
+    monkeypatch.chdir(os.path.dirname(db))
+    conn = sqlite3.connect('credentials.db')
+    conn.execute("CREATE TABLE users (username TEXT, password TEXT)")
+    conn.execute("INSERT INTO users VALUES ('ada', 'secret')")
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(db)
+    conn.execute("INSERT INTO Patients (Patient_ID, First_Name, Last_Name) VALUES (1, 'Ada', 'Lovelace')")
+    conn.executemany("""
+        INSERT INTO sleep_observations (patient_id, observation_date, snoring_rate, respiratory_rate,
+            body_temperature, limb_movement, blood_oxygen, eye_movement, sleeping_hours, heart_rate, stress_level)
+        VALUES (1, ?, 40, 16, 97.5, 8, 95, 80, 7, 60, 2)
+    """, [('2023-01-0{}'.format(day),) for day in (1, 2, 3)])
+    conn.commit()
+    conn.close()
+
+    spec = importlib.util.spec_from_file_location('asgi', os.path.join(ROOT, 'asgi.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+    module.flask_app.extensions['write_queue'].close()
+    module._readers.shutdown()
+    module._writer.shutdown()
+    sys.modules.pop('fhir_sleepdata', None)
+
+
+def scope(method, path, query=b'', headers=()):
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'root_path': '',
+            'headers': [(b'host', b'localhost')] + list(headers), 'server': ('localhost', 80),
+            'client': ('127.0.0.1', 5000), 'scheme': 'http', 'http_version': '1.1'}
+
+
+async def request(asgi, method, path, query=b'', body=b'', headers=()):
+    # (status, headers, body) of one request through the ASGI app
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.app(scope(method, path, query, headers), receive, send)
+    assert sent[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+    return sent[0]['status'], sent[0]['headers'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def json_request(asgi, path, data):
+    body = json.dumps(data).encode()
+    return request(asgi, 'POST', path, body=body, headers=[(b'content-type', b'application/json'),
+                                                          (b'content-length', str(len(body)).encode())])
+
+
+def post_json(asgi, path, data):
+    return asyncio.run(json_request(asgi, path, data))
+
+
+@pytest.mark.parametrize('path, query', [
+    ('/fhir/patient/1', b''),
+    ('/fhir/patient/999', b''),
+    ('/fhir/sleep-observations/1', b'_count=2'),
+    ('/fhir/Observation', b'patient=1&_fast=true'),
+    ('/fhir/names', b''),
+    ('/fhir/dates/1', b''),
+    ('/fhir/$export', b'_type=Observation'),
+])
+def test_responses_match_the_wsgi_app_byte_for_byte(asgi, path, query):
+    status, headers, body = asyncio.run(request(asgi, 'GET', path, query))
+    expected = asgi.flask_app.test_client().get(path, query_string=query.decode())
+    assert status == expected.status_code
+    assert body == expected.get_data()
+    assert sorted((name.decode(), value.decode()) for name, value in headers) == \
+        sorted((name.lower(), value) for name, value in expected.headers.items())
+
+
+@pytest.mark.parametrize('method, path, executor', [
+    ('GET', '/fhir/patient/1', '_readers'),
+    ('OPTIONS', '/verify_credentials', '_readers'),
+    ('POST', '/verify_credentials', '_readers'),
+    ('POST', '/add_credentials', '_readers'),
+    ('POST', '/fhir/insert_sleep_data', '_readers'),  # Write-behind only enqueues
+    ('POST', '/fhir/add_new_patient', '_writer'),
+    ('POST', '/fhir', '_writer'),
+    ('POST', '/fhir/delete_patient_obs', '_writer'),
+    ('POST', '/no/such/route', '_readers'),
+])
+def test_only_sleep_database_writes_take_the_writer_thread(asgi, method, path, executor):
+    assert asgi._executor_for(scope(method, path)) is getattr(asgi, executor)
+
+
+def test_credentials_and_writes_go_through(asgi, db):
+    assert post_json(asgi, '/verify_credentials', {'username': 'ada', 'password': 'secret'})[2] == \
+        b'{"exists":true}\n'
+    assert post_json(asgi, '/add_credentials', {'username': 'grace', 'password': 'hopper'})[0] == 201
+    assert post_json(asgi, '/verify_credentials', {'username': 'grace', 'password': 'hopper'})[2] == \
+        b'{"exists":true}\n'
+
+    assert post_json(asgi, '/fhir/delete_patient_obs', {'patient_id': 1, 'observation_date': '2023-01-01'})[0] == 200
+    conn = sqlite3.connect(db)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM sleep_observations").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+def test_shutdown_finishes_requests_and_queued_writes(asgi, db):
+    def slow():
+        time.sleep(0.2)
+        return 'done'
+
+    asgi.flask_app.add_url_rule('/slow', view_func=slow)
+    events = []
+
+    async def lifespan(messages):
+        async def receive():
+            return await messages.get()
+
+        async def send(message):
+            events.append(message['type'])
+
+        await asgi.app({'type': 'lifespan'}, receive, send)
+
+    async def run():
+        messages = asyncio.Queue()
+        server = asyncio.ensure_future(lifespan(messages))
+        await messages.put({'type': 'lifespan.startup'})
+        while 'lifespan.startup.complete' not in events:
+            await asyncio.sleep(0.01)
+
+        status, _, _ = await json_request(asgi, '/fhir/insert_sleep_data', {
+            'patient_id': 1, 'observation_date': '2023-01-04', 'snoring_rate': 40, 'respiratory_rate': 16,
+            'eye_movement': 80, 'sleeping_hours': 7, 'heart_rate': 60})
+        assert status == 202
+
+        in_flight = asyncio.ensure_future(request(asgi, 'GET', '/slow'))
+        await asyncio.sleep(0.05)
+        await messages.put({'type': 'lifespan.shutdown'})
+        status, _, body = await in_flight
+        events.append('slow finished')
+        await server
+        return status, body
+
+    assert asyncio.run(run()) == (200, b'done')
+    assert events == ['lifespan.startup.complete', 'slow finished', 'lifespan.shutdown.complete']
+    conn = sqlite3.connect(db)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM sleep_observations WHERE observation_date = '2023-01-04'"
+                            ).fetchone()[0] == 1
+    finally:
+        conn.close()
@@ -0,0 +1,81 @@
+import glob
+import gzip
+import json
+import os
+import sqlite3
+from datetime import date
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from columnar_export import bundle_batches, open_dataset, read_arrow_file, table_batches, write_dataset
+from test_fhir_ingest import observation
+
+PATIENTS = 60
+MONTHS = 20  # 1,200 patient/month partitions, more than pyarrow's default limit of 1,024
+
+
+def test_export_with_more_than_1024_partitions(db, tmp_path):
+    conn = sqlite3.connect(db)
+    try:
+        conn.executemany(
+            "INSERT INTO sleep_observations (patient_id, observation_date, heart_rate) VALUES (?, ?, ?)",
+            [(patient_id, date(2020 + month // 12, month % 12 + 1, day).isoformat(), patient_id)
+             for patient_id in range(1, PATIENTS + 1) for month in range(MONTHS) for day in (1, 11, 21)])
+        conn.commit()
+    finally:
+        conn.close()
+    rows = PATIENTS * MONTHS * 3
+
+    out_dir = str(tmp_path / 'arrow')
+    write_dataset(table_batches(db), out_dir, 'arrow')
+
+    dataset = open_dataset(out_dir, 'arrow')
+    assert dataset.count_rows() == rows
+    files = glob.glob(os.path.join(out_dir, 'patient_id=*', 'month=*', '*.arrow'))
+    assert len({os.path.dirname(path) for path in files}) == PATIENTS * MONTHS
+
+    patient = dataset.to_table(filter=ds.field('patient_id') == 7)
+    assert len(patient) == MONTHS * 3 and set(patient['heart_rate'].to_pylist()) == {7}
+    partition = os.path.join(out_dir, 'patient_id=7', 'month=2020-03')
+    assert sum(read_arrow_file(path).num_rows for path in glob.glob(os.path.join(partition, '*'))) == 3
+
+    parquet_dir = str(tmp_path / 'parquet')
+    write_dataset(table_batches(db), parquet_dir)
+    assert open_dataset(parquet_dir).count_rows() == rows
+
+
+def test_text_vitals_export_as_null(db):
+    conn = sqlite3.connect(db)
+    try:
+        conn.executemany("INSERT INTO sleep_observations (patient_id, observation_date, heart_rate, blood_oxygen) "
+                         "VALUES (?, ?, ?, ?)", [(1, '2023-01-01', 60, ''), (1, '2023-01-02', 'n/a', 95.5)])
+        conn.commit()
+    finally:
+        conn.close()
+
+    table = pa.Table.from_batches(list(table_batches(db)))
+    assert table['heart_rate'].to_pylist() == [60.0, None]
+    assert table['blood_oxygen'].to_pylist() == [None, 95.5]
+
+
+def test_bundle_batches_stream_gzipped_ndjson_and_bundles(tmp_path):
+    ndjson = str(tmp_path / 'export.ndjson.gz')
+    with gzip.open(ndjson, 'wt') as f:
+        for day in (1, 2):
+            f.write(json.dumps(observation(1, day, heart_rate=60 + day)) + '\n')
+    bundle = str(tmp_path / 'bundle.json')
+    with open(bundle, 'w') as f:
+        json.dump({'resourceType': 'Bundle', 'entry': [
+            {'resource': {'resourceType': 'Patient', 'id': '2'}},
+            {'resource': observation(2, 3, heart_rate=70)},
+            {'resource': dict(observation(2, 4), effectiveDateTime=None)},
+        ]}, f)
+
+    skipped = {}
+    table = pa.Table.from_batches(list(bundle_batches([ndjson, bundle], batch_size=2, skipped=skipped)))
+    assert table['patient_id'].to_pylist() == [1, 1, 2]
+    assert [day.isoformat() for day in table['observation_date'].to_pylist()] == \
+        ['2023-01-01', '2023-01-02', '2023-01-03']
+    assert table['heart_rate'].to_pylist() == [61.0, 62.0, 70.0]
+    assert skipped == {'count': 1}
@@ -0,0 +1,53 @@
+import json
+import random
+
+import pytest
+
+import fhir_builders
+from benchmarks.generate_data import observation_rows
+from fhir.resources.bundle import Bundle, BundleEntry
+from fhir_fast import ObservationBundleSerializer, check_conformance
+
+
+def sample_rows():
+    # Generated nights plus the awkward values real uploads contain
+    rows = [tuple(row) for patient_id in (1, 2, 3) for row in observation_rows(random.Random(patient_id), patient_id, 60)]
+    rows.append((4, None, 16.0, 96.5, None, 97.0, 60.0, 7.5, None, 0, '2023-01-01'))
+    rows.append((4, 0, 0.0, 96.5, 4.0, 97.0, 60.0, 0.0, 0, None, '2023-01-02'))
+    rows.append((4, '45.5', '16', 96.5, 4.0, 97.0, 60.0, 7.5, 55, 2, '2023-01-03'))
+    return rows
+
+
+def as_json(bundle):
+    return json.dumps(bundle, sort_keys=True, default=str)
+
+
+@pytest.mark.parametrize('coded', [False, True])
+def test_sample_validates_against_fhir_resources(coded):
+    rows = sample_rows()
+    assert check_conformance(ObservationBundleSerializer(coded=coded), rows, sample_size=len(rows)) == len(rows)
+
+
+@pytest.mark.parametrize('coded, build', [(False, fhir_builders.text_observation), (True, fhir_builders.loinc_observation)])
+def test_fast_bundle_matches_pydantic_bundle(coded, build):
+    rows = sample_rows()
+    bundle = Bundle(type="searchset")
+    bundle.entry = [BundleEntry(resource=build(obs)) for obs in rows]
+    assert as_json(ObservationBundleSerializer(coded=coded).bundle(rows)) == as_json(bundle.dict())
+
+
+def test_invalid_value_is_skipped_like_pydantic():
+    obs = (5, 'n/a', 16.0, 96.5, 4.0, 97.0, 60.0, 7.5, 55, 2, '2023-01-04')
+    fast = ObservationBundleSerializer(coded=True).observation(obs)
+    assert len(fast['component']) == 8
+    assert as_json(fast) == as_json(fhir_builders.loinc_observation(obs).dict())
+
+
+def test_check_conformance_reports_a_mismatch():
+    class Broken(ObservationBundleSerializer):
+        def observation(self, obs):
+            # fhir.resources drops empty fields, so this does not round-trip
+            return dict(super().observation(obs), subject={"reference": f"Patient/{obs[0]}", "display": None})
+
+    with pytest.raises(AssertionError):
+        check_conformance(Broken(coded=True), sample_rows()[:5])
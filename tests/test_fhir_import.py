@@ -0,0 +1,83 @@
+import gzip
+import json
+import os
+import sqlite3
+
+import pytest
+
+from fhir_import import import_file, iter_resources
+from test_fhir_ingest import observation
+
+DAYS = 5
+
+
+class Interrupted(Exception):
+    pass
+
+
+def write_source(tmp_path, kind, heart_rate=60):
+    # Observations of patient 1 on days 1..DAYS, plus a Patient that is not imported
+    resources = [{'resourceType': 'Patient', 'id': '1'}] + [
+        observation(1, day, heart_rate + day) for day in range(1, DAYS + 1)]
+    if kind == 'bundle':
+        path = str(tmp_path / 'bundle.json')
+        with open(path, 'w') as f:
+            json.dump({'resourceType': 'Bundle', 'entry': [{'resource': r} for r in resources]}, f)
+    else:
+        path = str(tmp_path / 'export.ndjson.gz')
+        with gzip.open(path, 'wt') as f:
+            f.writelines(json.dumps(r) + '\n' for r in resources)
+    return path
+
+
+def stored(db):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute("SELECT observation_date, heart_rate FROM sleep_observations ORDER BY 1").fetchall()
+    finally:
+        conn.close()
+
+
+def interrupt_after_first_batch(state):
+    raise Interrupted()
+
+
+@pytest.mark.parametrize('kind', ['bundle', 'ndjson.gz'])
+def test_interrupted_import_resumes_after_the_last_batch(db, tmp_path, kind):
+    path = write_source(tmp_path, kind)
+    with pytest.raises(Interrupted):
+        import_file(db, path, batch_size=2, progress=interrupt_after_first_batch)
+    assert [row[0] for row in stored(db)] == ['2023-01-01', '2023-01-02']
+
+    batches = []
+    result = import_file(db, path, batch_size=2, progress=lambda state: batches.append(state['resources']))
+    # The Patient and the first two Observations are not read again
+    assert result['resumed_from'] > 0 and batches == [5, 6]
+    assert result['resources'] == DAYS + 1 and result['imported'] == DAYS and result['completed'] == 1
+    assert stored(db) == [('2023-01-0{}'.format(day), 60 + day) for day in range(1, DAYS + 1)]
+
+
+def test_resumed_gzip_offsets_count_uncompressed_bytes(tmp_path):
+    path = write_source(tmp_path, 'ndjson.gz')
+    resources = list(iter_resources(path))
+    assert resources[-1][1] > os.path.getsize(path)  # Compressed, so the offsets run past the file size
+    assert list(iter_resources(path, resources[2][1])) == resources[3:]
+
+
+def test_reimport_is_idempotent(db, tmp_path):
+    path = write_source(tmp_path, 'bundle')
+    import_file(db, path, batch_size=2)
+    expected = stored(db)
+
+    # A completed, unchanged file is not read again
+    assert import_file(db, path, batch_size=2, progress=interrupt_after_first_batch)['completed'] == 1
+    # Importing it from the start upserts the same rows
+    assert import_file(db, path, batch_size=2, resume=False)['imported'] == DAYS
+    assert stored(db) == expected
+
+    # A changed file invalidates the checkpoint and its rows replace the old ones
+    os.remove(path)
+    path = write_source(tmp_path, 'bundle', heart_rate=70)
+    os.utime(path, ns=(1, 1))
+    assert import_file(db, path, batch_size=2)['resumed_from'] == 0
+    assert stored(db) == [('2023-01-0{}'.format(day), 70 + day) for day in range(1, DAYS + 1)]
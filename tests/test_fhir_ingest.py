@@ -0,0 +1,78 @@
+import sqlite3
+
+import pytest
+
+from fhir_ingest import BundleError, process_bundle
+from shards import ShardConnections
+
+
+def observation(patient_id, day, heart_rate=60):
+    return {
+        'resourceType': 'Observation', 'status': 'final', 'code': {'text': 'Sleep Observation'},
+        'subject': {'reference': 'Patient/{}'.format(patient_id)},
+        'effectiveDateTime': '2023-01-{:02d}'.format(day),
+        'component': [{'code': {'text': 'Heart Rate'}, 'valueQuantity': {'value': heart_rate}}],
+    }
+
+
+def entry(resource, method='POST'):
+    return {'resource': resource, 'request': {'method': method, 'url': resource['resourceType']}}
+
+
+def apply(db_name, bundle_type, entries):
+    with ShardConnections(db_name) as shards:
+        return process_bundle(shards, {'resourceType': 'Bundle', 'type': bundle_type, 'entry': entries})
+
+
+def statuses(response):
+    return [e['response']['status'] for e in response['entry']]
+
+
+def stored_days(db_name):
+    conn = sqlite3.connect(db_name)
+    try:
+        return [row[0] for row in conn.execute("SELECT observation_date FROM sleep_observations ORDER BY 1")]
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def rejecting_db(db):
+    # SQLite refuses heart_rate 666, standing in for any row-level database error
+    conn = sqlite3.connect(db)
+    conn.execute('''CREATE TRIGGER reject_heart_rate BEFORE INSERT ON sleep_observations
+                    WHEN NEW.heart_rate = 666 BEGIN SELECT RAISE(ABORT, 'rejected heart rate'); END''')
+    conn.commit()
+    conn.close()
+    return db
+
+
+def test_malformed_entries_fail_alone_in_a_batch(db):
+    bad_date = dict(observation(1, 3), effectiveDateTime=20230103)
+    bad_component = dict(observation(1, 4), component=['not an object'])
+    response = apply(db, 'batch', [entry(observation(1, 1)), 'not an entry', bad_date, bad_component,
+                                   {'resource': observation(1, 5), 'request': ['POST']}])
+    assert statuses(response) == ['201 Created'] + ['400 Bad Request'] * 4
+    assert stored_days(db) == ['2023-01-01']
+
+
+def test_malformed_entry_rejects_a_transaction(db):
+    with pytest.raises(BundleError) as error:
+        apply(db, 'transaction', [entry(observation(1, 1)), 7])
+    assert error.value.status == 400
+    assert stored_days(db) == []
+
+
+def test_database_error_fails_only_its_batch_entry(rejecting_db):
+    response = apply(rejecting_db, 'batch', [entry(observation(1, 1)), entry(observation(1, 2, heart_rate=666)),
+                                             entry(observation(1, 3), 'PUT')])
+    assert statuses(response) == ['201 Created', '500 Internal Server Error', '201 Created']
+    assert 'rejected heart rate' in response['entry'][1]['response']['outcome']['issue'][0]['diagnostics']
+    assert stored_days(rejecting_db) == ['2023-01-01', '2023-01-03']
+
+
+def test_database_error_rolls_back_a_transaction(rejecting_db):
+    with pytest.raises(BundleError) as error:
+        apply(rejecting_db, 'transaction', [entry(observation(1, 1)), entry(observation(1, 2, heart_rate=666))])
+    assert error.value.status == 500
+    assert stored_days(rejecting_db) == []
@@ -0,0 +1,105 @@
+import sqlite3
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+
+@pytest.fixture
+def client(app_module, db, monkeypatch):
+    monkeypatch.setattr(app_module, 'db_name', db)
+    conn = sqlite3.connect(db)
+    try:
+        conn.execute("INSERT INTO Patients (Patient_ID, First_Name, Last_Name) VALUES (1, 'Ada', 'Lovelace')")
+        conn.executemany("""
+            INSERT INTO sleep_observations (patient_id, observation_date, body_temperature, heart_rate)
+            VALUES (?, ?, 97.0, 60)
+        """, [(patient_id, '2023-01-0{}'.format(day)) for patient_id in (1, 2) for day in (1, 2, 3)])
+        conn.commit()
+    finally:
+        conn.close()
+    return app_module.app.test_client()
+
+
+def follow(client, url):
+    # Every page of a searchset, and the query of each next link
+    pages, queries = [], []
+    while url:
+        bundle = client.get(url).get_json()
+        pages.append(bundle)
+        url = next((link['url'] for link in bundle.get('link') or [] if link['relation'] == 'next'), None)
+        if url:
+            queries.append(parse_qs(urlsplit(url).query))
+    return pages, queries
+
+
+@pytest.mark.parametrize('url, expected', [('/fhir/Observation?patient=1&patient=2&_count=2&_fast=true', 6),
+                                           ('/fhir/Patient/1/$everything?_count=2&_fast=true', 3)])
+def test_next_links_keep_the_query(client, url, expected):
+    pages, queries = follow(client, url)
+    assert len(pages) == -(-expected // 2)
+    original = parse_qs(urlsplit(url).query)
+    for query in queries:
+        assert query.pop('_cursor') and query == original
+    observations = [entry['resource'] for page in pages for entry in page.get('entry', [])
+                    if entry['resource']['resourceType'] == 'Observation']
+    assert len(observations) == expected
+
+
+@pytest.fixture
+def nights_client(client, db):
+    # Patient 3 with five complete nights, 2023-01-01 to 2023-01-05
+    conn = sqlite3.connect(db)
+    try:
+        conn.executemany("""
+            INSERT INTO sleep_observations (patient_id, observation_date, snoring_rate, respiratory_rate,
+                body_temperature, limb_movement, blood_oxygen, eye_movement, sleeping_hours, heart_rate, stress_level)
+            VALUES (3, ?, 50, 16, 97, 10, 95, 80, 7, 60, 2)
+        """, [('2023-01-0{}'.format(day),) for day in range(1, 6)])
+        conn.commit()
+    finally:
+        conn.close()
+    return client
+
+
+def page_dates(bundle):
+    return [component['valueString'] for entry in bundle['entry'] for component in entry['resource']['component']
+            if component['code']['text'] == 'Observation Date']
+
+
+def link(bundle, relation):
+    return next((l['url'] for l in bundle.get('link') or [] if l['relation'] == relation), None)
+
+
+@pytest.mark.parametrize('fast', ['true', 'false'])
+def test_sleep_observations_page_forwards_and_back(nights_client, fast):
+    first = nights_client.get('/fhir/sleep-observations/3?_count=2&_fast=' + fast).get_json()
+    assert page_dates(first) == ['2023-01-01', '2023-01-02'] and link(first, 'previous') is None
+    second = nights_client.get(link(first, 'next')).get_json()
+    assert page_dates(second) == ['2023-01-03', '2023-01-04']
+    assert parse_qs(urlsplit(link(second, 'next')).query)['_fast'] == [fast]
+    back = nights_client.get(link(second, 'previous')).get_json()
+    assert page_dates(back) == ['2023-01-01', '2023-01-02']
+    last = nights_client.get(link(second, 'next')).get_json()
+    assert page_dates(last) == ['2023-01-05'] and link(last, 'next') is None
+
+
+def test_sleep_observations_date_filters_and_sort(nights_client):
+    bundle = nights_client.get('/fhir/sleep-observations/3?date=ge2023-01-02&date=le2023-01-04&_sort=-date'
+                               '&_fast=true').get_json()
+    assert page_dates(bundle) == ['2023-01-04', '2023-01-03', '2023-01-02']
+    bundle = nights_client.get('/fhir/sleep-observations/3?date=2023-01-05&_fast=true').get_json()
+    assert page_dates(bundle) == ['2023-01-05']
+    descending = nights_client.get('/fhir/sleep-observations/3?_sort=-date&_count=3&_fast=true').get_json()
+    assert page_dates(nights_client.get(link(descending, 'next')).get_json()) == ['2023-01-02', '2023-01-01']
+
+
+@pytest.mark.parametrize('query', ['_count=0', '_count=x', '_sort=name', 'date=ge2023-13-01', 'date=xx2023-01-01',
+                                   '_cursor=WyJuZXh0IiwgWyJ4Il1d', '_cursor=WyJuZXh0IiwgIngiXQ==', '_cursor=!!'])
+def test_sleep_observations_rejects_bad_parameters(nights_client, query):
+    assert nights_client.get('/fhir/sleep-observations/3?' + query).status_code == 400
+
+
+def test_batched_cursor_must_hold_a_patient_and_date(client):
+    # ["next", [1, "x"]]
+    response = client.get('/fhir/Observation?subject=1&_cursor=WyJuZXh0IiwgWzEsICJ4Il1d')
+    assert response.status_code == 400
@@ -0,0 +1,30 @@
+import sqlite3
+
+import pytest
+
+import migrations
+from migrations import LATEST_VERSION, MIGRATIONS, apply_migrations, current_version, verify_query_plans
+
+
+def test_query_plans_use_the_migration_indexes():
+    expected = sum(len(plan_checks) for _, _, _, plan_checks in MIGRATIONS)
+    assert expected > 0
+    assert verify_query_plans() == expected
+
+
+def test_a_plan_regression_is_reported(monkeypatch):
+    query = "SELECT * FROM sleep_observations WHERE stress_level = ?"
+    monkeypatch.setattr(migrations, 'MIGRATIONS', MIGRATIONS + [
+        (LATEST_VERSION + 1, 'unindexed', lambda conn: None, [(query, (1,), 'USING INDEX', None)]),
+    ])
+    with pytest.raises(AssertionError, match='unindexed'):
+        verify_query_plans()
+
+
+def test_migrations_are_applied_once(db):
+    assert apply_migrations(db) == []
+    conn = sqlite3.connect(db)
+    try:
+        assert current_version(conn) == LATEST_VERSION
+    finally:
+        conn.close()
@@ -0,0 +1,98 @@
+import sqlite3
+
+import pytest
+
+from patient_search import search_patients
+from shards import rebalance, reset_routers
+
+PEOPLE = [
+    (1, 'John', 'Doe', 'john.doe@example.com', '555-0123'),
+    (2, 'Jane', 'Doe', 'jane@example.org', '555-0199'),
+    (3, 'Johanna', 'Smith', 'jo.smith@example.com', '555-0456'),
+    (4, 'Ada', 'Lovelace', 'ada@example.com', '555-1815'),
+    (5, 'Mary', None, 'mary-jo@example.com', None),
+] + [(patient_id, 'Jo{}'.format(patient_id), 'Name{:02d}'.format(patient_id % 7), None, None)
+     for patient_id in range(6, 31)]
+
+QUERIES = ['', 'jo', 'doe', 'jo do', 'JOHN', '555-01', 'john.d', 'example', 'mary jo', 'name03', 'zzz']
+
+
+@pytest.fixture
+def people(db):
+    conn = sqlite3.connect(db)
+    try:
+        conn.executemany("INSERT INTO Patients (Patient_ID, First_Name, Last_Name, Email, Phone_Number) "
+                         "VALUES (?, ?, ?, ?, ?)", PEOPLE)
+        conn.commit()
+    finally:
+        conn.close()
+    return db
+
+
+def ids(db, text, limit=100, offset=0):
+    rows, has_more = search_patients(db, text, limit, offset)
+    return [row[0] for row in rows], has_more
+
+
+def pages(db, text, limit=4):
+    result, offset = [], 0
+    while True:
+        page = ids(db, text, limit, offset)
+        result.append(page)
+        if not page[1]:
+            return result
+        offset += limit
+
+
+def test_matching_and_order(people):
+    assert ids(people, 'jo do') == ([1], False)
+    assert ids(people, '555-01') == ([2, 1], False)  # Ordered by name
+    assert ids(people, 'john.d') == ([1], False)
+    assert ids(people, 'mary jo') == ([5], False)
+    assert ids(people, 'zzz') == ([], False)
+    assert ids(people, '', 3) == ([5, 2, 1], True)  # NULL Last_Name first, as SQLite sorts it
+
+
+def test_index_follows_every_write(app_module, db, monkeypatch):
+    monkeypatch.setattr(app_module, 'db_name', db)
+    response = app_module.app.test_client().post('/fhir/add_new_patient', json={
+        'First_Name': 'Grace', 'Last_Name': 'Hopper', 'Date_of_Birth': '1906-12-09', 'Gender': 'female',
+        'Phone_Number': '555-1906', 'Email': 'grace@example.com', 'Address': '1 Navy Way', 'City': 'Arlington',
+        'State': 'VA', 'Zip_Code': '22202'})
+    assert response.status_code == 201
+    (patient_id,), _ = ids(db, 'grace hop')
+
+    conn = sqlite3.connect(db)
+    try:
+        conn.execute("UPDATE Patients SET Last_Name = 'Murray' WHERE Patient_ID = ?", (patient_id,))
+        conn.commit()
+        assert ids(db, 'hopper') == ([], False) and ids(db, 'grace murr') == ([patient_id], False)
+        conn.execute("DELETE FROM Patients WHERE Patient_ID = ?", (patient_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    assert ids(db, 'grace') == ([], False)
+
+
+def test_like_fallback_matches_fts(people):
+    expected = {text: pages(people, text) for text in QUERIES}
+
+    # As on an SQLite built without FTS5, where migration 7 creates no index
+    conn = sqlite3.connect(people)
+    try:
+        for trigger in ('insert', 'delete', 'update'):
+            conn.execute("DROP TRIGGER patients_fts_{}".format(trigger))
+        conn.execute("DROP TABLE patients_fts")
+        conn.commit()
+    finally:
+        conn.close()
+    reset_routers()  # Forgets that the file had patients_fts
+
+    assert {text: pages(people, text) for text in QUERIES} == expected
+
+
+@pytest.mark.parametrize('strategy', ['hash', 'range'])
+def test_sharded_pages_match_a_single_file(people, strategy):
+    expected = {text: pages(people, text) for text in QUERIES}
+    rebalance(people, 3, strategy, range_size=10)
+    assert {text: pages(people, text) for text in QUERIES} == expected
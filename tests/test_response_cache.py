@@ -0,0 +1,87 @@
+import sqlite3
+
+from flask import Flask, jsonify
+
+from response_cache import ResponseCache
+from shards import patient_version, rebalance, reset_routers, shard_for
+
+
+def cached_app(db, cache):
+    app = Flask(__name__)
+
+    @app.route('/names/<int:patient_id>')
+    @cache.cached('names')
+    def names(patient_id):
+        conn = sqlite3.connect(shard_for(db, patient_id))
+        try:
+            return jsonify(conn.execute("SELECT First_Name FROM Patients WHERE Patient_ID = ?",
+                                        (patient_id,)).fetchall())
+        finally:
+            conn.close()
+
+    return app
+
+
+def write(db, patient_id, sql, params):
+    # Writes through a connection the cache never sees, as another worker would
+    conn = sqlite3.connect(shard_for(db, patient_id))
+    try:
+        conn.execute(sql, params)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def add_patient(db, patient_id, first_name):
+    write(db, patient_id, "INSERT INTO Patients (Patient_ID, First_Name) VALUES (?, ?)", (patient_id, first_name))
+
+
+def test_entries_built_before_an_outside_write_are_stale(db):
+    cache = ResponseCache(validator=lambda patient_id, resource_type: patient_version(db, patient_id))
+    client = cached_app(db, cache).test_client()
+
+    assert client.get('/names/1').get_json() == []
+    assert client.get('/names/1').get_json() == []
+    assert cache.hits == 1
+
+    add_patient(db, 1, 'Ada')
+    assert client.get('/names/1').get_json() == [['Ada']]
+    assert cache.stale == 1
+
+
+def test_sharded_entries_only_go_stale_with_their_shard(db):
+    rebalance(db, 2)
+    reset_routers()
+    cache = ResponseCache(validator=lambda patient_id, resource_type: patient_version(db, patient_id))
+    client = cached_app(db, cache).test_client()
+    client.get('/names/1')
+    client.get('/names/2')
+
+    add_patient(db, 2, 'Grace')
+    assert client.get('/names/1').get_json() == []
+    assert client.get('/names/2').get_json() == [['Grace']]
+    assert cache.hits == 1 and cache.stale == 1
+
+
+def test_writes_to_another_patient_on_the_same_shard_keep_entries_fresh(db):
+    cache = ResponseCache(validator=lambda patient_id, resource_type: patient_version(db, patient_id))
+    client = cached_app(db, cache).test_client()
+    add_patient(db, 1, 'Ada')
+    client.get('/names/1')
+
+    add_patient(db, 2, 'Grace')
+    write(db, 2, "INSERT INTO sleep_observations (patient_id, observation_date) VALUES (?, ?)", (2, '2024-01-01'))
+    write(db, 2, "UPDATE Patients SET First_Name = ? WHERE Patient_ID = ?", ('Hopper', 2))
+    assert client.get('/names/1').get_json() == [['Ada']]
+    assert cache.hits == 1 and cache.stale == 0
+
+    # Every kind of write to the patient itself, to either table, is seen
+    for sql, params in [
+            ("INSERT INTO sleep_observations (patient_id, observation_date) VALUES (?, ?)", (1, '2024-01-01')),
+            ("UPDATE sleep_observations SET heart_rate = ? WHERE patient_id = ?", (60, 1)),
+            ("DELETE FROM sleep_observations WHERE patient_id = ?", (1,)),
+            ("UPDATE Patients SET First_Name = ? WHERE Patient_ID = ?", ('Lovelace', 1))]:
+        write(db, 1, sql, params)
+        client.get('/names/1')
+    assert cache.stale == 4
+    assert client.get('/names/1').get_json() == [['Lovelace']]
@@ -0,0 +1,113 @@
+import random
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+from rollups import PERIODS, ROLLUP_COLUMNS, ROLLUP_VITALS, period_start
+
+OBSERVATION_COLUMNS = ['patient_id', 'observation_date'] + ROLLUP_VITALS
+
+
+def observations(seed, patients=3, days=70):
+    # Nights from Sunday 2023-01-01 across several weeks and months, with some
+    # vitals missing or stored as text SQLite could not convert
+    rng = random.Random(seed)
+    rows = []
+    for patient_id in range(1, patients + 1):
+        for day in range(days):
+            values = [rng.choice([None, '', round(rng.uniform(50, 100), 2), rng.randint(50, 100)])
+                      for _ in ROLLUP_VITALS]
+            rows.append([patient_id, (date(2023, 1, 1) + timedelta(days=day)).isoformat()] + values)
+    return rows
+
+
+def from_scratch(conn):
+    # {(period, patient_id, period_start): [nights, count, sum, sumsq, min, max per vital]}
+    buckets = {}
+    for patient_id, observation_date, *values in conn.execute(
+            "SELECT {} FROM sleep_observations".format(', '.join(OBSERVATION_COLUMNS))):
+        try:
+            day = date.fromisoformat(observation_date)
+        except (TypeError, ValueError):
+            continue
+        for period in PERIODS:
+            bucket = buckets.setdefault((period, patient_id, period_start(period, day)),
+                                        [0] + [[] for _ in ROLLUP_VITALS])
+            bucket[0] += 1
+            for measured, value in zip(bucket[1:], values):
+                if isinstance(value, (int, float)):
+                    measured.append(value)
+    expected = {}
+    for key, (nights, *measured) in buckets.items():
+        row = [nights]
+        for values in measured:
+            row += [len(values), sum(values), sum(value * value for value in values),
+                    min(values, default=None), max(values, default=None)]
+        expected[key] = row
+    return expected
+
+
+def stored(conn):
+    return {tuple(row[:3]): list(row[3:]) for row in conn.execute(
+        "SELECT {} FROM sleep_rollups".format(', '.join(ROLLUP_COLUMNS)))}
+
+
+def assert_rollups_match(conn):
+    expected, actual = from_scratch(conn), stored(conn)
+    assert actual.keys() == expected.keys()
+    for key, row in expected.items():
+        assert actual[key] == pytest.approx(row), key
+
+
+@pytest.fixture
+def conn(db):
+    conn = sqlite3.connect(db)
+    yield conn
+    conn.close()
+
+
+def insert(conn, rows):
+    conn.executemany("INSERT INTO sleep_observations ({}) VALUES ({})".format(
+        ', '.join(OBSERVATION_COLUMNS), ', '.join('?' * len(OBSERVATION_COLUMNS))), rows)
+    conn.commit()
+
+
+def test_weeks_start_on_monday(conn):
+    insert(conn, [[1, '2023-01-01'] + [1] * len(ROLLUP_VITALS), [1, '2023-01-02'] + [2] * len(ROLLUP_VITALS)])
+    weeks = dict(conn.execute("SELECT period_start, nights FROM sleep_rollups WHERE period = 'week'"))
+    assert weeks == {'2022-12-26': 1, '2023-01-02': 1}  # Sunday the 1st ends the week of Monday the 26th
+    assert period_start('week', '2023-01-01') == '2022-12-26' and period_start('week', '2023-01-08') == '2023-01-02'
+    assert_rollups_match(conn)
+
+
+def test_triggers_match_a_recomputation_through_every_write(conn):
+    insert(conn, observations(seed=1))
+    assert_rollups_match(conn)
+
+    # Upserts as the write-behind queue and fhir_import.py issue them, changing some values
+    insert_or_update = "INSERT INTO sleep_observations ({}) VALUES ({}) ON CONFLICT(patient_id, observation_date) " \
+                       "DO UPDATE SET {}".format(', '.join(OBSERVATION_COLUMNS), ', '.join('?' * len(OBSERVATION_COLUMNS)),
+                                                 ', '.join('{0} = excluded.{0}'.format(c) for c in ROLLUP_VITALS))
+    conn.executemany(insert_or_update, observations(seed=2)[::3])
+    conn.commit()
+    assert_rollups_match(conn)
+
+    conn.execute("UPDATE sleep_observations SET heart_rate = 120, blood_oxygen = '' "
+                 "WHERE patient_id = 2 AND observation_date LIKE '2023-01-1%'")
+    # Moves across a week and a month boundary, and to another patient
+    conn.execute("UPDATE sleep_observations SET observation_date = '2023-04-03' "
+                 "WHERE patient_id = 1 AND observation_date = '2023-01-31'")
+    conn.execute("UPDATE sleep_observations SET patient_id = 4 WHERE patient_id = 3 AND observation_date < '2023-01-10'")
+    # An unparseable date drops out of every bucket
+    conn.execute("UPDATE sleep_observations SET observation_date = 'unknown' "
+                 "WHERE patient_id = 1 AND observation_date = '2023-02-15'")
+    conn.commit()
+    assert_rollups_match(conn)
+
+    conn.execute("DELETE FROM sleep_observations WHERE patient_id = 2 AND observation_date >= '2023-02-01'")
+    conn.execute("DELETE FROM sleep_observations WHERE patient_id = 1 AND observation_date = '2023-01-02'")
+    conn.commit()
+    assert_rollups_match(conn)
+    assert not conn.execute("SELECT 1 FROM sleep_rollups WHERE patient_id = 2 AND period_start >= '2023-02-01'"
+                            ).fetchone()
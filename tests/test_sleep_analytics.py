@@ -0,0 +1,23 @@
+import math
+import sqlite3
+
+from sleep_analytics import load_columns, patient_analytics
+
+
+def test_text_vitals_load_as_nan(db):
+    conn = sqlite3.connect(db)
+    try:
+        conn.executemany('''
+            INSERT INTO sleep_observations (patient_id, observation_date, heart_rate, sleeping_hours, stress_level)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(1, '2024-01-01', 60, '', 2), (1, '2024-01-02', 'n/a', 7.5, '')])
+        conn.commit()
+    finally:
+        conn.close()
+
+    columns = load_columns(db, 1)
+    assert columns['heart_rate'][0] == 60 and math.isnan(columns['heart_rate'][1])
+    assert math.isnan(columns['sleeping_hours'][0]) and columns['sleeping_hours'][1] == 7.5
+    assert columns['stress_level'][0] == 2 and math.isnan(columns['stress_level'][1])
+    assert load_columns(db)['day'].tolist() == columns['day'].tolist()
+    assert patient_analytics(db, 1) is not None
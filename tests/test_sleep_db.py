@@ -0,0 +1,26 @@
+import sqlite3
+
+import pytest
+
+from shards import rebalance
+from sleep_db import read_patient_names
+
+PATIENTS = [(1, 'Zoe', 'Young'), (2, 'Adam', 'Abbott'), (3, 'Mia', 'Moore'), (4, 'Ben', 'Adams'), (5, 'Eve', 'Zimmer')]
+
+
+@pytest.fixture
+def patients_db(db):
+    conn = sqlite3.connect(db)
+    conn.executemany("INSERT INTO Patients (Patient_ID, First_Name, Last_Name) VALUES (?, ?, ?)", PATIENTS)
+    conn.commit()
+    conn.close()
+    return db
+
+
+def test_names_are_in_patient_id_order(patients_db):
+    assert read_patient_names(patients_db) == PATIENTS
+
+
+def test_names_are_in_patient_id_order_across_shards(patients_db):
+    rebalance(patients_db, 3)
+    assert read_patient_names(patients_db) == PATIENTS
@@ -0,0 +1,84 @@
+import json
+import sqlite3
+
+import pytest
+
+from write_queue import WriteBehindQueue, observation_row
+
+
+def row(day, heart_rate=60):
+    return observation_row({'patient_id': 1, 'observation_date': '2023-01-{:02d}'.format(day),
+                            'heart_rate': heart_rate, 'sleeping_hours': 7})
+
+
+def execute(db_name, sql):
+    conn = sqlite3.connect(db_name)
+    try:
+        conn.execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def stored_days(db_name):
+    conn = sqlite3.connect(db_name)
+    try:
+        return [r[0] for r in conn.execute("SELECT observation_date FROM sleep_observations ORDER BY 1")]
+    finally:
+        conn.close()
+
+
+def reject_heart_rate(db_name, heart_rate):
+    execute(db_name, '''
+        CREATE TRIGGER reject_heart_rate BEFORE INSERT ON sleep_observations WHEN NEW.heart_rate = {}
+        BEGIN SELECT RAISE(ABORT, 'rejected heart rate'); END
+    '''.format(heart_rate))
+
+
+@pytest.fixture
+def queue(db, tmp_path):
+    queue = WriteBehindQueue(db, str(tmp_path / 'writeq'), max_delay=0.2)
+    yield queue
+    queue.close()
+
+
+def test_failing_rows_are_rejected_and_the_rest_committed(db, queue):
+    reject_heart_rate(db, 666)
+    for day, heart_rate in ((1, 60), (2, 666), (3, 60)):
+        queue.submit(row(day, heart_rate))
+    assert queue.flush(timeout=10)
+
+    assert stored_days(db) == ['2023-01-01', '2023-01-03']
+    with open(queue.rejects_path) as f:
+        rejects = [json.loads(line) for line in f]
+    assert [r['row'][1] for r in rejects] == ['2023-01-02'] and 'rejected heart rate' in rejects[0]['error']
+    stats = queue.stats()
+    assert stats['rejected'] == 1 and stats['committed'] == 2
+    assert stats['writer_alive'] and not stats['healthy']
+
+    queue.submit(row(4))
+    assert queue.flush(timeout=10)
+    assert queue.stats()['healthy'] and stored_days(db)[-1] == '2023-01-04'
+
+
+def test_a_permanent_error_is_not_retried(db, queue):
+    queue.start()
+    execute(db, "DROP TABLE sleep_observations")
+    queue.submit(row(1))
+    assert queue.flush(timeout=10)
+
+    stats = queue.stats()
+    assert stats['rejected'] == 1 and stats['retries'] == 0
+    assert stats['writer_alive'] and 'no such table' in stats['last_error']
+
+
+def test_a_journal_that_cannot_be_replayed_does_not_stop_the_start(db, queue):
+    reject_heart_rate(db, 666)
+    with open(queue.journal_path + '.0', 'w') as f:
+        for seq, day, heart_rate in ((1, 1, 666), (2, 2, 60)):
+            f.write(json.dumps([seq, list(row(day, heart_rate))]) + '\n')
+    queue.start()
+
+    assert stored_days(db) == ['2023-01-02']
+    stats = queue.stats()
+    assert stats['replayed'] == 1 and stats['rejected'] == 1
@@ -0,0 +1,387 @@
+import collections
+import fcntl
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date
+
+from db_pool import connection
+from fhir_ingest import OBSERVATION_COLUMNS, VITAL_COLUMNS
+from instrumentation import get_logger, log_event
+from shards import ShardConnections, migrate
+
+
+# Write-behind queue for sleep observation uploads. Handlers submit validated rows
+# and return immediately; a single writer thread group-commits them in batches of
+# up to `max_batch` rows or every `max_delay` seconds. Every accepted row is first
+# appended to an fsynced journal (fsyncs of concurrent submitters are grouped), and
+# the journal's last committed sequence is stored in write_queue_state in the same
+# transaction as the batch, so after a crash exactly the uncommitted tail is
+# replayed. On a sharded database each batch is split by shard and the
+# sequence, kept in the catalog, commits after the shards; rows that reached a
+# shard before a crash are skipped as duplicates on replay. Each process holds
+# an flock on its own journal slot
+# (<journal>.0, <journal>.1, ...) and on start replays any slot left by a process
+# that is gone. A batch that fails for any reason other than a locked database
+# is written again row by row; rows that still fail are appended with the error
+# to <journal>.rejects.ndjson instead of being retried forever.
+
+DEFAULT_MAX_BATCH = 500
+DEFAULT_MAX_DELAY = 0.05  # Seconds a partial batch waits for more rows
+DEFAULT_MAX_PENDING = 10000
+RETRY_BACKOFF_MAX = 1.0  # Seconds between retries of a batch on a locked database
+
+logger = get_logger('write_queue')
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _is_transient(error):
+    # A locked or busy database clears up; anything else (no such table, a
+    # constraint or trigger failing) fails the same way on every retry
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+def observation_row(data):
+    # Validates an insert_sleep_data payload into an OBSERVATION_COLUMNS row;
+    # raises ValueError with a message for the client
+    try:
+        patient_id = int(data['patient_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('patient_id must be an integer')
+    observation_date = data.get('observation_date')
+    try:
+        date.fromisoformat(observation_date)
+    except (TypeError, ValueError):
+        raise ValueError('observation_date must be a YYYY-MM-DD date')
+
+    values = []
+    for column in VITAL_COLUMNS:
+        value = data.get(column)
+        if value is not None and value != '':
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError('{} must be a number'.format(column))
+        values.append(value if value != '' else None)
+    return tuple([patient_id, observation_date] + values)
+
+
+class WriteBehindQueue:
+
+    def __init__(self, db_name, journal_path, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY,
+                 max_pending=DEFAULT_MAX_PENDING, on_commit=None):
+        self.db_name = db_name
+        self.journal_path = journal_path
+        self.rejects_path = journal_path + '.rejects.ndjson'
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.on_commit = on_commit  # Called with each committed batch of rows, on the writer thread
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._sync_lock = threading.Lock()
+        self._journal = None
+        self._slot = None
+        self._written_seq = 0
+        self._synced_seq = 0
+        self._committed_seq = 0
+        self._thread = None
+        self._closing = False
+
+        self.accepted = 0
+        self.committed = 0
+        self.duplicates = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.rejected_full = 0
+        self.replayed = 0
+        self.retries = 0
+        self.rejected = 0
+        self.last_error = None  # Cleared by the next batch that commits as a whole
+
+    # Journal
+
+    def _claim_slot(self):
+        # Locks the first free journal slot for this process and replays every
+        # unlocked slot (including it) left behind by earlier processes
+        claimed = None
+        index = 0
+        existing = sorted(glob.glob(glob.escape(self.journal_path) + '.*'))
+        candidates = [path for path in existing if path.rsplit('.', 1)[1].isdigit()]
+        while claimed is None:
+            path = '{}.{}'.format(self.journal_path, index)
+            if path not in candidates:
+                candidates.append(path)
+            index += 1
+            f = open(path, 'a+', encoding='utf-8')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            claimed = (path, f)
+
+        for path in candidates:
+            if path == claimed[0]:
+                self._replay(path, claimed[1])
+                continue
+            if not os.path.exists(path):
+                continue
+            with open(path, 'a+', encoding='utf-8') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # Owned by a live process
+                self._replay(path, f)
+                f.truncate(0)
+        return claimed
+
+    def _replay(self, path, f):
+        # Commits journal entries past the slot's committed sequence
+        slot = os.path.basename(path)
+        with connection(self.db_name) as conn:
+            row = conn.execute("SELECT committed_seq FROM write_queue_state WHERE journal = ?", (slot,)).fetchone()
+        committed = row[0] if row else 0
+
+        f.seek(0)
+        entries = []
+        for line in f:
+            try:
+                seq, row = json.loads(line)
+            except ValueError:
+                break  # A write torn by the crash was never acknowledged
+            if seq > committed:
+                entries.append((seq, tuple(row)))
+        if entries:
+            _, written = self._commit(slot, entries)
+            self.replayed += len(written)
+            self.rejected += len(entries) - len(written)
+            log_event(logger, logging.INFO, 'journal_replayed', journal=slot, rows=len(entries))
+
+    def _sync(self, seq):
+        # Group fsync: whoever takes the lock syncs every entry written so far
+        if self._synced_seq >= seq:
+            return
+        with self._sync_lock:
+            if self._synced_seq >= seq:
+                return
+            with self._cond:
+                target = self._written_seq
+                self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._synced_seq = max(self._synced_seq, target)
+
+    # Lifecycle
+
+    def start(self):
+        # Replays leftover journals and starts the writer thread; idempotent
+        with self._cond:
+            if self._thread is not None:
+                return
+            if self._closing:
+                raise RuntimeError('write queue is closed')
+            migrate(self.db_name)
+            path, self._journal = self._claim_slot()
+            self._slot = os.path.basename(path)
+            self._journal.truncate(0)
+            with connection(self.db_name) as conn:
+                row = conn.execute("SELECT committed_seq FROM write_queue_state WHERE journal = ?",
+                                   (self._slot,)).fetchone()
+            self._written_seq = self._synced_seq = self._committed_seq = row[0] if row else 0
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def submit(self, row, timeout=None):
+        """Journal one OBSERVATION_COLUMNS row and queue it for the writer.
+
+        Blocks while the queue holds `max_pending` rows, for at most `timeout`
+        seconds (None waits indefinitely), then raises QueueFull. Returns the row's
+        journal sequence once the journal entry is on disk.
+        """
+        self.start()
+        with self._cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            # Rows the writer has taken but not committed still count as pending
+            while self._written_seq - self._committed_seq >= self.max_pending and not self._closing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.rejected_full += 1
+                    raise QueueFull('write queue is full')
+                self._cond.wait(remaining)
+            if self._closing:
+                raise RuntimeError('write queue is closed')
+            seq = self._written_seq + 1
+            self._journal.write(json.dumps([seq, row]) + '\n')
+            self._written_seq = seq
+            self._queue.append((seq, row))
+            self.accepted += 1
+            self._cond.notify_all()
+        self._sync(seq)
+        return seq
+
+    def flush(self, timeout=None):
+        # Waits until every accepted row is committed; False on timeout
+        with self._cond:
+            return self._cond.wait_for(lambda: self._committed_seq >= self._written_seq, timeout)
+
+    def close(self, timeout=30):
+        # Flush-on-shutdown: commits what is queued, then stops the writer. Rows
+        # that could not be committed stay in the journal for the next start.
+        with self._cond:
+            if self._thread is None or self._journal.closed:
+                self._closing = True
+                return self._committed_seq >= self._written_seq
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        drained = not self._thread.is_alive()
+        with self._cond:
+            drained = drained and self._committed_seq >= self._written_seq
+            if drained:
+                self._journal.truncate(0)
+            self._journal.close()
+        return drained
+
+    # Writer
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                deadline = time.monotonic() + self.max_delay
+                while len(self._queue) < self.max_batch and not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+                self._cond.notify_all()  # Room for blocked submitters
+
+            inserted, written = self._commit(self._slot, batch)
+
+            with self._cond:
+                self._committed_seq = batch[-1][0]
+                self.batches += 1
+                self.committed += inserted
+                self.duplicates += len(written) - inserted
+                self.rejected += len(batch) - len(written)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                if not self._queue and self._committed_seq >= self._written_seq and not self._journal.closed:
+                    self._journal.truncate(0)  # Everything journaled is in the database or the rejects
+                self._cond.notify_all()
+            if self.on_commit is not None and written:
+                try:
+                    self.on_commit([row for _, row in written])
+                except Exception as e:
+                    log_event(logger, logging.ERROR, 'on_commit_failed', error=str(e))
+
+    def _commit(self, slot, batch):
+        # Returns (rows inserted, entries written). When the batch as a whole
+        # fails, each row is written on its own and the failing ones are rejected.
+        try:
+            inserted = self._write_retrying(slot, batch, batch[-1][0])
+            self.last_error = None
+            return inserted, batch
+        except Exception as e:
+            self.last_error = str(e)
+            log_event(logger, logging.ERROR, 'batch_failed', rows=len(batch), error=str(e))
+
+        inserted = 0
+        written = []
+        for entry in batch:
+            try:
+                inserted += self._write_retrying(slot, [entry], entry[0])
+                written.append(entry)
+            except Exception as e:
+                self._reject(entry, e)
+        if not written or written[-1] is not batch[-1]:
+            # Move the slot's sequence past the rejected tail, so a restart does not replay it
+            try:
+                self._write_retrying(slot, [], batch[-1][0])
+            except Exception as e:
+                log_event(logger, logging.ERROR, 'sequence_not_saved', seq=batch[-1][0], error=str(e))
+        return inserted, written
+
+    def _write_retrying(self, slot, entries, seq):
+        # The rows are journaled, so a locked database is waited out with backoff
+        backoff = 0.01
+        while True:
+            try:
+                return self._write(slot, entries, seq)
+            except Exception as e:
+                if not _is_transient(e):
+                    raise
+                self.retries += 1
+                self.last_error = str(e)
+                log_event(logger, logging.WARNING, 'batch_retry', rows=len(entries), error=str(e))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+
+    def _reject(self, entry, error):
+        # Keeps a row that cannot be written, with the reason, for an operator to fix and resubmit
+        log_event(logger, logging.ERROR, 'row_rejected', seq=entry[0], error=str(error))
+        try:
+            with open(self.rejects_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'seq': entry[0], 'row': list(entry[1]), 'error': str(error)}) + '\n')
+        except OSError as e:
+            log_event(logger, logging.ERROR, 'reject_not_saved', row=json.dumps(list(entry[1])), error=str(e))
+
+    def _write(self, slot, entries, seq):
+        # One transaction per shard: the rows (existing keys are left alone), then
+        # the slot's sequence, which a single-file database commits with the rows
+        with ShardConnections(self.db_name) as shards:
+            try:
+                inserted = 0
+                for conn, group in shards.split(entries, lambda entry: entry[1][0]):
+                    cursor = conn.executemany('''
+                        INSERT INTO sleep_observations ({}) VALUES ({})
+                        ON CONFLICT(patient_id, observation_date) DO NOTHING
+                    '''.format(', '.join(OBSERVATION_COLUMNS), ', '.join('?' * len(OBSERVATION_COLUMNS))),
+                        [row for _, row in group])
+                    inserted += cursor.rowcount
+                shards.for_path(self.db_name).execute('''
+                    INSERT INTO write_queue_state (journal, committed_seq) VALUES (?, ?)
+                    ON CONFLICT(journal) DO UPDATE SET committed_seq = excluded.committed_seq,
+                                                       updated_at = CURRENT_TIMESTAMP
+                ''', (slot, seq))
+                shards.commit()
+            except BaseException:
+                shards.rollback()
+                raise
+        return inserted
+
+    def stats(self):
+        with self._cond:
+            alive = self._thread is not None and self._thread.is_alive()
+            return {
+                # The writer (started on the first submit) is running and its last batch committed as a whole
+                'healthy': (alive or self._thread is None) and self.last_error is None,
+                'writer_alive': alive,
+                'last_error': self.last_error,
+                'pending': self._written_seq - self._committed_seq,
+                'accepted': self.accepted,
+                'committed': self.committed,
+                'duplicates': self.duplicates,
+                'batches': self.batches,
+                'largest_batch': self.largest_batch,
+                'rejected_full': self.rejected_full,
+                'replayed': self.replayed,
+                'retries': self.retries,
+                'rejected': self.rejected,
+                'rejects': self.rejects_path,
+                'journal': self._slot,
+                'max_batch': self.max_batch,
+                'max_delay': self.max_delay,
+                'max_pending': self.max_pending,
+            }